@@ -22,6 +22,7 @@ Indigo Admin Command Line Interface.
 
 Usage:
   iadmin create
+  iadmin bucketize <path> [<buckets>]
   iadmin lu [<name>]
   iadmin lg [<name>]
   iadmin mkuser [<name>]
@@ -31,6 +32,12 @@ Usage:
   iadmin atg <name> <userlist> ...
   iadmin rfg <name> <userlist> ...
   iadmin rmgroup [<name>]
+  iadmin jobs resume
+  iadmin jobs [<id>]
+  iadmin graph-queue
+  iadmin graph-replay
+  iadmin graph-sync [<path>]
+  iadmin reindex [<path>]
   iadmin ingest <user> <group> <path> [--reference --localip <ip> --include <expr> --no-compress]
 
 
@@ -41,6 +48,10 @@ Options:
   --localip      Specify the IP address for this machine (subnets/private etc)
   --include      include ONLY paths that include this string
   --no-compress  by default compress data when uploaded in Cassandra, set to disable compression
+
+'graph-sync' finds the vertices to drop through the 'son' edges of the
+collections, a vertex which isn't linked to any collection is left in the
+graph.
 """
 
 import argparse
@@ -55,12 +66,22 @@ import indigo
 from indigo import get_config
 from indigo.models.errors import GroupConflictError
 from indigo.models import (
+    Collection,
+    GraphBacklog,
+    GraphQueueStats,
     Group,
     initialise,
+    Job,
     sync,
+    TreeEntry,
     User,
 )
+from indigo.graph_queue import replay_backlog
 from indigo.ingest import do_ingest
+from indigo.jobs import (
+    execute_job,
+    resume_jobs,
+)
 
 
 class IndigoApplication(object):
@@ -102,6 +123,34 @@ class IndigoApplication(object):
             self.print_error(msg.format(", ".join(not_added)))
 
 
+    def bucketize(self, args):
+        """Split the entries of a collection in several partitions"""
+        path = unicode(args['<path>'], "utf-8")
+        collection = Collection.find(path)
+        if not collection:
+            self.print_error(u"Collection {} not found".format(path))
+            return
+        if args['<buckets>']:
+            try:
+                buckets = int(args['<buckets>'])
+            except ValueError:
+                buckets = 0
+        else:
+            buckets = get_config(None).get('TREE_ENTRY_BUCKETS', 0) or 16
+        if buckets < 1:
+            self.print_error(u"Invalid number of buckets {}".format(
+                args['<buckets>']))
+            return
+        if TreeEntry.get_buckets(collection.path):
+            self.print_error(u"Collection {} is already split in {} "
+                             u"buckets".format(path,
+                                               TreeEntry.get_buckets(collection.path)))
+            return
+        count = TreeEntry.bucketize(collection.path, buckets)
+        self.print_success(u"Moved {} entries of {} to {} buckets".format(
+            count, path, buckets))
+
+
     def create(self, args):
         """Create the keyspace and the tables"""
         sync()
@@ -136,6 +185,65 @@ class IndigoApplication(object):
         do_ingest(user, group, path)
 
 
+    def graph_queue(self, args):
+        """Show the metrics published by the write-behind queue of each
+        process and the number of mutations in the backlog"""
+        rows = sorted(GraphQueueStats.objects.all(),
+                      key=lambda row: row.process)
+        if not rows:
+            print u"No graph queue running"
+        for row in rows:
+            print (u"{0.bold}{1}{0.normal}: depth {2}, in flight {3}, "
+                   u"lag {4:.1f}s, enqueued {5}, flushed {6}, retried {7}, "
+                   u"backlogged {8}, updated {9}".format(self.terminal,
+                                                         row.process,
+                                                         row.depth,
+                                                         row.in_flight,
+                                                         row.lag,
+                                                         row.enqueued,
+                                                         row.flushed,
+                                                         row.retried,
+                                                         row.backlogged,
+                                                         row.modified_ts))
+        print u"{} vertex mutation(s) in the backlog".format(
+            GraphBacklog.objects.count())
+
+
+    def graph_replay(self, args):
+        """Write the graph mutations saved in the backlog by the write-behind
+        queue"""
+        done, failed = replay_backlog()
+        if failed:
+            self.print_error(u"{} vertex mutation(s) failed again".format(failed))
+        if done:
+            self.print_success(u"Replayed {} vertex mutation(s)".format(done))
+        elif not failed:
+            print u"No graph mutation to replay"
+
+
+    def graph_sync(self, args):
+        """Rebuild the graph of the users and of a subtree from the Cassandra
+        tables. It runs as a job so an interrupted sync can be finished with
+        'iadmin jobs resume'"""
+        path = unicode(args['<path>'] or '/', "utf-8")
+        if not Collection.find(path):
+            self.print_error(u"Collection {} not found".format(path))
+            return
+        job = execute_job("graph_sync", {"path": path})
+        if job.error:
+            self.print_error(u"Job {} failed: {}".format(job.uuid, job.error))
+            return
+        stats = job.get_progress()
+        self.print_success(u"Graph synchronised: {} collection(s), {} resource(s), "
+                           u"{} user(s) checked, {} vertices created, {} linked, "
+                           u"{} dropped".format(stats.get("collections", 0),
+                                                stats.get("resources", 0),
+                                                stats.get("users", 0),
+                                                stats.get("created", 0),
+                                                stats.get("linked", 0),
+                                                stats.get("dropped", 0)))
+
+
     def list_groups(self, args):
         """List all groups or a specific group if the name is specified"""
         if args['<name>']:
@@ -160,6 +268,37 @@ class IndigoApplication(object):
                 print group.name
 
 
+    def list_jobs(self, args):
+        """List all jobs or a specific job if the id is specified"""
+        if args['<id>']:
+            job = Job.find(args['<id>'])
+            if not job:
+                self.print_error(u"Job {} not found".format(args['<id>']))
+                return
+            job_info = job.to_dict()
+            for label, key in [("Job id", "id"),
+                               ("Type", "type"),
+                               ("Parameters", "spec"),
+                               ("State", "state"),
+                               ("Progress", "progress"),
+                               ("User", "username"),
+                               ("Owner", "owner"),
+                               ("Created", "create_ts"),
+                               ("Last update", "modified_ts"),
+                               ("Error", "error")]:
+                print u"{0.bold}{1}{0.normal}: {2}".format(
+                    self.terminal,
+                    label,
+                    job_info.get(key) or "")
+        else:
+            jobs = sorted(Job.objects.all(), key=lambda job: job.create_ts)
+            for job in jobs:
+                print u"{} {:<10} {:<8} {}".format(job.uuid,
+                                                   job.job_type,
+                                                   job.state,
+                                                   job.create_ts)
+
+
     def list_users(self, args):
         """List all users or a specific user if the name is specified"""
         if args['<name>']:
@@ -274,6 +413,34 @@ class IndigoApplication(object):
                                                               msg)
 
 
+    def reindex(self, args):
+        """Index again the objects of a subtree in the search and metadata
+        indexes. The indexes of the whole tree are emptied and rebuilt, this
+        is needed after an upgrade of the index tables or a change of
+        SEARCH_SHARDS or METADATA_INDEX_SHARDS. It runs as a job so an
+        interrupted reindex can be finished with 'iadmin jobs resume'"""
+        path = unicode(args['<path>'] or '/', "utf-8")
+        if not Collection.find(path):
+            self.print_error(u"Collection {} not found".format(path))
+            return
+        job = execute_job("reindex", {"path": path, "reset": path == '/'})
+        if job.error:
+            self.print_error(u"Job {} failed: {}".format(job.uuid, job.error))
+            return
+        stats = job.get_progress()
+        self.print_success(u"Indexed {} collection(s), {} resource(s)".format(
+            stats.get("collections", 0), stats.get("resources", 0)))
+
+
+    def resume_jobs(self, args):
+        """Execute the pending jobs and the jobs interrupted by a restart"""
+        uuids = resume_jobs(wait=True)
+        if uuids:
+            self.print_success(u"Executed {} job(s)".format(len(uuids)))
+        else:
+            print u"No job to execute"
+
+
     def rm_from_group(self, args):
         """Remove user(s) from a group."""
         groupname = args['<name>']
@@ -347,10 +514,22 @@ def main():
 
     if arguments['atg']:
         return app.add_to_group(arguments)
+    elif arguments['bucketize']:
+        return app.bucketize(arguments)
     elif arguments['create']:
         return app.create(arguments)
+    elif arguments['graph-queue']:
+        return app.graph_queue(arguments)
+    elif arguments['graph-replay']:
+        return app.graph_replay(arguments)
+    elif arguments['graph-sync']:
+        return app.graph_sync(arguments)
     elif arguments['ingest']:
         return app.do_ingest(arguments)
+    elif arguments['jobs']:
+        if arguments['resume']:
+            return app.resume_jobs(arguments)
+        return app.list_jobs(arguments)
     elif arguments['lu']:
         return app.list_users(arguments)
     elif arguments['lg']:
@@ -361,6 +540,8 @@ def main():
         return app.mk_user(arguments)
     elif arguments['moduser']:
         return app.mod_user(arguments)
+    elif arguments['reindex']:
+        return app.reindex(arguments)
     if arguments['rfg']:
         return app.rm_from_group(arguments)
     elif arguments['rmgroup']:
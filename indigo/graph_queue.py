@@ -0,0 +1,474 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from collections import OrderedDict
+from itertools import islice
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+from indigo import get_config
+from indigo.log import init_log
+from indigo.util_graph import graph_apply
+
+logger = init_log('graph_queue')
+
+# Maximum number of vertices waiting in the queue, the writers block when it's
+# full
+GRAPH_QUEUE_SIZE = 10000
+
+# Number of threads which flush the queue
+GRAPH_QUEUE_WORKERS = 2
+
+# Maximum number of vertices written by a single traversal
+GRAPH_QUEUE_BATCH_SIZE = 100
+
+# Number of times a vertex is flushed before it's moved to the backlog table
+GRAPH_QUEUE_ATTEMPTS = 3
+
+# Number of seconds a worker waits for new mutations before it checks if it
+# has to stop
+GRAPH_QUEUE_WAIT = 1.0
+
+# Number of seconds between two publications of the metrics of the queue in
+# the GraphQueueStats table, they expire after GRAPH_QUEUE_STATS_TTL seconds
+GRAPH_QUEUE_PUBLISH = 10.0
+GRAPH_QUEUE_STATS_TTL = 60
+
+
+def new_entry(label, uuid):
+    """Return an empty entry of the queue for a vertex"""
+    return {
+        'label': label,
+        'uuid': uuid,
+        'drop': False,
+        'add': None,
+        'metadata': None,
+        'ts': time.time(),
+        'attempts': 0,
+    }
+
+
+def coalesce(entry, op, params):
+    """Apply a mutation to the pending entry of a vertex, return False if the
+    entry doesn't need to be written anymore"""
+    if op == 'drop':
+        if entry['add'] and not entry['drop']:
+            # The vertex has never been written
+            return False
+        entry['drop'] = True
+        entry['add'] = None
+        entry['metadata'] = None
+    elif op == 'add':
+        entry['add'] = params
+    elif op == 'update':
+        entry['metadata'] = params
+    else:
+        raise ValueError(u"Unknown graph mutation '{}'".format(op))
+    return True
+
+
+def merge(older, newer):
+    """Return the entry which applies the mutations of 'older' and then the
+    ones of 'newer'"""
+    if newer['drop']:
+        return newer
+    entry = dict(older)
+    if newer['add']:
+        entry['add'] = newer['add']
+    if newer['metadata'] is not None:
+        entry['metadata'] = newer['metadata']
+    return entry
+
+
+class GraphWriteQueue(object):
+    """Write-behind queue for the mutations of the graph.
+
+    The graph is a secondary view of the tree so, when GRAPH_WRITE_BEHIND is
+    set, the models don't wait for DSE Graph. The mutations are kept in an
+    ordered dictionary with one entry per vertex, a new mutation is merged in
+    the pending entry of its vertex. Background threads take the oldest
+    entries and write them with a few batched traversals, a vertex isn't
+    handed out while an earlier entry of it is being written so the
+    mutations of a vertex are applied in order. An entry which
+    can't be written is retried and then saved in the GraphBacklog table,
+    'iadmin graph-replay' writes it later. The workers publish the metrics
+    of the queue, 'iadmin graph-queue' shows them. Like the other shared objects the
+    threads are started again in a forked process."""
+
+    def __init__(self, size=GRAPH_QUEUE_SIZE, workers=GRAPH_QUEUE_WORKERS,
+                 batch_size=GRAPH_QUEUE_BATCH_SIZE):
+        self.size = size
+        self.workers = workers
+        self.batch_size = batch_size
+        self._reset()
+
+
+    def _reset(self):
+        """Initialise the state of the queue for the current process"""
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._entries = OrderedDict()
+        self._threads = []
+        # Keys of the vertices being written by the workers
+        self._busy = set()
+        self._stopping = False
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.retried = 0
+        self.backlogged = 0
+        self.last_flush_ts = None
+        self._published_ts = 0
+
+
+    def _check_fork(self):
+        """Forget the entries and the threads of a parent process"""
+        if os.getpid() != self._pid:
+            self._reset()
+
+
+    def _start(self):
+        """Start the workers if they aren't running, the lock is held"""
+        self._threads = [thread for thread in self._threads
+                         if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work,
+                                      name="graph-queue-{}".format(
+                                          len(self._threads)))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+
+    def enabled(self):
+        """Return True if the graph mutations are written asynchronously"""
+        cfg = get_config(None)
+        return bool(cfg.get('GRAPH_WRITE_BEHIND', False))
+
+
+    def put(self, op, label, uuid, params):
+        """Queue a mutation of a vertex, block while the queue is full"""
+        self._check_fork()
+        key = (label, uuid)
+        with self._cond:
+            self._start()
+            self._stopping = False
+            while key not in self._entries and len(self._entries) >= self.size:
+                self._cond.wait()
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = new_entry(label, uuid)
+                self._entries[key] = entry
+            else:
+                self.coalesced += 1
+            self.enqueued += 1
+            if not coalesce(entry, op, params):
+                del self._entries[key]
+                self._cancel_children(uuid)
+            self._cond.notify_all()
+
+
+    def _cancel_children(self, uuid):
+        """Cancel the pending creation of the vertices below a vertex whose
+        creation has been cancelled, their 'son' edge would have no parent.
+        The lock is held"""
+        parents = [uuid]
+        while parents:
+            parent = parents.pop()
+            for key, entry in self._entries.items():
+                if entry['add'] and entry['add'].get('parent_uuid') == parent:
+                    parents.append(entry['uuid'])
+                    if entry['drop']:
+                        # An earlier vertex still has to be dropped
+                        entry['add'] = None
+                        entry['metadata'] = None
+                    else:
+                        del self._entries[key]
+
+
+    def requeue(self, entry):
+        """Put back an entry which has been taken by a worker, the mutations
+        queued in the meantime are applied after it"""
+        key = (entry['label'], entry['uuid'])
+        with self._cond:
+            newer = self._entries.pop(key, None)
+            if newer is not None:
+                entry = merge(entry, newer)
+            self._entries[key] = entry
+            self._cond.notify_all()
+
+
+    def _ready(self):
+        """Return the keys of the oldest entries which can be written, the
+        lock is held"""
+        return list(islice((key for key in self._entries
+                            if key not in self._busy), self.batch_size))
+
+
+    def _take(self):
+        """Wait for entries and remove the oldest ones which aren't being
+        written by another worker. An empty list is returned if none came
+        in GRAPH_QUEUE_WAIT seconds, None when the queue is stopped"""
+        with self._cond:
+            keys = self._ready()
+            if not keys and not self._stopping:
+                self._cond.wait(GRAPH_QUEUE_WAIT)
+                keys = self._ready()
+            if not keys and self._stopping:
+                return None
+            batch = [self._entries.pop(key) for key in keys]
+            self._busy.update(keys)
+            self._cond.notify_all()
+            return batch
+
+
+    def _done(self, batch):
+        """Release the vertices of a batch which has been written"""
+        with self._cond:
+            self._busy.difference_update([(entry['label'], entry['uuid'])
+                                          for entry in batch])
+            self._cond.notify_all()
+
+
+    def _work(self):
+        """Main loop of a worker"""
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            if batch:
+                try:
+                    self.flush_batch(batch)
+                finally:
+                    self._done(batch)
+            self._publish()
+
+
+    def _publish(self):
+        """Save the metrics of the queue every GRAPH_QUEUE_PUBLISH seconds so
+        they can be read from other processes"""
+        from indigo.models import GraphQueueStats
+        now = time.time()
+        with self._cond:
+            if now - self._published_ts < GRAPH_QUEUE_PUBLISH:
+                return
+            self._published_ts = now
+        try:
+            GraphQueueStats.publish(u"{}:{}".format(socket.gethostname(),
+                                                    os.getpid()),
+                                    self.stats(), GRAPH_QUEUE_STATS_TTL)
+        except Exception:
+            logger.warning(u"Metrics of the graph queue not published: "
+                           u"{}".format(traceback.format_exc()))
+
+
+    def flush_batch(self, batch):
+        """Write a list of entries, if the batched traversals fail each entry
+        is tried alone so a single bad vertex doesn't hold back the others"""
+        try:
+            graph_apply(batch)
+        except Exception:
+            if len(batch) == 1:
+                self._failed(batch[0], traceback.format_exc())
+                return
+            for entry in batch:
+                try:
+                    graph_apply([entry])
+                except Exception:
+                    self._failed(entry, traceback.format_exc())
+                else:
+                    self._flushed(1)
+        else:
+            self._flushed(len(batch))
+
+
+    def _flushed(self, count):
+        """Record entries written to the graph"""
+        with self._cond:
+            self.flushed += count
+            self.last_flush_ts = time.time()
+
+
+    def _failed(self, entry, error):
+        """Retry an entry which couldn't be written (a vertex may depend on a
+        parent still in flight in another worker) or save it in the
+        backlog"""
+        from indigo.models import GraphBacklog
+        entry['attempts'] += 1
+        if entry['attempts'] < GRAPH_QUEUE_ATTEMPTS:
+            with self._cond:
+                self.retried += 1
+            self.requeue(entry)
+            return
+        logger.error(u"Graph mutation of {} {} failed, moved to the "
+                     u"backlog".format(entry['label'], entry['uuid']))
+        logger.error(error)
+        try:
+            GraphBacklog.store(entry, error)
+        except Exception:
+            logger.error(u"Graph mutation of {} {} lost: {}".format(
+                entry['label'], entry['uuid'], traceback.format_exc()))
+            return
+        with self._cond:
+            self.backlogged += 1
+
+
+    def settle(self, label, uuids):
+        """Wait until the queued and the in-flight mutations of a list of
+        vertices are written, before the vertices are written directly.
+        Return True if some of them had pending mutations"""
+        self._check_fork()
+        keys = set([(label, uuid) for uuid in uuids])
+        pending = False
+        with self._cond:
+            if keys.intersection(self._entries):
+                self._start()
+            while (keys.intersection(self._entries) or
+                   keys.intersection(self._busy)):
+                pending = True
+                self._cond.wait(GRAPH_QUEUE_WAIT)
+        return pending
+
+
+    def flush(self, timeout=None):
+        """Wait until the queue is empty and the workers are idle, return
+        False if the timeout expired first"""
+        self._check_fork()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            if self._entries:
+                self._start()
+            while self._entries or self._busy:
+                if deadline is None:
+                    self._cond.wait(GRAPH_QUEUE_WAIT)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(min(remaining, GRAPH_QUEUE_WAIT))
+        return True
+
+
+    def shutdown(self, timeout=30):
+        """Write the pending entries and stop the workers, the entries which
+        are still pending after the timeout are saved in the backlog"""
+        from indigo.models import GraphBacklog
+        if os.getpid() != self._pid or not self._threads:
+            return
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            entries = self._entries.values()
+            self._entries = OrderedDict()
+            self._cond.notify_all()
+        for entry in entries:
+            try:
+                GraphBacklog.store(entry, u"Pending at shutdown")
+            except Exception:
+                logger.error(u"Graph mutation of {} {} lost".format(
+                    entry['label'], entry['uuid']))
+
+
+    def stats(self):
+        """Return the metrics of the queue: the number of vertices waiting
+        ('depth'), the age in seconds of the oldest one ('lag') and the
+        counters of mutations"""
+        self._check_fork()
+        now = time.time()
+        with self._cond:
+            if self._entries:
+                oldest = next(iter(self._entries.itervalues()))
+                lag = now - oldest['ts']
+            else:
+                lag = 0.0
+            return {
+                "enabled": self.enabled(),
+                "depth": len(self._entries),
+                "in_flight": len(self._busy),
+                "lag": lag,
+                "enqueued": self.enqueued,
+                "coalesced": self.coalesced,
+                "flushed": self.flushed,
+                "retried": self.retried,
+                "backlogged": self.backlogged,
+                "workers": len([thread for thread in self._threads
+                                if thread.is_alive()]),
+                "last_flush_ts": self.last_flush_ts,
+            }
+
+
+def replay_backlog():
+    """Write the mutations saved in the backlog table, return the number of
+    vertices written and the number of failures"""
+    from indigo.models import GraphBacklog
+    done = 0
+    failed = 0
+    for row in GraphBacklog.objects.all():
+        entry = row.to_entry()
+        try:
+            graph_apply([entry])
+        except Exception:
+            error = traceback.format_exc()
+            logger.error(u"Graph mutation of {} {} failed again: {}".format(
+                row.label, row.uuid, error))
+            # Keep only the steps which haven't been written
+            row.update(drop=entry['drop'],
+                       add=json.dumps(entry['add']) if entry['add'] else None,
+                       error=error)
+            failed += 1
+        else:
+            row.delete()
+            done += 1
+    return done, failed
+
+
+def _init_queue():
+    """Create the shared queue with the sizes given in the settings"""
+    cfg = get_config(None)
+    return GraphWriteQueue(
+        size=cfg.get('GRAPH_QUEUE_SIZE', GRAPH_QUEUE_SIZE),
+        workers=cfg.get('GRAPH_QUEUE_WORKERS', GRAPH_QUEUE_WORKERS),
+        batch_size=cfg.get('GRAPH_QUEUE_BATCH_SIZE', GRAPH_QUEUE_BATCH_SIZE))
+
+
+graph_queue = _init_queue()
+atexit.register(graph_queue.shutdown)
+
+
+def graph_queue_stats():
+    """Return the metrics of the shared write-behind queue"""
+    return graph_queue.stats()
+
+
+def settle_graph_queue(label, uuids):
+    """Wait until the mutations of a list of vertices queued by this process
+    are written, if the write-behind mode is enabled. Return True if some of
+    them had pending mutations"""
+    if graph_queue.enabled():
+        return graph_queue.settle(label, uuids)
+    return False
+
+
+def flush_graph_queue(timeout=None):
+    """Wait until the shared write-behind queue is empty"""
+    return graph_queue.flush(timeout)
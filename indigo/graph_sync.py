@@ -0,0 +1,298 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from multiprocessing.pool import ThreadPool
+import time
+
+from indigo.models import (
+    Collection,
+    Resource,
+    TreeEntry,
+    User,
+)
+from indigo.graph_queue import settle_graph_queue
+from indigo.util import merge
+from indigo.util_graph import (
+    gq_add_son_edges,
+    gq_add_users,
+    gq_add_vertices,
+    gq_drop_subtrees,
+    gq_existing_uuids,
+    gq_get_children,
+    vertex_collection,
+    vertex_resource,
+)
+from indigo.tree_walker import TreeWalker
+
+# Number of threads which compare the collections of a level with the graph
+SYNC_WORKERS = 8
+
+# Number of collections handled by a single task, and number of vertices
+# looked up or created with a single request
+SYNC_BATCH_SIZE = 100
+
+
+def chunks(iterable, size):
+    """Generator which yields lists of at most 'size' items of an iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def sync_user_vertices(users):
+    """Create the missing vertices of a list of users with one lookup and
+    one creation request, return the number of vertices created"""
+    existing = gq_existing_uuids('user', [user.uuid for user in users])
+    missing = [user for user in users if user.uuid not in existing]
+    gq_add_users(missing)
+    return len(missing)
+
+
+def sync_users(batch_size=SYNC_BATCH_SIZE):
+    """Create the missing vertices of all the users, return the number of
+    vertices created"""
+    return sum(sync_user_vertices(users)
+               for users in chunks(User.objects.all(), batch_size))
+
+
+class GraphSync(TreeWalker):
+    """Rebuild the graph of a subtree from the tree entries.
+
+    The users are synchronised first, then the tree is walked breadth-first
+    from the top collection so the vertex of a collection always exists
+    before its children are compared. The collections of a level are
+    processed by batches on a pool of threads: the children of their
+    vertices are read with one traversal, the tree entries are compared with
+    them and the differences are fixed with bulk requests. The vertices
+    which are missing are created with their 'son' edge, the existing
+    vertices which aren't linked to their collection get their edge and the
+    children of a vertex which aren't in the tree anymore are dropped with
+    everything below them. A checkpoint is saved after each batch, the
+    changes are idempotent so an interrupted sync restarts from the last
+    batch.
+
+    The tree doesn't record the owner of a collection or a resource, the
+    'owns' edges of the existing vertices are kept but they can't be created
+    for the missing ones. The orphans are found through the 'son' edges of
+    the collections, a vertex which isn't linked to any collection isn't
+    found (listing all the vertices of a label would scan the graph).
+
+    The vertices are written directly, in write-behind mode the mutations
+    of a vertex queued by this process are written before it's changed."""
+
+    operation = u"Graph sync"
+
+    def __init__(self, path="/", workers=SYNC_WORKERS,
+                 batch_size=SYNC_BATCH_SIZE, progress=None, checkpoint=None,
+                 users=True):
+        super(GraphSync, self).__init__(path, workers, batch_size, progress)
+        self.checkpoint = checkpoint
+        self.sync_users = users
+        self.users = 0
+        self.created = 0
+        self.linked = 0
+        self.dropped = 0
+
+
+    def _sync(self, paths):
+        """Compare a batch of collections of a level with the graph, return
+        the list of the sub-collections and a tuple with the number of
+        resources and the number of vertices created, linked and dropped"""
+        collections = [coll for coll in Collection.find_many(paths) if coll]
+        graph_children = gq_get_children([coll.uuid for coll in collections])
+        res = [[], 0, 0, 0, 0]
+        for coll in collections:
+            children = graph_children.get(coll.uuid, {})
+            seen = set()
+            for names in chunks((name for name in TreeEntry.iter_names(coll.path)
+                                 if name != '.'),
+                                self.batch_size):
+                sub_collections, counts = self._sync_names(coll, names,
+                                                           children, seen)
+                res[0].extend(sub_collections)
+                for idx, count in enumerate(counts):
+                    res[idx + 1] += count
+            orphans = {}
+            for uuid, label in children.iteritems():
+                if uuid not in seen:
+                    orphans.setdefault(label, []).append(uuid)
+            for label, uuids in orphans.iteritems():
+                settle_graph_queue(label, uuids)
+                gq_drop_subtrees(label, uuids)
+                res[4] += len(uuids)
+        return res[0], tuple(res[1:])
+
+
+    def _sync_names(self, coll, names, children, seen):
+        """Compare a list of children of a collection with the children of
+        its vertex, return the sub-collections and a tuple with the number of
+        resources, and of vertices created and linked"""
+        entries = TreeEntry.find_many([(coll.path, name) for name in names])
+        missing = {'collection': {}, 'resource': {}}
+        sub_collections = []
+        resources = 0
+        for name in names:
+            entry = entries.get((coll.path, name))
+            if entry is None or not entry.uuid:
+                continue
+            if name.endswith('/'):
+                label = 'collection'
+                path = merge(coll.path, name[:-1])
+                sub_collections.append(path)
+            else:
+                label = 'resource'
+                path = merge(coll.path, name)
+                resources += 1
+            seen.add(entry.uuid)
+            if children.get(entry.uuid) != label:
+                missing[label][entry.uuid] = path
+        edges = []
+        vertices = []
+        for label, paths in missing.iteritems():
+            if not paths:
+                continue
+            if settle_graph_queue(label, paths.keys()):
+                # The queued vertices may have been created with their edge
+                current = gq_get_children([coll.uuid]).get(coll.uuid, {})
+                paths = dict([(uuid, path) for uuid, path in paths.iteritems()
+                              if current.get(uuid) != label])
+                if not paths:
+                    continue
+            existing = gq_existing_uuids(label, paths.keys())
+            edges.extend([{'label': label,
+                           'uuid': uuid,
+                           'parent_uuid': coll.uuid}
+                          for uuid in existing])
+            new_paths = [path for uuid, path in paths.iteritems()
+                         if uuid not in existing]
+            if label == 'collection':
+                for child in Collection.find_many(new_paths):
+                    if child:
+                        vertices.append(vertex_collection(
+                            child, coll, metadata=child.get_cdmi_metadata()))
+            else:
+                for resc in Resource.find_many(new_paths, load_objects=True):
+                    if resc:
+                        vertices.append(vertex_resource(
+                            resc, coll, metadata=resc.get_cdmi_metadata()))
+        gq_add_vertices(vertices)
+        gq_add_son_edges(edges)
+        return sub_collections, (resources, len(vertices), len(edges))
+
+
+    def _sync_root(self, root):
+        """Create the vertex of the top collection if it's missing, it's
+        linked to its parent if the parent has a vertex"""
+        settle_graph_queue('collection', [root.uuid])
+        if gq_existing_uuids('collection', [root.uuid]):
+            return
+        parent = None
+        if not root.is_root:
+            parent = Collection.find(root.container)
+            if parent and not gq_existing_uuids('collection', [parent.uuid]):
+                parent = None
+        gq_add_vertices([vertex_collection(root, parent,
+                                           metadata=root.get_cdmi_metadata())])
+        self.created += 1
+
+
+    def _sync_user_batch(self, users):
+        """Create the missing vertices of a batch of users, return the number
+        of users and the number of vertices created"""
+        return len(users), sync_user_vertices(users)
+
+
+    def _sync_users(self, pool):
+        """Create the missing vertices of the users"""
+        for count, created in self._run_tasks(pool, self._sync_user_batch,
+                                              chunks(User.objects.all(),
+                                                     self.batch_size)):
+            self.users += count
+            self.created += created
+            self._report()
+
+
+    def run(self, state=None):
+        """Synchronise the graph, return the statistics. 'state' is the last
+        checkpoint of an interrupted sync"""
+        root = Collection.find(self.path)
+        if not root:
+            return None
+        self.start_time = time.time()
+        pool = ThreadPool(self.workers)
+        try:
+            if state:
+                for key in ("collections", "resources", "users", "created",
+                            "linked", "dropped"):
+                    setattr(self, key, state[key])
+            else:
+                if self.sync_users:
+                    self._sync_users(pool)
+                self._sync_root(root)
+                self.collections = 1
+            for resources, created, linked, dropped in self._walk(pool,
+                                                                  self._sync,
+                                                                  root.path,
+                                                                  state):
+                self.resources += resources
+                self.created += created
+                self.linked += linked
+                self.dropped += dropped
+                self._report()
+        finally:
+            pool.close()
+            pool.join()
+        self._report(True)
+        return self.stats()
+
+
+    def stats(self):
+        """Return a dictionary with the progress of the sync"""
+        stats = super(GraphSync, self).stats()
+        stats.update({
+            "users": self.users,
+            "created": self.created,
+            "linked": self.linked,
+            "dropped": self.dropped,
+        })
+        return stats
+
+
+def sync_graph(path="/", workers=SYNC_WORKERS, batch_size=SYNC_BATCH_SIZE,
+               progress=None):
+    """Rebuild the graph of a subtree, return the statistics"""
+    engine = GraphSync(path, workers, batch_size, progress)
+    return engine.run()
+
+
+def sync_job(job):
+    """Execute a 'graph_sync' job, a job resumed after a restart starts
+    again after its last batch"""
+    spec = job.get_spec()
+    progress = lambda stats: job.save_checkpoint(progress=stats)
+    checkpoint = lambda state: job.save_checkpoint(checkpoint=state)
+    engine = GraphSync(spec.get('path', '/'),
+                       progress=progress,
+                       checkpoint=checkpoint,
+                       users=spec.get('users', True))
+    return engine.run(job.get_checkpoint())
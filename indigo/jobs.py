@@ -0,0 +1,185 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+import importlib
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import threading
+import traceback
+
+from indigo import get_config
+from indigo.log import init_log
+from indigo.models.job import (
+    Job,
+    STATE_PENDING,
+    STATE_RUNNING,
+)
+
+logger = init_log('jobs')
+
+# Number of jobs executed at the same time by a process
+JOB_WORKERS = 2
+
+# Number of seconds without heartbeat after which a running job is considered
+# abandoned and can be resumed by another process
+JOB_STALE_TIMEOUT = 300
+
+# The function which executes each type of job, it is called with the Job and
+# returns the final statistics. Handlers should save checkpoints with
+# job.save_checkpoint() and restart from job.get_checkpoint().
+JOB_HANDLERS = {
+    "delete": "indigo.tree_delete:delete_job",
+    "graph_sync": "indigo.graph_sync:sync_job",
+    "propagate_acl": "indigo.tree_acl:propagate_job",
+    "reindex": "indigo.tree_index:reindex_job",
+}
+
+
+def get_handler(job_type):
+    """Return the function which executes a type of job"""
+    cfg = get_config(None)
+    handlers = dict(JOB_HANDLERS)
+    handlers.update(cfg.get('JOB_HANDLERS', {}))
+    if job_type not in handlers:
+        raise ValueError(u"Unknown job type '{}'".format(job_type))
+    module_name, func_name = handlers[job_type].split(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+class JobRunner(object):
+    """Execute the jobs on a local pool of threads.
+
+    The pool is started with the first job, a forked process gets its own
+    pool. A job is claimed with a lightweight transaction before it runs, so
+    several processes can resume the pending jobs at the same time. The
+    first job submitted by a process also resumes the jobs left behind by
+    the processes which died."""
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pool = None
+        self._resumed_pid = None
+
+
+    def _get_pool(self):
+        """Return the pool of the current process"""
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(self.workers)
+                self._pid = os.getpid()
+            return self._pool
+
+
+    def execute(self, job_type, spec=None, username=None):
+        """Create a job and execute it in the calling thread, return the
+        finished job"""
+        get_handler(job_type)
+        job = Job.create(job_type, spec, username)
+        self.run_job(job.uuid)
+        return Job.find(job.uuid)
+
+
+    def owner(self):
+        """Return the identifier of this process"""
+        return u"{}:{}".format(socket.gethostname(), os.getpid())
+
+
+    def stale_limit(self):
+        """Return the time before which the heartbeat of a running job means
+        its process died"""
+        return datetime.now() - timedelta(seconds=JOB_STALE_TIMEOUT)
+
+
+    def resume(self, wait=False):
+        """Queue the pending jobs and the running jobs which lost their
+        process. Return the list of job ids queued, if 'wait' is True the
+        call returns when they are finished"""
+        limit = self.stale_limit()
+        results = []
+        for job in Job.objects.all():
+            if job.state == STATE_PENDING or (job.state == STATE_RUNNING and
+                                              (job.heartbeat is None or
+                                               job.heartbeat < limit)):
+                results.append((job.uuid, self._get_pool().apply_async(
+                    self.run_job, (job.uuid,))))
+        if wait:
+            for _, result in results:
+                result.get()
+        return [uuid for uuid, _ in results]
+
+
+    def run_job(self, uuid):
+        """Claim and execute a job, return True if it has been executed by
+        this process. The job is read again, a running job is only taken
+        over if it's still stale"""
+        job = Job.find(uuid)
+        if job is None or job.state not in (STATE_PENDING, STATE_RUNNING):
+            return False
+        if not job.claim(self.owner(), self.stale_limit()):
+            logger.info(u"Job {} is run by another process".format(uuid))
+            return False
+        logger.info(u"Starting job {} ({})".format(uuid, job.job_type))
+        try:
+            progress = get_handler(job.job_type)(job)
+        except Exception:
+            logger.error(u"Job {} failed".format(uuid))
+            error = traceback.format_exc()
+            logger.error(error)
+            job.finish(error=error)
+        else:
+            logger.info(u"Job {} done".format(uuid))
+            job.finish(progress=progress)
+        return True
+
+
+    def submit(self, job_type, spec=None, username=None):
+        """Create a job and queue it, return the job id"""
+        # Fail straight away for an unknown type
+        get_handler(job_type)
+        job = Job.create(job_type, spec, username)
+        self._get_pool().apply_async(self.run_job, (job.uuid,))
+        if self._resumed_pid != os.getpid():
+            self._resumed_pid = os.getpid()
+            self._get_pool().apply_async(self.resume)
+        return job.uuid
+
+
+runner = JobRunner()
+
+
+def execute_job(job_type, spec=None, username=None):
+    """Create a job and execute it in the calling thread, return the finished
+    job"""
+    return runner.execute(job_type, spec, username)
+
+
+def resume_jobs(wait=False):
+    """Queue the jobs which need to be executed with the shared runner"""
+    return runner.resume(wait)
+
+
+def submit_job(job_type, spec=None, username=None):
+    """Queue a new job with the shared runner, return its id"""
+    return runner.submit(job_type, spec, username)
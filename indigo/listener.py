@@ -203,14 +203,17 @@ def scan_script_collection(directory):
                         'to find the collection "{0}" in the database.'.format(directory))
         return
 
-    child_container, child_dataobject = collection.get_child()
+    child_dataobject = [name for name, _ in collection.iter_child(containers=False)]
     resource_count = len(child_dataobject)
     logging.info('{0} scripts found in collection "{1}"'.format(resource_count, directory))
 
     # TODO: Refactor this and combine it with the on_message() function.
 
-    for resource_name in child_dataobject:
-        resource = Resource.find("{}/{}".format(directory, resource_name))
+    resources = Resource.find_many(["{}/{}".format(directory, resource_name)
+                                     for resource_name in child_dataobject])
+    for resource in resources:
+        if resource is None:
+            continue
         script_contents = StringIO.StringIO()
 
         for chunk in resource.chunk_content():
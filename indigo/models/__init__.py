@@ -34,19 +34,25 @@ from dse.cluster import (
 from dse.graph import GraphOptions
 import time
 
-from indigo.util_graph import get_graph_session
+from indigo.util_graph import (
+    create_graph_schema,
+    get_graph_session,
+)
 from indigo.models.group import Group
 from indigo.models.user import User
-from indigo.models.tree_entry import TreeEntry
+from indigo.models.tree_entry import TreeEntry, TreeEntryBucket
 from indigo.models.collection import Collection
 from indigo.models.data_object import DataObject
 from indigo.models.listener_log import ListenerLog
 from indigo.models.resource import Resource
 from indigo.models.search import SearchIndex
 from indigo.models.id_search import IDSearch
+from indigo.models.metadata_index import MetadataIndex, MetadataKeyIndex
 from indigo.models.acl import Ace
 from indigo.models.notification import Notification
 from indigo.models.graph import Graph
+from indigo.models.graph_backlog import GraphBacklog, GraphQueueStats
+from indigo.models.job import Job
 
 from indigo.log import init_log
 
@@ -80,8 +86,9 @@ def initialise(keyspace="indigo", hosts=('127.0.0.1',), strategy='SimpleStrategy
 
 def sync():
     """Create tables and graphs for the different models"""
-    tables = (User, Group, SearchIndex, IDSearch, TreeEntry, DataObject,
-              Notification, ListenerLog)
+    tables = (User, Group, SearchIndex, IDSearch, MetadataIndex,
+              MetadataKeyIndex, TreeEntry, TreeEntryBucket, DataObject,
+              Notification, ListenerLog, Job, GraphBacklog, GraphQueueStats)
 
     for table in tables:
         logger.info('Syncing table "{0}"'.format(table.__name__))
@@ -93,8 +100,7 @@ def sync():
     session.execute_graph("system.graph(name).ifNotExists().create()", {'name': graph_name},
                           execution_profile=EXEC_PROFILE_GRAPH_SYSTEM_DEFAULT)
 
-    session.execute_graph("schema.config().option('graph.schema_mode').set('Development')")
-    session.execute_graph("schema.config().option('graph.allow_scan').set('true')")
+    create_graph_schema(graph_name)
 
 
 def destroy(keyspace):
@@ -23,13 +23,19 @@ limitations under the License.
 # cdmi_str: A comma separated list of flags or masks, used in cdmi
 #             ("READ_ACL, READ_ATTRIBUTES", ..)
 
-from collections import OrderedDict
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+import threading
+import time
 from dse.cqlengine.usertype import UserType
 from dse.cqlengine import columns
 
 from indigo.models import (
     Group
 )
+from indigo.util import split
 
 
 # ACE Flags for ACL in CDMI
@@ -41,6 +47,10 @@ ACEFLAG_INHERIT_ONLY = 0x00000008
 ACEFLAG_IDENTIFIER_GROUP = 0x00000040
 ACEFLAG_INHERITED = 0x00000080
 
+# The ACL written before the flags were used have no flags, their entries are
+# inherited by the objects and the sub-containers
+ACEFLAG_DEFAULT = ACEFLAG_OBJECT_INHERIT | ACEFLAG_CONTAINER_INHERIT
+
 # ACE Mask bits for ACL in CDMI
 ACEMASK_READ_OBJECT = 0x00000001
 ACEMASK_LIST_CONTAINER = 0x00000001
@@ -164,6 +174,44 @@ ACEMASK_INT_STR_COL = {
     0x5F: "read/write",
 }
 
+# Actions a user can be authorized to do on a collection or a resource
+ACTIONS = ("read", "write", "edit", "delete")
+
+# Bit of each action in the masks computed by CompiledAcl
+ACTION_BITS = {
+    "read": 0x1,
+    "write": 0x2,
+    "edit": 0x4,
+    "delete": 0x8,
+}
+
+# Actions granted by the simplified access levels (see acemask_to_str), an
+# ACE whose acemask isn't exactly one of these levels grants nothing
+LEVEL_ACTIONS = {
+    "read": ACTION_BITS["read"],
+    "write": ACTION_BITS["write"] | ACTION_BITS["edit"] | ACTION_BITS["delete"],
+    "read/write": (ACTION_BITS["read"] | ACTION_BITS["write"] |
+                   ACTION_BITS["edit"] | ACTION_BITS["delete"]),
+}
+
+# Identifier added to the groups of any logged in user
+AUTHENTICATED = "AUTHENTICATED@"
+
+# Number of seconds an effective ACL is kept in the cache
+ACL_CACHE_TTL = 30
+
+# Maximum number of collections in the cache
+ACL_CACHE_SIZE = 10000
+
+# Number of seconds a group name is kept in the cache of the ACL builder
+GROUP_CACHE_TTL = 60
+
+# Maximum number of group names (and ACL) in the cache of the ACL builder
+GROUP_CACHE_SIZE = 10000
+
+# Identifiers which can be used in an ACL without being a group
+SPECIAL_IDENTIFIERS = ("AUTHENTICATED@", "ANONYMOUS@")
+
 ACEFLAG_STR_INT = {
     "INHERITED": 0x00000080,
     "IDENTIFIER_GROUP": 0x00000040,
@@ -175,6 +223,375 @@ ACEFLAG_STR_INT = {
 }
 
 
+def _build_names(table, column, bits, shift):
+    """Return the list of names for every combination of 'bits' bits of an
+    ace table, starting at bit 'shift'"""
+    names = []
+    for value in xrange(1 << bits):
+        value = value << shift
+        names.append([row[column] for row in table
+                      if row[0] and row[0] & value == row[0]])
+    return names
+
+
+# Precomputed names of the masks, the low bits (0x7FF) and the high bits
+# (0x1F0000) are looked up separately. Index 1 for objects, 2 for containers
+_ACEMASK_LOW = dict([(col, _build_names(ACEMASK_TABLE, col, 11, 0))
+                     for col in (1, 2)])
+_ACEMASK_HIGH = dict([(col, _build_names(ACEMASK_TABLE, col, 5, 16))
+                      for col in (1, 2)])
+
+# Precomputed cdmi strings for all the flag combinations, the unknown bits
+# are rendered as NO_FLAGS
+ACEFLAG_CDMI_STR = {}
+for _value in xrange(256):
+    _names = [row[1] for row in ACEFLAG_TABLE
+              if row[0] and _value & row[0] == row[0]]
+    if _value & 0x30:
+        _names.append("NO_FLAGS")
+    ACEFLAG_CDMI_STR[_value] = ', '.join(_names)
+del _value, _names
+
+
+class CompiledAcl(object):
+    """An ACL compiled for the permission checks.
+
+    The actions granted by each principal are stored as a bitmask (see
+    ACTION_BITS) so a check only uses bitwise operations. The decision is
+    the same as the simplified access levels: an ACE grants the actions of
+    the level its acemask matches exactly, the actions of all the principals
+    of a user are added up, the type of the ACE is ignored. The entries
+    inherited as INHERIT_ONLY (see inherited_acl) only reach the objects
+    below, they don't apply to their holder. The ACL stored on an object
+    ('is_object') is only matched against the groups of the user,
+    AUTHENTICATED@ is only used when it's inherited from a collection."""
+
+    __slots__ = ("allow",)
+
+    def __init__(self, acl=None, is_object=False):
+        self.allow = {}
+        for ident, ace in (acl or {}).items():
+            flags = ace.aceflags or 0
+            if flags & ACEFLAG_INHERITED:
+                if flags & ACEFLAG_INHERIT_ONLY:
+                    continue
+            elif is_object and ident == AUTHENTICATED:
+                continue
+            level = acemask_to_str(ace.acemask, is_object)
+            actions = LEVEL_ACTIONS.get(level, 0)
+            if actions:
+                self.allow[ident] = self.allow.get(ident, 0) | actions
+
+
+    def __nonzero__(self):
+        return bool(self.allow)
+
+
+    def can(self, user_groups, action):
+        """Return True if one of the groups is allowed to do 'action'"""
+        return bool(self.mask(user_groups) & ACTION_BITS[action])
+
+
+    def mask(self, user_groups):
+        """Return the action bits granted to a list of groups"""
+        allowed = 0
+        for gid in user_groups:
+            allowed |= self.allow.get(gid, 0)
+        return allowed
+
+
+EMPTY_ACL = CompiledAcl()
+
+
+# Value of an Access Control Entry bound to the prepared statements, the
+# fields are in the order of the Ace type
+AceValue = namedtuple("AceValue", ["acetype",
+                                   "identifier",
+                                   "aceflags",
+                                   "acemask"])
+
+
+class AclBuilder(object):
+    """Build the ACL maps bound to the prepared ACL writers.
+
+    The identifiers are resolved through a cache of the group names, the
+    unknown ones are read with a single Group.find_all request. The ACL
+    built from lists of groups are shared, so the same object is reused for
+    all the entries created with the same groups (ingest)."""
+
+    def __init__(self, ttl=GROUP_CACHE_TTL, size=GROUP_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        # name -> (identifier or None, expiry time)
+        self._groups = {}
+        # (read, write) -> (acl map, expiry time)
+        self._acls = {}
+
+
+    def clear(self):
+        """Empty the caches"""
+        with self._lock:
+            self._groups.clear()
+            self._acls.clear()
+
+
+    def from_cdmi(self, cdmi_acl):
+        """Return the ACL map from a cdmi object (list of dict)"""
+        cdmi_acl = [cdmi_ace for cdmi_ace in cdmi_acl
+                    if 'identifier' in cdmi_ace]
+        idents = self.resolve([cdmi_ace['identifier']
+                               for cdmi_ace in cdmi_acl])
+        acl = {}
+        for cdmi_ace in cdmi_acl:
+            ident = idents.get(cdmi_ace['identifier'])
+            if not ident:
+                # TODO log or return error if the identifier isn't found ?
+                continue
+            acl[ident] = AceValue(
+                cdmi_ace['acetype'].upper(),
+                ident,
+                cdmi_str_to_aceflag(cdmi_ace['aceflags']),
+                cdmi_str_to_acemask(cdmi_ace['acemask'], False))
+        return acl
+
+
+    def from_list(self, read_access, write_access):
+        """Return the ACL map from lists of group names"""
+        key = (tuple(sorted(read_access)), tuple(sorted(write_access)))
+        now = time.time()
+        with self._lock:
+            cached = self._acls.get(key)
+            if cached and cached[1] > now:
+                return cached[0]
+        access = {}
+        for gname in read_access:
+            access[gname] = "read"
+        for gname in write_access:
+            if gname in access:
+                access[gname] = "read/write"
+            else:
+                access[gname] = "write"
+        idents = self.resolve(access.keys())
+        acl = {}
+        for gname, level in access.iteritems():
+            ident = idents.get(gname)
+            if not ident:
+                # TODO log or return error if the identifier isn't found ?
+                continue
+            acl[ident] = AceValue("ALLOW", ident, 0,
+                                  str_to_acemask(level, False))
+        with self._lock:
+            if len(self._acls) >= self.size:
+                self._acls.clear()
+            self._acls[key] = (acl, now + self.ttl)
+        return acl
+
+
+    def invalidate_group(self, name):
+        """Forget a group which has been created or deleted"""
+        with self._lock:
+            self._groups.pop(name, None)
+            self._acls.clear()
+
+
+    def resolve(self, identifiers):
+        """Return a dictionary with the ACL identifier of each group name
+        (None for an unknown group)"""
+        now = time.time()
+        res = {}
+        missing = []
+        with self._lock:
+            for gid in identifiers:
+                cached = self._groups.get(gid)
+                if cached and cached[1] > now:
+                    res[gid] = cached[0]
+                else:
+                    missing.append(gid)
+        if not missing:
+            return res
+        found = dict([(group.name, group.name)
+                      for group in Group.find_all(list(set(missing)))])
+        with self._lock:
+            if len(self._groups) >= self.size:
+                self._groups.clear()
+            for gid in missing:
+                ident = found.get(gid)
+                if ident is None and gid.upper() in SPECIAL_IDENTIFIERS:
+                    ident = gid.upper()
+                res[gid] = ident
+                self._groups[gid] = (ident, now + self.ttl)
+        return res
+
+
+acl_builder = AclBuilder()
+
+
+class EffectiveAclCache(object):
+    """Per-process cache of the effective ACL of the collections.
+
+    A collection without ACL inherits the entries of its parent's effective
+    ACL, according to their ACEFLAG_* flags (see inherited_acl). The
+    resolved ACL is kept for each path, with the compiled ACL of the
+    collection and the one inherited by its objects, so a permission check
+    doesn't walk up the tree. The missing ancestors are read with a single
+    bulk request. The entries expire after 'ttl' seconds (other processes
+    may change an ACL) and the oldest ones are dropped above 'size'
+    entries. The ACL writers of TreeEntry invalidate the subtree.
+    """
+
+    def __init__(self, ttl=ACL_CACHE_TTL, size=ACL_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        # path -> ((acl, compiled acl, compiled object acl), expiry time), in
+        # insertion order
+        self._acls = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def clear(self):
+        """Empty the cache"""
+        with self._lock:
+            self._acls.clear()
+
+
+    def get(self, path):
+        """Return the effective ACL of the collection at 'path' as a
+        CompiledAcl (empty if no ancestor defines an ACL)"""
+        return self._resolve(path)[1]
+
+
+    def get_acl(self, path):
+        """Return the effective ACL map of the collection at 'path'"""
+        return self._resolve(path)[0]
+
+
+    def get_for_objects(self, path):
+        """Return the CompiledAcl inherited by the objects of the collection
+        at 'path' which don't have an ACL"""
+        return self._resolve(path)[2]
+
+
+    def _resolve(self, path):
+        """Return the cached triple for a path, resolve it and the missing
+        ancestors if needed"""
+        from indigo.models import Collection
+        now = time.time()
+        # Walk up until we find a path in the cache
+        missing = []
+        inherited = None
+        current = path
+        with self._lock:
+            while True:
+                cached = self._acls.get(current)
+                if cached and cached[1] > now:
+                    inherited = cached[0]
+                    break
+                missing.append(current)
+                if current == '/':
+                    break
+                current, _ = split(current)
+            if not missing:
+                self.hits += 1
+                return inherited
+            self.misses += 1
+        # Resolve the missing paths from the top
+        resolved = []
+        collections = Collection.find_many(missing)
+        for coll_path, coll in reversed(zip(missing, collections)):
+            if coll and coll.entry.container_acl:
+                acl = coll.entry.container_acl
+            elif inherited:
+                acl = inherited_acl(inherited[0], False)
+            else:
+                acl = {}
+            inherited = (acl,
+                         CompiledAcl(acl),
+                         CompiledAcl(inherited_acl(acl, True)))
+            resolved.append((coll_path, inherited))
+        with self._lock:
+            for coll_path, value in resolved:
+                self._acls.pop(coll_path, None)
+                self._acls[coll_path] = (value, now + self.ttl)
+            while len(self._acls) > self.size:
+                self._acls.popitem(last=False)
+        return inherited
+
+
+    def invalidate(self, path):
+        """Remove a collection and its sub-collections from the cache"""
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            for key in self._acls.keys():
+                if key == path or key.startswith(prefix):
+                    del self._acls[key]
+
+
+    def stats(self):
+        """Return a dictionary with the usage of the cache"""
+        return {
+            "size": len(self._acls),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+acl_cache = EffectiveAclCache()
+
+
+def inherited_acl(acl, is_object):
+    """Return the ACL map a child inherits from the ACL of its container.
+
+    An object gets the OBJECT_INHERIT entries. A sub-container gets the
+    CONTAINER_INHERIT entries, and the OBJECT_INHERIT ones as INHERIT_ONLY
+    so they reach its objects. NO_PROPAGATE stops the inheritance after
+    this level. Entries without flags use ACEFLAG_DEFAULT."""
+    res = {}
+    for ident, ace in acl.iteritems():
+        flags = ace.aceflags or ACEFLAG_DEFAULT
+        if is_object:
+            if not flags & ACEFLAG_OBJECT_INHERIT:
+                continue
+            new_flags = ACEFLAG_INHERITED
+        elif flags & ACEFLAG_CONTAINER_INHERIT:
+            if flags & ACEFLAG_NO_PROPAGATE:
+                new_flags = ACEFLAG_INHERITED
+            else:
+                new_flags = (flags & ~ACEFLAG_INHERIT_ONLY) | ACEFLAG_INHERITED
+        elif (flags & ACEFLAG_OBJECT_INHERIT and
+              not flags & ACEFLAG_NO_PROPAGATE):
+            new_flags = flags | ACEFLAG_INHERIT_ONLY | ACEFLAG_INHERITED
+        else:
+            continue
+        res[ident] = AceValue(ace.acetype, ace.identifier, new_flags,
+                              ace.acemask)
+    return res
+
+
+def mask_to_actions(mask):
+    """Return the set of actions of a mask of action bits"""
+    return set([action for action in ACTIONS
+                if mask & ACTION_BITS[action]])
+
+
+def mask_to_dict(mask):
+    """Return the can_<action> flags used by the web ui from a mask of
+    action bits"""
+    return {
+        "can_read": bool(mask & ACTION_BITS["read"]),
+        "can_write": bool(mask & ACTION_BITS["write"]),
+        "can_edit": bool(mask & ACTION_BITS["edit"]),
+        "can_delete": bool(mask & ACTION_BITS["delete"]),
+    }
+
+
+def user_principals(user):
+    """Return the identifiers an ACL can use to grant access to a user"""
+    return user.groups + [AUTHENTICATED]
+
+
 def aceflag_to_cdmi_str(num_value):
     """Return the string value for ACE flag value given
 
@@ -185,15 +602,10 @@ def aceflag_to_cdmi_str(num_value):
     :type num_value: integer
     :rtype: string
     """
-    res = []
-    for idx in xrange(len(ACEFLAG_TABLE)):
-        if num_value == 0:
-            return ', '.join(res)
-
-        if num_value & ACEFLAG_TABLE[idx][0] == ACEFLAG_TABLE[idx][0]:
-            res.append(ACEFLAG_TABLE[idx][1])
-            num_value = num_value ^ ACEFLAG_TABLE[idx][0]
-    return ', '.join(res)
+    if num_value >> 8:
+        # Unknown bits
+        return ACEFLAG_CDMI_STR[(num_value & 0xFF) | 0x10]
+    return ACEFLAG_CDMI_STR[num_value]
 
 
 def acemask_to_cdmi_str(num_value, is_object):
@@ -208,18 +620,9 @@ def acemask_to_cdmi_str(num_value, is_object):
     :type is_object: boolean
     :rtype: string
     """
-    res = []
-    for idx in xrange(len(ACEMASK_TABLE)):
-        if num_value == 0:
-            return ', '.join(res)
-
-        if num_value & ACEMASK_TABLE[idx][0] == ACEMASK_TABLE[idx][0]:
-            if is_object:
-                res.append(ACEMASK_TABLE[idx][1])
-            else:
-                res.append(ACEMASK_TABLE[idx][2])
-            num_value = num_value ^ ACEMASK_TABLE[idx][0]
-    return ', '.join(res)
+    col = 1 if is_object else 2
+    return ', '.join(_ACEMASK_HIGH[col][(num_value >> 16) & 0x1F] +
+                     _ACEMASK_LOW[col][num_value & 0x7FF])
 
 def acemask_to_str(acemask, is_object):
     """Return the simplified access level from an acemask"""
@@ -230,69 +633,43 @@ def acemask_to_str(acemask, is_object):
 
 
 def acl_cdmi_to_cql(cdmi_acl):
-    ls_access = []
-    for cdmi_ace in cdmi_acl:
-        if 'identifier' in cdmi_ace:
-            gid = cdmi_ace['identifier']
-        else:
-            # Wrong syntax for the ace
-            continue
-        group = Group.find(gid)
-        if group:
-            ident = group.name
-        elif gid.upper() == "AUTHENTICATED@":
-            ident = "AUTHENTICATED@"
-        elif gid.upper() == "ANONYMOUS@":
-            ident = "ANONYMOUS@"
-        else:
-            # TODO log or return error if the identifier isn't found ?
-            continue
-        s = (u"'{}': {{"
-              "acetype: '{}', "
-              "identifier: '{}', "
-              "aceflags: {}, "
-              "acemask: {}"
-              "}}").format(ident,
-                          cdmi_ace['acetype'].upper(),
-                          ident,
-                          cdmi_str_to_aceflag(cdmi_ace['aceflags']),
-                          cdmi_str_to_acemask(cdmi_ace['acemask'], False)
-                         )
-        ls_access.append(s)
-    acl = u"{{{}}}".format(", ".join(ls_access))
-    return acl
+    """Return the CQL literal of an ACL from a cdmi object (list of dict)"""
+    return acl_map_to_cql(acl_cdmi_to_map(cdmi_acl))
+
+
+def acl_cdmi_to_map(cdmi_acl):
+    """Return the ACL map bound to the ACL writers from a cdmi object"""
+    return acl_builder.from_cdmi(cdmi_acl)
 
 
 def acl_list_to_cql(read_access, write_access):
-    access = {}
-    for gname in read_access:
-        access[gname] = "read"
-    for gname in write_access:
-        if gname in access:
-            access[gname] = "read/write"
-        else:
-            access[gname] = "write"
+    """Return the CQL literal of an ACL from lists of group names"""
+    return acl_map_to_cql(acl_list_to_map(read_access, write_access))
+
+
+def acl_list_to_map(read_access, write_access):
+    """Return the ACL map bound to the ACL writers from lists of group
+    names. The map is shared, it mustn't be modified"""
+    return acl_builder.from_list(read_access, write_access)
+
+
+def acl_map_to_cql(acl):
+    """Return the CQL literal of an ACL map"""
     ls_access = []
-    for gname in access:
-        g = Group.find(gname)
-        if g:
-            ident = g.name
-        elif gname.upper() == "AUTHENTICATED@":
-            ident = "AUTHENTICATED@"
-        elif gname.upper() == "ANONYMOUS@":
-            ident = "ANONYMOUS@"
-        else:
-            # TODO log or return error if the identifier isn't found ?
-            continue
+    for ident, ace in acl.iteritems():
         s = (u"'{}': {{"
-              "acetype: 'ALLOW', "
+              "acetype: '{}', "
               "identifier: '{}', "
               "aceflags: {}, "
               "acemask: {}"
-              "}}").format(ident, ident, 0, str_to_acemask(access[gname], False))
+              "}}").format(ident,
+                           ace.acetype,
+                           ace.identifier,
+                           ace.aceflags,
+                           ace.acemask)
         ls_access.append(s)
-    acl = u"{{{}}}".format(", ".join(ls_access))
-    return acl
+    return u"{{{}}}".format(", ".join(ls_access))
+
 
 def str_to_acemask(lvl, is_object):
     """Return the acemask from a simplified access level"""
@@ -336,7 +713,7 @@ def serialize_acl_metadata(obj):
         acl_md = OrderedDict()
         acl_md["acetype"] = ace.acetype
         acl_md["identifier"] = ace.identifier
-        aceflags = ACEFLAG_OBJECT_INHERIT | ACEFLAG_CONTAINER_INHERIT
+        aceflags = ace.aceflags or ACEFLAG_DEFAULT
         acl_md["aceflags"] = aceflag_to_cdmi_str(aceflags)
         acemask = ace.acemask
         acl_md["acemask"] = acemask_to_cdmi_str(acemask, is_object)
@@ -17,28 +17,28 @@ limitations under the License.
 """
 
 from datetime import datetime
-from dse.cqlengine import connection
-from dse.query import SimpleStatement
 import json
 
-from indigo import (
-    RESERVED_META,
-    get_config
-)
+from indigo import RESERVED_META
 from indigo.util_graph import (
-    get_graph_session,
     gq_add_vertex_collection,
-    gq_get_metadata_collection,
-    gq_get_vertex_collection,
-    gq_get_vertex_user,
+    gq_drop_vertex,
+    gq_get_properties,
+    gq_get_vertex,
+    gq_update_properties,
 )
 from indigo.models import (
     TreeEntry,
     User
 )
 from indigo.models.acl import (
+    CompiledAcl,
     acemask_to_str,
-    serialize_acl_metadata
+    acl_cache,
+    mask_to_actions,
+    mask_to_dict,
+    serialize_acl_metadata,
+    user_principals,
 )
 from indigo.util import (
     datetime_serializer,
@@ -57,6 +57,9 @@ from indigo.models.errors import (
 
 # import logging
 
+# Number of rows fetched in a single page when we list a collection
+CHILD_PAGE_SIZE = 1000
+
 
 class Collection(object):
     """Collection model"""
@@ -80,21 +83,14 @@ class Collection(object):
     def check_graph_root(cls):
         """Return True if the root vertex does exist"""
         root = Collection.find("/")
-        session = get_graph_session()
-        query = gq_get_vertex_collection(root)
-        rset = session.execute_graph("v_root = {};".format(query))
-        
-        try:
-            root = next(rset.current_rows)
-            return True
-        except StopIteration:
-            return False
+        rset = gq_get_vertex('collection', root.uuid)
+        return bool(rset.current_rows)
 
 
     @classmethod
     def create(cls, name, container='/', metadata=None, username=None):
         """Create a new collection"""
-        from indigo.models import Notification
+        from indigo.models import MetadataIndex, Notification
         from indigo.models import Resource
         path = merge(container, name)
         # Check if parent collection exists
@@ -129,26 +125,11 @@ class Collection(object):
         
         new = Collection.find(path)
         
-        add_user_edge = ""
-        if username:
-            user = User.find(username)
-            if user:
-                add_user_edge = """v_user = {}.next();
-                                   v_user.addEdge('owns', v_new);
-                                   """.format(gq_get_vertex_user(user))
-        else:
-            add_user_edge = ""
-        session = get_graph_session()
-        session.execute_graph("""v_parent = {}.next();
-                                 v_new = {};
-                                 v_parent.addEdge('son', v_new);
-                                 {}
-                                 """.format(gq_get_vertex_collection(parent),
-                                            gq_add_vertex_collection(new),
-                                            add_user_edge)
-                             )
+        user = User.find(username) if username else None
+        gq_add_vertex_collection(new, parent, user)
         if metadata:
             new.update_graph(metadata)
+            MetadataIndex.update_object(new, None, metadata)
 
         state = new.mqtt_get_state()
         payload = new.mqtt_payload({}, state)
@@ -161,8 +142,7 @@ class Collection(object):
     @classmethod
     def create_graph_root(cls, root_entry):
         """Create the vertex for the root in the graph store"""
-        session = get_graph_session()
-        session.execute_graph(gq_add_vertex_collection(root_entry))
+        gq_add_vertex_collection(root_entry)
 
 
     @classmethod
@@ -183,21 +163,15 @@ class Collection(object):
 
 
     @classmethod
-    def delete_all(cls, path, username=None):
+    def delete_all(cls, path, username=None, wait=False):
         """Delete recursively all sub-collections and all resources contained
-        in a collection at 'path'"""
-        from indigo.models import Resource
-        parent = Collection.find(path)
-        if not parent:
-            return
-        collections, resources = parent.get_child()
-        collections = [Collection.find(merge(path, c)) for c in collections]
-        resources = [Resource.find(merge(path, c)) for c in resources]
-        for resource in resources:
-            resource.delete(username)
-        for collection in collections:
-            Collection.delete_all(collection.path, username)
-        parent.delete(username)
+        in a collection at 'path'. The deletion is executed in the background,
+        return the id of the job. With 'wait' the job is executed in the
+        calling thread and the call returns when the subtree is deleted"""
+        from indigo.jobs import execute_job, submit_job
+        if wait:
+            return execute_job("delete", {"path": path}, username).uuid
+        return submit_job("delete", {"path": path}, username)
 
 
     @classmethod
@@ -210,6 +184,22 @@ class Collection(object):
         else:
             return cls(entries.first())
 
+
+    @classmethod
+    def find_many(cls, paths):
+        """Return a list of collections from a list of paths, in the same
+        order, None is returned for the paths which can't be found"""
+        entries = TreeEntry.find_many([(path, '.') for path in paths])
+        res = []
+        for path in paths:
+            entry = entries.get((path, '.'))
+            if entry is None:
+                res.append(None)
+            else:
+                res.append(cls(entry))
+        return res
+
+
     @classmethod
     def get_root(cls):
         """Return the root collection, Create it if it doesn't exist"""
@@ -241,22 +231,13 @@ class Collection(object):
         from indigo.models import Notification
         if self.is_root:
             return
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement("""DELETE FROM tree_entry WHERE container=%s""")
-        session.execute(query, (self.path,))
+        TreeEntry.delete_container(self.path)
         # Get the row that describe the collection as a child of its parent
-        child = TreeEntry.objects.filter(container=self.container,
-                                           name=u"{}/".format(self.name)).first()
+        child = TreeEntry.find_entry(self.container, u"{}/".format(self.name))
         if child:
             child.delete()
         
-        session = get_graph_session()
-        session.execute_graph("""v_coll = {}.drop();
-                                 """.format(gq_get_vertex_collection(self))
-                             )
+        gq_drop_vertex('collection', self.uuid)
         
         state = self.mqtt_get_state()
         payload = self.mqtt_payload(state, {})
@@ -295,50 +276,82 @@ class Collection(object):
 
     def get_authorized_actions(self, user):
         """"Get available actions for user according to a group"""
-        # Check permission on the parent container if there's no action
-        # defined at this level
-        if not self.entry.container_acl:
-            if self.is_root:
-                return set([])
-            else:
-                parent_container = Collection.find(self.container)
-                return parent_container.get_authorized_actions(user)
-        actions = set([])
-        for gid in user.groups + ["AUTHENTICATED@"]:
-            if gid in self.entry.container_acl:
-                ace = self.entry.container_acl[gid]
-                level = acemask_to_str(ace.acemask, False)
-                if level == "read":
-                    actions.add("read")
-                elif level == "write":
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-                elif level == "read/write":
-                    actions.add("read")
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-        return actions
+        mask = self.get_compiled_acl().mask(user_principals(user))
+        return mask_to_actions(mask)
+
+
+    def get_compiled_acl(self):
+        """Return the ACL used for the permission checks, the one inherited
+        from the ancestors if there's no ACL defined at this level"""
+        if self.entry.container_acl:
+            return CompiledAcl(self.entry.container_acl)
+        return acl_cache.get(self.path)
+
+
+    def get_permissions(self, user):
+        """Return the can_<action> flags of a user, the ACL is resolved once
+        for all the actions"""
+        if user.administrator:
+            return mask_to_dict(~0)
+        return mask_to_dict(self.get_compiled_acl().mask(user_principals(user)))
 
 
     def get_child(self):
         """Return two lists for child container and child dataobjects"""
-        entries = TreeEntry.objects.filter(container=self.path)
         child_container = []
         child_dataobject = []
-        for entry in list(entries):
-            if entry.name == '.':
-                continue
-            elif entry.name.endswith('/'):
-                child_container.append(entry.name[:-1])
+        for name, is_container in self.iter_child():
+            if is_container:
+                child_container.append(name)
             else:
-                child_dataobject.append(entry.name)
+                child_dataobject.append(name)
         return (child_container, child_dataobject)
 
+
+    def get_child_page(self, cursor=None, page_size=CHILD_PAGE_SIZE,
+                       containers=True, resources=True):
+        """Return a page of the children of the collection as two lists for
+        child container and child dataobjects, and the cursor to give to get
+        the next page (None for the last page).
+
+        A page holds at most 'page_size' rows, it can have less children if
+        some kinds are filtered out."""
+        names, next_cursor = TreeEntry.get_names_page(self.path, cursor,
+                                                      page_size)
+        child_container = []
+        child_dataobject = []
+        for name in names:
+            if name == '.':
+                continue
+            elif name.endswith('/'):
+                if containers:
+                    child_container.append(name[:-1])
+            elif resources:
+                child_dataobject.append(name)
+        return (child_container, child_dataobject, next_cursor)
+
+
     def get_child_resource_count(self):
-        child_container, child_dataobject = self.get_child()
-        return len(child_dataobject)
+        """Return the number of dataobjects in the collection"""
+        count = 0
+        for _ in self.iter_child(containers=False):
+            count += 1
+        return count
+
+
+    def iter_child(self, containers=True, resources=True,
+                   page_size=CHILD_PAGE_SIZE):
+        """Generator which yields a (name, is_container) couple for each child
+        of the collection. Only the names are read from Cassandra, a page at a
+        time, so the partition (or the buckets) is never loaded in memory."""
+        for name in TreeEntry.iter_names(self.path, page_size):
+            if name == '.':
+                continue
+            elif name.endswith('/'):
+                if containers:
+                    yield (name[:-1], True)
+            elif resources:
+                yield (name, False)
 
 
     def get_cdmi_metadata(self):
@@ -348,8 +361,7 @@ class Collection(object):
 
     def get_graph_metadata(self):
         """Return a dictionary of metadata stored in the graph"""
-        session = get_graph_session()
-        result = session.execute_graph(gq_get_metadata_collection(self))
+        result = gq_get_properties('collection', self.uuid)
         return { r['label']:r['value'] 
                  for r in result 
                  if r['label'] not in RESERVED_META
@@ -365,10 +377,9 @@ class Collection(object):
         """Return the value of a metadata"""
         return decode_meta(self.entry.container_metadata.get(key, ""))
 
-    def index(self):
+    def index(self, force=False):
         from indigo.models import SearchIndex
-        self.reset()
-        SearchIndex.index(self, ['name', 'metadata'])
+        SearchIndex.index(self, ['name', 'metadata'], force)
 
     def mqtt_get_state(self):
         """Get the collection state for the payload"""
@@ -389,9 +400,25 @@ class Collection(object):
         payload['post'] = post_state
         return json.dumps(payload, default=datetime_serializer)
 
+
+    def propagate_acl(self, read_access, write_access, recursive=True,
+                      username=None):
+        """Replace the ACL of the collection from two lists of groups id and
+        propagate it to its content, following the inheritance flags. The
+        subtree is updated in the background, return the id of the job. With
+        'recursive' False only the direct children are updated"""
+        from indigo.jobs import submit_job
+        return submit_job("propagate_acl", {"path": self.path,
+                                            "read_access": read_access,
+                                            "write_access": write_access,
+                                            "recursive": recursive},
+                          username)
+
+
     def reset(self):
-        from indigo.models import SearchIndex
+        from indigo.models import MetadataIndex, SearchIndex
         SearchIndex.reset(self.path)
+        MetadataIndex.update_object(self, self.get_cdmi_metadata(), None)
 
 
     def to_dict(self, user=None):
@@ -405,18 +432,17 @@ class Collection(object):
             "metadata": self.get_list_metadata()
         }
         if user:
-            data['can_read'] = self.user_can(user, "read")
-            data['can_write'] = self.user_can(user, "write")
-            data['can_edit'] = self.user_can(user, "edit")
-            data['can_delete'] = self.user_can(user, "delete")
+            data.update(self.get_permissions(user))
         return data
 
 
     def update(self, **kwargs):
         """Update a collection"""
-        from indigo.models import Notification
+        from indigo.models import MetadataIndex, Notification
         pre_state = self.mqtt_get_state()
         kwargs['container_modified_ts'] = datetime.now()
+        old_metadata = self.get_cdmi_metadata()
+        new_metadata = kwargs.get('metadata')
         if 'metadata' in kwargs:
             # Transform the metadata in cdmi format to the format stored in
             # Cassandra
@@ -430,6 +456,8 @@ class Collection(object):
         else:
             username = None
         self.entry.update(**kwargs)
+        if new_metadata is not None:
+            MetadataIndex.update_object(self, old_metadata, new_metadata)
         coll = Collection.find(self.path)
         post_state = coll.mqtt_get_state()
         payload = coll.mqtt_payload(pre_state, post_state)
@@ -450,37 +478,9 @@ class Collection(object):
 
 
     def update_graph(self, metadata):
-        """Get the new metadata and store them in the graph as properties"""
-        session = get_graph_session()
-        gq_coll = gq_get_vertex_collection(self)
-        
-        # old_meta stores the metadata present in the graph before updating
-        old_meta = self.get_graph_metadata()
-        # new_meta stores the set of final metadata we want
-        new_meta = metadata
-        
-        old_meta_keys = set(old_meta.keys())
-        new_meta_keys = set(new_meta.keys())
-        
-        # Delete metadata present in old but not in new
-        for meta_to_delete in old_meta_keys.difference(new_meta_keys):
-            session.execute_graph("""{}.properties('{}').drop()""".format(
-                gq_coll,
-                meta_to_delete))
-        
-        # Update metadata present in both old and new (check if value changed ?)
-        for meta_to_update in old_meta_keys.intersection(new_meta_keys):
-            session.execute_graph("""{}.property('{}', '{}')""".format(
-                gq_coll,
-                meta_to_update,
-                new_meta[meta_to_update]))
-        
-        # Add metadata present in new but not in old
-        for meta_to_add in new_meta_keys.difference(old_meta_keys):
-            session.execute_graph("""{}.property('{}', '{}')""".format(
-                gq_coll,
-                meta_to_add,
-                new_meta[meta_to_add]))
+        """Store the new metadata in the graph as properties, with a single
+        request, return the metadata of the vertex"""
+        return gq_update_properties('collection', self.uuid, metadata)
 
 
     def user_can(self, user, action):
@@ -491,9 +491,6 @@ class Collection(object):
         if user.administrator:
             # An administrator can do anything
             return True
-        actions = self.get_authorized_actions(user)
-        if action in actions:
-            return True
-        return False
+        return self.get_compiled_acl().can(user_principals(user), action)
 
 
@@ -19,26 +19,25 @@ limitations under the License.
 from cStringIO import StringIO
 import zipfile
 from datetime import datetime
-from dse.cqlengine import (
-    columns,
-    connection
-)
-from dse.query import SimpleStatement
+from dse.cqlengine import columns
 from dse.cqlengine.models import Model
 
-from indigo import get_config
 from indigo.models import (
     Group,
 )
 from indigo.models.acl import (
     Ace,
-    acl_cdmi_to_cql,
-    acl_list_to_cql,
+    acl_cdmi_to_map,
+    acl_list_to_map,
     cdmi_str_to_aceflag,
     str_to_acemask,
     cdmi_str_to_acemask,
 )
 from indigo.util import default_cdmi_id
+from indigo.util_cql import (
+    cql_execute,
+    cql_execute_concurrent,
+)
 
 
 static_fields = ["checksum",
@@ -169,38 +168,36 @@ class DataObject(Model):
         return new
 
 
-    def create_acl(self, acl_cql):
-        """Replace the static acl with the given cql string"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE data_object SET acl = {}
-            WHERE uuid=%s""".format(acl_cql))
-        session.execute(query, (self.uuid,))
+    def create_acl(self, acl):
+        """Replace the static acl with the given ACL map"""
+        cql_execute(u"""UPDATE {keyspace}.data_object SET acl = ?
+            WHERE uuid=?""", (acl, self.uuid))
 
 
     def create_acl_cdmi(self, cdmi_acl):
         """""Create entry ACL from a cdmi object (list of dict)"""
-        cql_string = acl_cdmi_to_cql(cdmi_acl)
-        self.create_acl(cql_string)
+        acl = acl_cdmi_to_map(cdmi_acl)
+        self.create_acl(acl)
 
 
     def create_acl_list(self, read_access, write_access):
         """Create ACL from two lists of groups id, existing ACL are replaced"""
-        cql_string = acl_list_to_cql(read_access, write_access)
-        self.create_acl(cql_string)
+        acl = acl_list_to_map(read_access, write_access)
+        self.create_acl(acl)
 
 
     @classmethod
     def delete_id(cls, uuid):
         """Delete all blobs for the specified uuid"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement("""DELETE FROM data_object WHERE uuid=%s""")
-        session.execute(query, (uuid,))
+        cql_execute(u"""DELETE FROM {keyspace}.data_object WHERE uuid=?""",
+                    (uuid,))
+
+
+    @classmethod
+    def delete_many(cls, uuids):
+        """Delete all blobs for a list of uuids, with asynchronous requests"""
+        cql_execute_concurrent(u"""DELETE FROM {keyspace}.data_object WHERE uuid=?""",
+                               [(uuid,) for uuid in uuids])
 
 
     @classmethod
@@ -213,47 +210,85 @@ class DataObject(Model):
             return entries.first()
 
 
+    @classmethod
+    def find_header(cls, uuid):
+        """Find an object by uuid, only the static columns are read so no blob
+        is transferred. The content is still available with chunk_content()
+        which reads the blobs when it is iterated."""
+        rows = cql_execute(u"""SELECT DISTINCT uuid, {columns}
+            FROM {keyspace}.data_object WHERE uuid=?""",
+                           (uuid,),
+                           columns=u", ".join(static_fields))
+        for row in rows:
+            return cls(**row)
+        return None
+
+
+    @classmethod
+    def set_acl_many(cls, uuids, acl):
+        """Replace the acl of a list of objects with the same ACL map, with
+        asynchronous requests"""
+        cql_execute_concurrent(u"""UPDATE {keyspace}.data_object SET acl=?
+            WHERE uuid=?""", [(acl, uuid) for uuid in uuids])
+
+
+    @classmethod
+    def find_header_many(cls, uuids):
+        """Find the headers of a list of objects with asynchronous reads,
+        return a dictionary indexed by the uuids found"""
+        uuids = list(set(uuids))
+        results = cql_execute_concurrent(u"""SELECT DISTINCT uuid, {columns}
+            FROM {keyspace}.data_object WHERE uuid=?""",
+                                         [(uuid,) for uuid in uuids],
+                                         columns=u", ".join(static_fields))
+        res = {}
+        for rows in results:
+            for row in rows:
+                res[row['uuid']] = cls(**row)
+        return res
+
+
     def update(self, **kwargs):
-        """Update a data object"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        for arg in kwargs:
-            # For static fields we can't use the name in the where condition
-            if arg in static_fields:
-                query = SimpleStatement("""UPDATE data_object SET {}=%s
-                    WHERE uuid=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.uuid))
-            else:
-                print """UPDATE data_object SET {}=%s
-                    WHERE uuid=%s and sequence_number=%s""".format(arg)
-                query = SimpleStatement("""UPDATE data_object SET {}=%s
-                    WHERE uuid=%s and sequence_number=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.uuid, self.sequence_number))
+        """Update a data object
+
+        All the columns are written with a single statement, prepared once
+        for each set of column names"""
+        if not kwargs:
+            return self
+        columns = sorted(kwargs)
+        values = [kwargs[arg] for arg in columns]
+        assignments = u", ".join([u"{}=?".format(arg) for arg in columns])
+        # For static fields we can't use the sequence number in the where
+        # condition, if there's at least one regular column the whole row is
+        # updated (the static columns can be set in the same statement)
+        if all([arg in static_fields for arg in columns]):
+            cql_execute(u"""UPDATE {keyspace}.data_object SET {assignments}
+                WHERE uuid=?""",
+                        values + [self.uuid],
+                        assignments=assignments)
+        else:
+            cql_execute(u"""UPDATE {keyspace}.data_object SET {assignments}
+                WHERE uuid=? and sequence_number=?""",
+                        values + [self.uuid, self.sequence_number],
+                        assignments=assignments)
         return self
 
 
-    def update_acl(self, acl_cql):
-        """Update the static acl with the given cql string
+    def update_acl(self, acl):
+        """Update the static acl with the given ACL map
         """
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE data_object SET acl = acl + {}
-            WHERE uuid=%s""".format(acl_cql))
-        session.execute(query, (self.uuid,))
+        cql_execute(u"""UPDATE {keyspace}.data_object SET acl = acl + ?
+            WHERE uuid=?""", (acl, self.uuid))
 
 
     def update_acl_cdmi(self, cdmi_acl):
         """"Update entry ACL from a cdmi object (list of dict)"""
-        cql_string = acl_cdmi_to_cql(cdmi_acl)
-        self.update_acl(cql_string)
+        acl = acl_cdmi_to_map(cdmi_acl)
+        self.update_acl(acl)
 
 
     def update_acl_list(self, read_access, write_access):
         """Update ACL from two lists of groups id, existing ACL are replaced"""
-        cql_string = acl_list_to_cql(read_access, write_access)
-        self.update_acl(cql_string)
+        acl = acl_list_to_map(read_access, write_access)
+        self.update_acl(acl)
 
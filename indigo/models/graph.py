@@ -17,10 +17,31 @@ limitations under the License.
 """
 
 
-from indigo.util_graph import get_graph_session
+from indigo.log import init_log
+from indigo.util_graph import (
+    get_graph_session,
+    graph_value,
+)
 
 from dse.cluster import EXEC_PROFILE_GRAPH_SYSTEM_DEFAULT
 
+logger = init_log('graph')
+
+
+GQ_VERTEX_BY_VID = "g.V().hasLabel(label).has('vid', vid)"
+
+GQ_ADD_EDGE = """v1 = g.V().hasLabel(v1_label).has('vid', v1_id).next();
+v2 = g.V().hasLabel(v2_label).has('vid', v2_id).next();
+v1.addEdge(label, v2, 'eid', eid);"""
+
+GQ_ADD_VERTEX = """v = graph.addVertex(T.label, label, 'vid', vid);
+properties.each { key, value -> v.property(key, value) };"""
+
+# The vertices are looked up by label and vid, each label gets a materialized
+# index on vid when it's first used
+GQ_CREATE_LABEL = """schema.vertexLabel(label).properties('vid').ifNotExists().create();
+schema.vertexLabel(label).index('byVid').materialized().by('vid').ifNotExists().add();"""
+
 
 class Graph(object):
     
@@ -33,57 +54,56 @@ class Graph(object):
                                    {'name': graph_name},
                                    execution_profile=EXEC_PROFILE_GRAPH_SYSTEM_DEFAULT)
     
+        # The labels and the properties are chosen by the caller, they are
+        # created on the fly but the lookups must use an index
         self.session.execute_graph("schema.config().option('graph.schema_mode').set('Development')")
-        self.session.execute_graph("schema.config().option('graph.allow_scan').set('true')")
+        self.session.execute_graph("schema.config().option('graph.allow_scan').set('false')")
+        self.session.execute_graph("schema.propertyKey('vid').Text().single().ifNotExists().create()")
+        self._labels = set()
 
 
     def add_edge(self, label, eid, v1_label, v1_id, v2_label, v2_id):
         try:
             # Check if edge exists ?
-            query = """v1 = g.V().hasLabel('{}').has('vid', '{}').next();
-                       v2 = g.V().hasLabel('{}').has('vid', '{}').next();
-                       v1.addEdge('{}', v2, 'eid', {});""".format(
-                           v1_label,
-                           v1_id,
-                           v2_label,
-                           v2_id,
-                           label,
-                           eid)
-            self.session.execute_graph(query)
+            self.session.execute_graph(GQ_ADD_EDGE, {'label': label,
+                                                     'eid': eid,
+                                                     'v1_label': v1_label,
+                                                     'v1_id': v1_id,
+                                                     'v2_label': v2_label,
+                                                     'v2_id': v2_id})
         except Exception as e:
             ## The vertex probaly doesn't exist
-            print "problem", query
+            logger.warning(u"Problem while adding the edge '{}' {}".format(
+                label, eid))
             return
 
 
+    def _create_label(self, label):
+        """Create a vertex label and its index if it hasn't been done by this
+        object"""
+        if label not in self._labels:
+            self.session.execute_graph(GQ_CREATE_LABEL, {'label': label})
+            self._labels.add(label)
+
+
     def add_vertex(self, label, vid, properties):
         """Add a new vertex with the specified label and the dictionary of 
         properties mapped to properties in the Gremlin graph"""
+        self._create_label(label)
         # Test if the vertex is already there
         if self.vertex_exists(label, vid):
             # Update ?
             return
         else:
-            properties_str = ", ".join(["'{}', '{}'".format(key, value)
-                                        for key, value in properties.iteritems()])
-            if properties_str:
-                query = "graph.addVertex(T.label, '{}', 'vid', {}, {})".format(label, vid, properties_str)
-            else:
-                query = "graph.addVertex(T.label, '{}', 'vid', {})".format(label, vid)
-            print query
-            self.session.execute_graph(query)
+            self.session.execute_graph(GQ_ADD_VERTEX, {
+                'label': label,
+                'vid': vid,
+                'properties': dict([(key, graph_value(value))
+                                    for key, value in properties.iteritems()])
+            })
 
 
     def vertex_exists(self, label, vid):
-        query = "g.V().hasLabel('{}').has('vid', '{}')".format(label, vid)
-        rset = self.session.execute_graph(query)
-        try:
-            vertex = next(rset.current_rows)
-            return True
-        except StopIteration:
-            return False
-    
-    
-
-
-
+        rset = self.session.execute_graph(GQ_VERTEX_BY_VID, {'label': label,
+                                                             'vid': vid})
+        return bool(rset.current_rows)
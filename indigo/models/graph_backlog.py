@@ -0,0 +1,106 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from dse.cqlengine import columns
+from dse.cqlengine.models import Model
+from datetime import datetime
+import json
+
+
+class GraphBacklog(Model):
+    """Graph Backlog Model
+
+    The vertex mutations which couldn't be written to the graph by the
+    write-behind queue. They are kept here until they are replayed, one row
+    per vertex with the mutations coalesced as in the queue."""
+    uuid = columns.Text(partition_key=True)
+    label = columns.Text(primary_key=True)
+    drop = columns.Boolean(default=False)
+    # Json map of the new vertex, if it still has to be created
+    add = columns.Text()
+    # Json map of the new properties of the vertex
+    metadata = columns.Text()
+    error = columns.Text()
+    # When the first mutation was queued
+    create_ts = columns.DateTime(default=datetime.now)
+    modified_ts = columns.DateTime(default=datetime.now)
+
+
+    @classmethod
+    def store(cls, entry, error=None):
+        """Save a pending entry of the write-behind queue, it's merged with
+        the mutations already saved for the same vertex"""
+        from indigo.graph_queue import merge
+        create_ts = datetime.fromtimestamp(entry['ts'])
+        row = cls.objects.filter(uuid=entry['uuid'],
+                                 label=entry['label']).first()
+        if row is not None:
+            entry = merge(row.to_entry(), entry)
+            create_ts = row.create_ts
+        return cls.create(
+            uuid=entry['uuid'],
+            label=entry['label'],
+            drop=entry['drop'],
+            add=json.dumps(entry['add']) if entry['add'] else None,
+            metadata=(json.dumps(entry['metadata'])
+                      if entry['metadata'] is not None else None),
+            error=error,
+            create_ts=create_ts,
+            modified_ts=datetime.now())
+
+
+    def to_entry(self):
+        """Return the entry of the write-behind queue saved in this row"""
+        return {
+            'label': self.label,
+            'uuid': self.uuid,
+            'drop': bool(self.drop),
+            'add': json.loads(self.add) if self.add else None,
+            'metadata': json.loads(self.metadata) if self.metadata else None,
+        }
+
+
+class GraphQueueStats(Model):
+    """Last metrics of the write-behind queue of each process, published by
+    its workers (see GraphWriteQueue.stats). The rows expire when a process
+    stops publishing"""
+    process = columns.Text(partition_key=True)
+    depth = columns.Integer()
+    in_flight = columns.Integer()
+    # Age in seconds of the oldest pending mutation
+    lag = columns.Float()
+    enqueued = columns.BigInt()
+    flushed = columns.BigInt()
+    retried = columns.BigInt()
+    backlogged = columns.BigInt()
+    modified_ts = columns.DateTime(default=datetime.now)
+
+
+    @classmethod
+    def publish(cls, process, stats, ttl):
+        """Save the metrics of the queue of a process for 'ttl' seconds"""
+        return cls.ttl(ttl).create(
+            process=process,
+            depth=stats['depth'],
+            in_flight=stats['in_flight'],
+            lag=stats['lag'],
+            enqueued=stats['enqueued'],
+            flushed=stats['flushed'],
+            retried=stats['retried'],
+            backlogged=stats['backlogged'],
+            modified_ts=datetime.now())
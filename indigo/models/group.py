@@ -67,6 +67,7 @@ class Group(Model):
         """Create a new group, raise an exception if the group already
         exists"""
         from indigo.models import Notification
+        from indigo.models.acl import acl_builder
         kwargs['name'] = kwargs['name'].strip()
         if 'username' in kwargs:
             username = kwargs['username']
@@ -78,6 +79,7 @@ class Group(Model):
         if existing:
             raise GroupConflictError(kwargs['name'])
         grp = super(Group, cls).create(**kwargs)
+        acl_builder.invalidate_group(grp.name)
         state = grp.mqtt_get_state()
         payload = grp.mqtt_payload({}, state)
         Notification.create_group(username, grp.name, payload)
@@ -91,6 +93,8 @@ class Group(Model):
     @classmethod
     def find_all(cls, namelist):
         """Find groups with a list of names"""
+        if not namelist:
+            return []
         return cls.objects.filter(name__in=namelist).all()
 
     def __unicode__(self):
@@ -100,12 +104,14 @@ class Group(Model):
         # Slow and ugly,
         from indigo.models import Notification
         from indigo.models import User
+        from indigo.models.acl import acl_builder
         state = self.mqtt_get_state()
         for u in User.objects.all():
             if self.name in u.groups:
                 u.groups.remove(self.name)
                 u.save()
         super(Group, self).delete()
+        acl_builder.invalidate_group(self.name)
         payload = self.mqtt_payload(state, {})
         Notification.delete_group(username, self.name, payload)
 
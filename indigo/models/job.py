@@ -0,0 +1,177 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from dse.cqlengine import columns
+from dse.cqlengine.models import Model
+from datetime import datetime
+import json
+
+from indigo.util import (
+    datetime_serializer,
+    default_uuid
+)
+from indigo.util_cql import cql_execute
+
+
+# States of a job
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+class Job(Model):
+    """Job Model
+
+    A long running operation (recursive delete, reindexing, ...) which is
+    executed in the background by a JobRunner. The parameters and the
+    checkpoints are json strings, their content depends on the type of the
+    job."""
+    __table_name__ = "jobs"
+
+    uuid = columns.Text(default=default_uuid, partition_key=True)
+    job_type = columns.Text(required=True)
+    spec = columns.Text()
+    state = columns.Text(default=STATE_PENDING)
+    # Handler specific data used to resume an interrupted job
+    checkpoint = columns.Text()
+    # Statistics reported by the job
+    progress = columns.Text()
+    error = columns.Text()
+    username = columns.Text()
+    # The process which runs the job (host:pid) and the last time it reported
+    # something, used to find the jobs whose process died
+    owner = columns.Text()
+    heartbeat = columns.DateTime()
+    create_ts = columns.DateTime(default=datetime.now)
+    modified_ts = columns.DateTime()
+
+
+    def claim(self, owner, stale_limit):
+        """Try to become the owner of the job, return True if it worked.
+
+        This is a lightweight transaction so two processes can't run the
+        same job: a pending job is claimed if it's still pending, a running
+        job only if the heartbeat we read is older than 'stale_limit' (its
+        process died) and hasn't changed since."""
+        now = datetime.now()
+        if self.state == STATE_PENDING:
+            condition = u"state=?"
+            expected = (STATE_PENDING,)
+        elif (self.state == STATE_RUNNING and
+              (self.heartbeat is None or self.heartbeat < stale_limit)):
+            condition = u"state=? AND heartbeat=?"
+            expected = (STATE_RUNNING, self.heartbeat)
+        else:
+            return False
+        rows = cql_execute(u"""UPDATE {keyspace}.jobs
+            SET owner=?, state=?, heartbeat=?, modified_ts=?
+            WHERE uuid=? IF {condition}""",
+                           (owner, STATE_RUNNING, now, now, self.uuid) +
+                           expected,
+                           condition=condition)
+        row = rows[0]
+        if not row['[applied]']:
+            return False
+        self.owner = owner
+        self.state = STATE_RUNNING
+        self.heartbeat = now
+        self.modified_ts = now
+        return True
+
+
+    @classmethod
+    def create(cls, job_type, spec=None, username=None):
+        """Create a new pending job"""
+        return super(Job, cls).create(job_type=job_type,
+                                      spec=json.dumps(spec or {}),
+                                      username=username)
+
+
+    @classmethod
+    def find(cls, uuid):
+        """Find a job by uuid"""
+        return cls.objects.filter(uuid=uuid).first()
+
+
+    def finish(self, progress=None, error=None):
+        """Record the end of the job"""
+        if error:
+            state = STATE_FAILED
+        else:
+            state = STATE_DONE
+        kwargs = {"state": state,
+                  "error": error,
+                  "modified_ts": datetime.now()}
+        if progress is not None:
+            kwargs["progress"] = json.dumps(progress,
+                                            default=datetime_serializer)
+        self.update(**kwargs)
+
+
+    def get_checkpoint(self):
+        """Return the last checkpoint, None if the job never saved one"""
+        if not self.checkpoint:
+            return None
+        return json.loads(self.checkpoint)
+
+
+    def get_progress(self):
+        """Return the last statistics of the job"""
+        if not self.progress:
+            return {}
+        return json.loads(self.progress)
+
+
+    def get_spec(self):
+        """Return the parameters of the job"""
+        if not self.spec:
+            return {}
+        return json.loads(self.spec)
+
+
+    def save_checkpoint(self, checkpoint=None, progress=None):
+        """Save the checkpoint and/or the statistics of a running job, it
+        also keeps the job alive for the other processes"""
+        now = datetime.now()
+        kwargs = {"heartbeat": now,
+                  "modified_ts": now}
+        if checkpoint is not None:
+            kwargs["checkpoint"] = json.dumps(checkpoint,
+                                              default=datetime_serializer)
+        if progress is not None:
+            kwargs["progress"] = json.dumps(progress,
+                                            default=datetime_serializer)
+        self.update(**kwargs)
+
+
+    def to_dict(self):
+        """Return a dictionary which describes a job"""
+        return {
+            "id": self.uuid,
+            "type": self.job_type,
+            "spec": self.get_spec(),
+            "state": self.state,
+            "progress": self.get_progress(),
+            "error": self.error,
+            "username": self.username,
+            "owner": self.owner,
+            "heartbeat": self.heartbeat,
+            "create_ts": self.create_ts,
+            "modified_ts": self.modified_ts,
+        }
@@ -20,21 +20,20 @@ limitations under the License.
 import json
 import logging
 from dse.cqlengine import columns
-from dse.cqlengine.models import (
-    connection,
-    Model
-    )
+from dse.cqlengine.models import Model
 from dse.util import uuid_from_time
 from dse.util import datetime_from_uuid1
-from dse.query import SimpleStatement
 
-from indigo import get_config
 from indigo.util import (
     datetime_serializer,
     default_time,
     default_date,
     last_x_days
 )
+from indigo.util_cql import (
+    cql_bind,
+    get_session,
+)
 
 
 
@@ -51,18 +50,13 @@ class ListenerLog(Model):
     @classmethod
     def recent(cls, script_name, count=20):
         """Return the last logs"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
+        session = get_session()
         # I couldn't find how to disable paging in cqlengine in the "model" view
         # so I create the cal query directly
-        query = SimpleStatement(u"""SELECT * from listener_log WHERE
-            script_name = '{}'
+        query = cql_bind(u"""SELECT * from {keyspace}.listener_log WHERE
+            script_name = ?
             ORDER BY when DESC
-            limit {}""".format(script_name,
-                               count)
-            )
+            limit ?""", (script_name, count))
         # Disable paging for this query (we use IN and ORDER BY in the same
         # query
         query.fetch_size = None
@@ -0,0 +1,210 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from dse.cqlengine import columns
+from dse.cqlengine.models import Model
+
+from indigo import get_config
+from indigo.models.search import shard_for
+from indigo.util_cql import (
+    cql_execute,
+    cql_execute_batches,
+    cql_execute_concurrent,
+)
+
+
+# Longer values aren't indexed, they would make too large partition keys
+METADATA_VALUE_MAX = 1024
+
+# Default number of partitions of each metadata key and value
+METADATA_INDEX_SHARDS = 1
+
+
+def metadata_shards():
+    """Return the number of partitions each metadata key and value is split
+    in, it's independent from the shards of the search index"""
+    cfg = get_config(None)
+    return cfg.get('METADATA_INDEX_SHARDS', METADATA_INDEX_SHARDS)
+
+
+def metadata_couples(metadata):
+    """Return the set of (key, value) couples indexed for a dictionary of
+    metadata in the cdmi format. A list is indexed as its values"""
+    couples = set()
+    for key, value in (metadata or {}).iteritems():
+        values = value if isinstance(value, list) else [value]
+        for val in values:
+            if not val and val != 0:
+                continue
+            val = unicode(val)
+            if len(val) <= METADATA_VALUE_MAX:
+                couples.add((key, val))
+    return couples
+
+
+def path_range(path):
+    """Return the bounds of the object paths below a collection, None for
+    the root"""
+    prefix = path.rstrip('/')
+    if not prefix:
+        return None
+    # '0' is the character which follows '/'
+    return (prefix + u'/', prefix + u'0')
+
+
+def index_changes(changes, shards, force=False):
+    """Return the rows to insert and to delete in MetadataIndex and in
+    MetadataKeyIndex for a list of (object_path, object_type, old metadata,
+    new metadata) tuples, grouped by partition. Only the values which
+    changed are returned, unless 'force' is set: all the rows of the new
+    metadata are inserted again"""
+    inserts = {}
+    deletes = {}
+    key_inserts = {}
+    key_deletes = {}
+    for path, obj_type, old_metadata, new_metadata in changes:
+        shard = shard_for(path, shards)
+        old = metadata_couples(old_metadata)
+        new = metadata_couples(new_metadata)
+        for key, value in (new if force else new - old):
+            inserts.setdefault((key, value, shard), []).append(
+                (key, value, shard, path, obj_type))
+        for key, value in old - new:
+            deletes.setdefault((key, value, shard), []).append(
+                (key, value, shard, path))
+        old_keys = set([key for key, _ in old])
+        new_keys = set([key for key, _ in new])
+        for key in (new_keys if force else new_keys - old_keys):
+            key_inserts.setdefault((key, shard), []).append(
+                (key, shard, path, obj_type))
+        for key in old_keys - new_keys:
+            key_deletes.setdefault((key, shard), []).append(
+                (key, shard, path))
+    return inserts, deletes, key_inserts, key_deletes
+
+
+class MetadataIndex(Model):
+    """Index of the metadata values
+
+    The objects which have a metadata 'key' with the value 'value' are
+    stored in the partitions (key, value, shard), clustered by path so a
+    lookup can be restricted to a subtree. The shard is a hash of the
+    path, as in the search index. The objects which have a metadata
+    'key' are indexed in MetadataKeyIndex. The rows are maintained by the
+    create, update and delete methods of the collections and resources, the
+    index of an existing tree is built with 'iadmin reindex'."""
+    key = columns.Text(required=True, partition_key=True)
+    value = columns.Text(required=True, partition_key=True)
+    shard = columns.Integer(required=True, partition_key=True)
+    object_path = columns.Text(required=True, primary_key=True)
+    object_type = columns.Text(required=True)
+
+
+    @classmethod
+    def find(cls, key, value=None, path=None, limit=None):
+        """Return the sorted list of the (object_path, object_type) couples
+        of the objects which have the metadata 'key', with the value 'value'
+        if it's given, and which are below 'path' if it's given. All the
+        shards are read in parallel"""
+        if value is None:
+            query = u"""SELECT object_path, object_type
+                FROM {keyspace}.metadata_key_index
+                WHERE key=? and shard=?{where}"""
+            key_values = (key,)
+        else:
+            query = u"""SELECT object_path, object_type
+                FROM {keyspace}.metadata_index
+                WHERE key=? and value=? and shard=?{where}"""
+            key_values = (key, unicode(value))
+        bounds = path_range(path) if path else None
+        where = u""
+        extra = ()
+        if bounds:
+            where = u" and object_path>=? and object_path<?"
+            extra = bounds
+        if limit:
+            where += u" LIMIT ?"
+            extra += (limit,)
+        params = [key_values + (shard,) + extra
+                  for shard in xrange(metadata_shards())]
+        results = cql_execute_concurrent(query, params, where=where)
+        found = sorted([(row['object_path'], row['object_type'])
+                        for rows in results for row in rows])
+        if limit:
+            return found[:limit]
+        return found
+
+
+    @classmethod
+    def reset_all(cls):
+        """Empty the index tables, before the whole tree is indexed again"""
+        cql_execute(u"TRUNCATE {keyspace}.metadata_index")
+        cql_execute(u"TRUNCATE {keyspace}.metadata_key_index")
+
+
+    @classmethod
+    def reset_many(cls, objects):
+        """Remove a list of objects from the index, 'objects' is a list of
+        (object_path, object_type, metadata) tuples"""
+        cls.update_many([(path, obj_type, metadata, None)
+                         for path, obj_type, metadata in objects])
+
+
+    @classmethod
+    def update_many(cls, changes, force=False):
+        """Update the index for a list of changes of metadata, 'changes' is
+        a list of (object_path, object_type, old metadata, new metadata)
+        tuples, the metadata are in the cdmi format. Only the rows of the
+        values which changed are written, with one batch per partition.
+        With 'force' all the rows of the new metadata are written, which
+        repairs missing rows"""
+        inserts, deletes, key_inserts, key_deletes = index_changes(
+            changes, metadata_shards(), force)
+        if deletes:
+            cql_execute_batches(u"""DELETE FROM {keyspace}.metadata_index
+                WHERE key=? and value=? and shard=? and object_path=?""",
+                                deletes.values())
+        if key_deletes:
+            cql_execute_batches(u"""DELETE FROM {keyspace}.metadata_key_index
+                WHERE key=? and shard=? and object_path=?""",
+                                key_deletes.values())
+        if inserts:
+            cql_execute_batches(u"""INSERT INTO {keyspace}.metadata_index
+                (key, value, shard, object_path, object_type)
+                VALUES (?, ?, ?, ?, ?)""", inserts.values())
+        if key_inserts:
+            cql_execute_batches(u"""INSERT INTO {keyspace}.metadata_key_index
+                (key, shard, object_path, object_type)
+                VALUES (?, ?, ?, ?)""", key_inserts.values())
+
+
+    @classmethod
+    def update_object(cls, obj, old_metadata, new_metadata):
+        """Update the index for a change of the metadata of a collection or
+        a resource"""
+        cls.update_many([(obj.path, obj.__class__.__name__,
+                          old_metadata, new_metadata)])
+
+
+class MetadataKeyIndex(Model):
+    """Index of the metadata keys, the objects which have a metadata 'key'
+    are stored in the partitions (key, shard) (see MetadataIndex)"""
+    key = columns.Text(required=True, partition_key=True)
+    shard = columns.Integer(required=True, partition_key=True)
+    object_path = columns.Text(required=True, primary_key=True)
+    object_type = columns.Text(required=True)
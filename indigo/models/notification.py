@@ -20,17 +20,16 @@ import json
 import paho.mqtt.publish as publish
 import logging
 from dse.cqlengine import columns
-from dse.cqlengine.models import (
-    connection,
-    Model
-    )
-from dse.query import SimpleStatement
-from indigo import get_config
+from dse.cqlengine.models import Model
 from indigo.util import (
     default_time,
     default_date,
     last_x_days
 )
+from indigo.util_cql import (
+    cql_bind,
+    get_session,
+)
 
 
 # Operations that could lead to a new notification
@@ -296,19 +295,13 @@ class Notification(Model):
         """Return the last activities"""
 #         return Notification.objects.filter(date__in=last_x_days())\
 #             .order_by("-when").all().limit(count)
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
+        session = get_session()
         # I couldn't find how to disable paging in cqlengine in the "model" view
         # so I create the cal query directly
-        query = SimpleStatement(u"""SELECT * from Notification WHERE
-            date IN ({})
+        query = cql_bind(u"""SELECT * from {keyspace}.notification WHERE
+            date IN ?
             ORDER BY when DESC
-            limit {}""".format(
-                ",".join(["'%s'" % el for el in last_x_days()]),
-                count)
-            )
+            limit ?""", (last_x_days(), count))
         # Disable paging for this query (we use IN and ORDER BY in the same
         # query
         query.fetch_size = None
@@ -30,16 +30,19 @@ from indigo.models import (
     User
 )
 from indigo.util_graph import (
-    get_graph_session,
     gq_add_vertex_resource,
-    gq_get_metadata_resource,
-    gq_get_vertex_collection,
-    gq_get_vertex_resource,
-    gq_get_vertex_user,
+    gq_drop_vertex,
+    gq_get_properties,
+    gq_update_properties,
 )
 from indigo.models.acl import (
+    CompiledAcl,
     acemask_to_str,
-    serialize_acl_metadata
+    acl_cache,
+    mask_to_actions,
+    mask_to_dict,
+    serialize_acl_metadata,
+    user_principals,
 )
 from indigo.models.errors import (
     NoSuchCollectionError,
@@ -76,9 +79,22 @@ class Resource(object):
         self.uuid = self.entry.uuid
         if not self.is_reference:
             self.obj_id = self.url.replace("cassandra://", "")
-            self.obj = DataObject.find(self.obj_id)
         else:
-            self.obj = None
+            self.obj_id = None
+        # The data object header is read on first access only, the tree entry
+        # is enough for the name, the path or the uuid
+        self._obj = obj
+        self._obj_loaded = obj is not None or self.is_reference
+
+
+    @property
+    def obj(self):
+        """Return the header of the data object (None for a reference), it's
+        read once and kept for the lifetime of the resource"""
+        if not self._obj_loaded:
+            self._obj = DataObject.find_header(self.obj_id)
+            self._obj_loaded = True
+        return self._obj
 
 
     def __unicode__(self):
@@ -98,7 +114,7 @@ class Resource(object):
                url=None, mimetype=None, username=None, size=None):
         """Create a new resource in the tree_entry table"""
         from indigo.models import Collection
-        from indigo.models import Notification
+        from indigo.models import MetadataIndex, Notification
         # Check if parent collection exists
         parent = Collection.find(container)
         if parent is None:
@@ -132,42 +148,28 @@ class Resource(object):
                 kwargs["metadata"] = metadata_cass
         else:
             obj_id = url.replace("cassandra://", "")
-            data_obj = DataObject.find(obj_id)
+            data_obj = DataObject.find_header(obj_id)
+            # Gather the columns so the data object is updated in one write
+            obj_kwargs = {}
             if metadata:
-                data_obj.update(mimetype=mimetype,
-                                metadata=metadata_cass)
+                obj_kwargs["mimetype"] = mimetype
+                obj_kwargs["metadata"] = metadata_cass
             else:
                 if mimetype:
-                    data_obj.update(mimetype=mimetype)
+                    obj_kwargs["mimetype"] = mimetype
                 if size:
-                    data_obj.update(size=size)
+                    obj_kwargs["size"] = size
+            if obj_kwargs:
+                data_obj.update(**obj_kwargs)
 
         data_entry = TreeEntry.create(**kwargs)
         new = Resource(data_entry)
 
-        session = get_graph_session()
-        
-        add_user_edge = ""
-        if username:
-            user = User.find(username)
-            if user:
-                add_user_edge = """v_user = {}.next();
-                                   v_user.addEdge('owns', v_new);
-                                   """.format(gq_get_vertex_user(user))
-        else:
-            add_user_edge = ""
-            
-        
-        session.execute_graph("""v_parent = {}.next();
-                                 v_new = {};
-                                 v_parent.addEdge('son', v_new);
-                                 {}
-                                 """.format(gq_get_vertex_collection(parent),
-                                            gq_add_vertex_resource(new),
-                                            add_user_edge)
-                             )
+        user = User.find(username) if username else None
+        gq_add_vertex_resource(new, parent, user)
         if metadata:
             new.update_graph(metadata)
+            MetadataIndex.update_object(new, None, metadata)
 
         state = new.mqtt_get_state()
         payload = new.mqtt_payload({}, state)
@@ -197,16 +199,14 @@ class Resource(object):
         """Delete the resource in the tree_entry table and all the corresponding
         blobs"""
         from indigo.models import Notification
+        # The state is read before the header of the data object is deleted
+        state = self.mqtt_get_state()
         self.delete_blobs()
         self.entry.delete()
         
-        session = get_graph_session()
-        session.execute_graph("""v_resc = {}.drop();
-                                 """.format(gq_get_vertex_resource(self))
-                             )
+        gq_drop_vertex('resource', self.uuid)
         
         
-        state = self.mqtt_get_state()
         payload = self.mqtt_payload(state, {})
         Notification.delete_resource(username, self.path, payload)
         self.reset()
@@ -222,11 +222,36 @@ class Resource(object):
     def find(cls, path):
         """Return a resource from a path"""
         coll_name, resc_name = split(path)
-        entries = TreeEntry.objects.filter(container=coll_name, name=resc_name)
-        if not entries:
+        entry = TreeEntry.find_entry(coll_name, resc_name)
+        if entry is None:
             return None
         else:
-            return cls(entries.first())
+            return cls(entry)
+
+
+    @classmethod
+    def find_many(cls, paths, load_objects=False):
+        """Return a list of resources from a list of paths, in the same order,
+        None is returned for the paths which can't be found. With
+        'load_objects' the headers of the data objects are read in bulk
+        too"""
+        keys = [split(path) for path in paths]
+        entries = TreeEntry.find_many(keys)
+        objs = {}
+        if load_objects:
+            objs = DataObject.find_header_many(
+                [entry.url.replace("cassandra://", "")
+                 for entry in entries.itervalues()
+                 if not is_reference(entry.url)])
+        res = []
+        for key in keys:
+            entry = entries.get(key)
+            if entry is None:
+                res.append(None)
+            else:
+                obj_id = entry.url.replace("cassandra://", "")
+                res.append(cls(entry, objs.get(obj_id)))
+        return res
 
 
     def full_dict(self, user=None):
@@ -249,22 +274,14 @@ class Resource(object):
             data["checksum"] = self.get_checksum()
             data["size"] = self.get_size()
         if user:
-            data['can_read'] = self.user_can(user, "read")
-            data['can_write'] = self.user_can(user, "write")
-            data['can_edit'] = self.user_can(user, "edit")
-            data['can_delete'] = self.user_can(user, "delete")
+            data.update(self.get_permissions(user))
         return data
 
 
     def get_acl(self):
-        if self.is_reference:
+        if self.obj is None:
             return self.entry.acl
-        else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.acl
-            return self.obj.acl
+        return self.obj.acl
 
 
     def get_acl_metadata(self):
@@ -274,30 +291,8 @@ class Resource(object):
 
     def get_authorized_actions(self, user):
         """"Get available actions for user according to a group"""
-        # Check permission on the parent container if there's no action
-        # defined at this level
-        acl = self.get_acl()
-        if not acl:
-            from indigo.models import Collection
-            parent_container = Collection.find(self.container)
-            return parent_container.get_authorized_actions(user)
-        actions = set([])
-        for gid in user.groups:
-            if gid in acl:
-                ace = acl[gid]
-                level = acemask_to_str(ace.acemask, True)
-                if level == "read":
-                    actions.add("read")
-                elif level == "write":
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-                elif level == "read/write":
-                    actions.add("read")
-                    actions.add("write")
-                    actions.add("delete")
-                    actions.add("edit")
-        return actions
+        mask = self.get_compiled_acl().mask(user_principals(user))
+        return mask_to_actions(mask)
 
 
     def get_cdmi_metadata(self):
@@ -307,31 +302,20 @@ class Resource(object):
 
 
     def get_checksum(self):
-        if self.is_reference:
+        if self.obj is None:
             return None
-        else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return None
-            return self.obj.checksum
+        return self.obj.checksum
 
 
     def get_create_ts(self):
-        if self.is_reference:
+        if self.obj is None:
             return self.entry.create_ts
-        else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.create_ts
-            return self.obj.create_ts
+        return self.obj.create_ts
 
 
     def get_graph_metadata(self):
         """Return a dictionary of metadata stored in the graph"""
-        session = get_graph_session()
-        result = session.execute_graph(gq_get_metadata_resource(self))
+        result = gq_get_properties('resource', self.uuid)
         return { r['label']:r['value'] 
                  for r in result 
                  if r['label'] not in RESERVED_META
@@ -345,14 +329,9 @@ class Resource(object):
 
 
     def get_metadata(self):
-        if self.is_reference:
+        if self.obj is None:
             return self.entry.metadata
-        else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.metadata
-            return self.obj.metadata
+        return self.obj.metadata
 
 
     def get_metadata_key(self, key):
@@ -366,25 +345,15 @@ class Resource(object):
 #         mimetype = self.resource.get_metadata_key('cdmi_mimetype')
 #         if mimetype:
 #             return mimetype
-        if self.is_reference:
+        if self.obj is None:
             return self.entry.mimetype
-        else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.mimetype
-            return self.obj.mimetype
+        return self.obj.mimetype
 
 
     def get_modified_ts(self):
-        if self.is_reference:
+        if self.obj is None:
             return self.entry.modified_ts
-        else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return self.entry.modified_ts
-            return self.obj.modified_ts
+        return self.obj.modified_ts
 
 
     def get_name(self):
@@ -402,21 +371,32 @@ class Resource(object):
         return self.path
 
 
+    def get_compiled_acl(self):
+        """Return the ACL used for the permission checks, the one inherited
+        from the collection if there's no ACL defined at this level"""
+        acl = self.get_acl()
+        if acl:
+            return CompiledAcl(acl, True)
+        return acl_cache.get_for_objects(self.container)
+
+
+    def get_permissions(self, user):
+        """Return the can_<action> flags of a user, the ACL is resolved once
+        for all the actions"""
+        if user.administrator:
+            return mask_to_dict(~0)
+        return mask_to_dict(self.get_compiled_acl().mask(user_principals(user)))
+
+
     def get_size(self):
-        if self.is_reference:
+        if self.obj is None:
             return 0
-        else:
-            if not self.obj:
-                self.obj = DataObject.find(self.obj_id)
-                if self.obj is None:
-                    return 0
-            return self.obj.size
+        return self.obj.size
 
 
-    def index(self):
+    def index(self, force=False):
         from indigo.models import SearchIndex
-        self.reset()
-        SearchIndex.index(self, ['name', 'metadata'])
+        SearchIndex.index(self, ['name', 'metadata'], force)
 
 
     def mqtt_get_state(self):
@@ -460,8 +440,9 @@ class Resource(object):
 
 
     def reset(self):
-        from indigo.models import SearchIndex
+        from indigo.models import MetadataIndex, SearchIndex
         SearchIndex.reset(self.path)
+        MetadataIndex.update_object(self, self.get_cdmi_metadata(), None)
 
 
     def simple_dict(self, user=None):
@@ -476,10 +457,7 @@ class Resource(object):
             "type": self.get_mimetype(),
         }
         if user:
-            data['can_read'] = self.user_can(user, "read")
-            data['can_write'] = self.user_can(user, "write")
-            data['can_edit'] = self.user_can(user, "edit")
-            data['can_delete'] = self.user_can(user, "delete")
+            data.update(self.get_permissions(user))
         return data
 
 
@@ -489,7 +467,7 @@ class Resource(object):
 
     def update(self, **kwargs):
         """Update a resource"""
-        from indigo.models import Notification
+        from indigo.models import MetadataIndex, Notification
         pre_state = self.mqtt_get_state()
         kwargs['modified_ts'] = datetime.now()
         
@@ -501,7 +479,9 @@ class Resource(object):
             username = None
 
         # Metadata given in cdmi format are transformed to be stored in Cassandra
+        new_metadata = kwargs.get('metadata')
         if 'metadata' in kwargs:
+            old_metadata = self.get_cdmi_metadata()
             self.update_graph(kwargs['metadata'])
             kwargs['metadata'] = meta_cdmi_to_cassandra(kwargs['metadata'])
 
@@ -512,6 +492,8 @@ class Resource(object):
                 self.entry.update(url=kwargs['url'])
                 del kwargs['url']
             self.obj.update(**kwargs)
+        if new_metadata is not None:
+            MetadataIndex.update_object(self, old_metadata, new_metadata)
 
         resc = Resource.find(self.path)
         post_state = resc.mqtt_get_state()
@@ -532,46 +514,18 @@ class Resource(object):
 
 
     def update_acl_list(self, read_access, write_access):
-        """Update the ACL from a cdmi list of ACE"""
+        """Update the ACL from two lists of groups id"""
         if self.is_reference:
-            self.entry.update_entry_acl_cdmi(read_access, write_access)
+            self.entry.update_entry_acl_list(read_access, write_access)
         else:
             if self.obj:
-                self.obj.update_acl_cdmi(read_access, write_access)
+                self.obj.update_acl_list(read_access, write_access)
 
 
     def update_graph(self, metadata):
-        """Get the new metadata and store them in the graph as properties"""
-        session = get_graph_session()
-        gq_resc = gq_get_vertex_resource(self)
-        
-        # old_meta stores the metadata present in the graph before updating
-        old_meta = self.get_graph_metadata()
-        # new_meta stores the set of final metadata we want
-        new_meta = metadata
-        
-        old_meta_keys = set(old_meta.keys())
-        new_meta_keys = set(new_meta.keys())
-        
-        # Delete metadata present in old but not in new
-        for meta_to_delete in old_meta_keys.difference(new_meta_keys):
-            session.execute_graph("""{}.properties('{}').drop()""".format(
-                gq_resc,
-                meta_to_delete))
-        
-        # Update metadata present in both old and new (check if value changed ?)
-        for meta_to_update in old_meta_keys.intersection(new_meta_keys):
-            session.execute_graph("""{}.property('{}', '{}')""".format(
-                gq_resc,
-                meta_to_update,
-                new_meta[meta_to_update]))
-        
-        # Add metadata present in new but not in old
-        for meta_to_add in new_meta_keys.difference(old_meta_keys):
-            session.execute_graph("""{}.property('{}', '{}')""".format(
-                gq_resc,
-                meta_to_add,
-                new_meta[meta_to_add]))
+        """Store the new metadata in the graph as properties, with a single
+        request, return the metadata of the vertex"""
+        return gq_update_properties('resource', self.uuid, metadata)
 
 
     def user_can(self, user, action):
@@ -582,9 +536,6 @@ class Resource(object):
         if user.administrator:
             # An administrator can do anything
             return True
-        actions = self.get_authorized_actions(user)
-        if action in actions:
-            return True
-        return False
+        return self.get_compiled_acl().can(user_principals(user), action)
 
 
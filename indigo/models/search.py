@@ -16,15 +16,105 @@ limitations under the License.
 
 """
 
+from collections import Counter
 from dse.cqlengine import columns
 from dse.cqlengine.models import Model
-import logging
+import heapq
+from itertools import chain
+import json
+import zlib
 
+from indigo import get_config
 from indigo.util import default_uuid
+from indigo.util_cql import (
+    cql_execute,
+    cql_execute_batches,
+    cql_execute_batches_async,
+    cql_execute_concurrent,
+    decode_cursor,
+    encode_cursor,
+)
+
+
+# Terms which are never indexed nor searched
+STOP_WORDS = frozenset(["a", "an", "and",
+                        "the", "of", "is",
+                        "in", "it", "or",
+                        "to"])
+
+# Maximum number of results returned by a search
+SEARCH_LIMIT = 100
+
+# Maximum number of results returned by a type-ahead query
+SUGGEST_LIMIT = 10
+
+# Types of the terms matched by an exact search
+TERM_TYPES = ["metadata", "name"]
+
+# Type of the rows of the prefix index, the term of a row is the prefix of a
+# word (or of a whole name) of the object
+PREFIX_TERM_TYPE = "prefix"
+
+# Length of the shortest prefix in the prefix index
+PREFIX_MIN_LENGTH = 2
+
+# Default number of partitions of each term
+SEARCH_SHARDS = 1
+
+def tokenize(text, full=True):
+    """Return the terms of a text as they are stored in the index: the words
+    separated by spaces, dots or underscores and, with 'full', the whole
+    text. The index and the queries use the same function"""
+    if not text:
+        return []
+    text = text.lower()
+    terms = text.replace('.', ' ').replace('_', ' ').split(' ')
+    if full:
+        terms.append(text)
+    return [term for term in terms
+            if len(term) >= 2 and term not in STOP_WORDS]
+
+
+def prefix_length():
+    """Return the length of the longest prefix in the prefix index, 0 if the
+    prefix index is disabled"""
+    cfg = get_config(None)
+    return cfg.get('SEARCH_PREFIX_LENGTH', 0)
+
+
+def prefixes(term, max_length):
+    """Return the prefixes of a term stored in the prefix index"""
+    return [term[:idx]
+            for idx in xrange(PREFIX_MIN_LENGTH,
+                              min(len(term), max_length) + 1)]
+
+
+def search_shards():
+    """Return the number of partitions each term is split in"""
+    cfg = get_config(None)
+    return cfg.get('SEARCH_SHARDS', SEARCH_SHARDS)
+
+
+def shard_for(object_path, shards):
+    """Return the partition of a term which holds the rows of an object. The
+    hash has to be stable between processes"""
+    if isinstance(object_path, unicode):
+        object_path = object_path.encode('utf-8')
+    return (zlib.crc32(object_path) & 0xffffffff) % shards
+
 
 class SearchIndex(Model):
-    """SearchIndex Model"""
-    term = columns.Text(required=True, primary_key=True)
+    """SearchIndex Model
+
+    The rows of a term are spread over several partitions (term, shard), the
+    shard is a hash of the object path. All the rows of an object are in the
+    same shard of each term, the searches read all the shards in
+    parallel. The table replaces the unsharded search_index table, it's
+    filled by 'iadmin reindex'."""
+    __table_name__ = "search_index_sharded"
+
+    term = columns.Text(required=True, partition_key=True)
+    shard = columns.Integer(required=True, partition_key=True)
     term_type = columns.Text(required=True, primary_key=True)
     object_path = columns.Text(required=True, primary_key=True)
     object_type = columns.Text(required=True)
@@ -34,6 +124,8 @@ class SearchIndex(Model):
     def create(cls, **kwargs):
         """Create a new indexed term"""
         from indigo.models import IDSearch
+        if 'shard' not in kwargs:
+            kwargs['shard'] = shard_for(kwargs['object_path'], search_shards())
         idx = super(SearchIndex, cls).create(**kwargs)
 
         # Create a row in the ID search table
@@ -43,105 +135,170 @@ class SearchIndex(Model):
         return idx
     
     @classmethod
-    def find(cls, termstrings, user):
-        from indigo.models.collection import Collection
-        from indigo.models.resource import Resource
+    def find(cls, termstrings, user, limit=None, cursor=None, prefix=False):
+        """Search the objects which match a list of terms, return the
+        dictionaries of the ones the user can read, best first. All of them
+        are returned unless a 'limit' is given (see find_page())"""
+        if limit is None:
+            keys = sorted(cls._ranking_keys(termstrings, prefix, cursor))
+            return [result_obj for _, result_obj in cls._hydrate(keys, user)]
+        return cls.find_page(termstrings, user, limit, cursor, prefix)[0]
+
+    @classmethod
+    def find_metadata(cls, key, user, value=None, path=None, limit=None):
+        """Return the dictionaries of the objects the user can read which
+        have the metadata 'key', with the value 'value' if it's given, and
+        which are below 'path' if it's given, sorted by path. The objects
+        are looked up in the metadata index and loaded by slices of 'limit'
+        until it's reached"""
+        from indigo.models.metadata_index import MetadataIndex
+        if limit is not None and limit < 1:
+            raise ValueError(u"Invalid limit '{}'".format(limit))
+        keys = [(-1, obj_path, obj_type)
+                for obj_path, obj_type in MetadataIndex.find(key, value, path)]
+        if limit is None:
+            return [result_obj for _, result_obj in cls._hydrate(keys, user)]
+        found = []
+        while keys and len(found) < limit:
+            found.extend(cls._hydrate(keys[:limit], user))
+            keys = keys[limit:]
+        return [result_obj for _, result_obj in found[:limit]]
+
+    @classmethod
+    def find_page(cls, termstrings, user, limit=SEARCH_LIMIT, cursor=None,
+                  prefix=False):
+        """Search the objects which match a list of terms, return a page of
+        the dictionaries of the objects the user can read and the cursor of
+        the next page (None for the last one).
+
+        The query goes through the tokenizer of the index, the terms are read
+        in parallel and each object path is scored with the number of rows
+        which match. The results are ordered by score then path, the best
+        ones after the cursor are selected with a heap and loaded with bulk
+        reads, by slices of 'limit', until the page is full. With 'prefix'
+        the words of the query are prefixes (see score())"""
+        if limit < 1:
+            raise ValueError(u"Invalid limit '{}'".format(limit))
+        keys = cls._ranking_keys(termstrings, prefix, cursor)
+        if not keys:
+            return [], None
+        last_key = max(keys)
 
-        def get_object(obj, user):
-            """Return the object corresponding to the SearchIndex object"""
-            if obj.object_type == 'Collection':
-                result_obj = Collection.find(obj.object_path)
-                if not result_obj or not result_obj.user_can(user, "read"):
-                    return None
-                result_obj = result_obj.to_dict(user)
-                result_obj['result_type'] = 'Collection'
-                return result_obj
-            elif obj.object_type == 'Resource':
-                result_obj = Resource.find(obj.object_path)
-                # Check the resource's collection for read permission
-                if not result_obj or not result_obj.user_can(user, "read"):
-                    return None
-                result_obj = result_obj.to_dict(user)
-                result_obj['result_type'] = 'Resource'
-                return result_obj
+        found = []
+        while keys and len(found) < limit:
+            best = heapq.nsmallest(limit, keys)
+            found.extend(cls._hydrate(best, user))
+            keys = [key for key in keys if key > best[-1]]
+        found = found[:limit]
+        next_cursor = None
+        if len(found) == limit and found[-1][0] < last_key:
+            next_cursor = encode_cursor(json.dumps(found[-1][0]))
+        return [result_obj for _, result_obj in found], next_cursor
+
+    @classmethod
+    def _decode_cursor(cls, cursor):
+        """Return the ranking key of the last result of the previous page"""
+        if not cursor:
             return None
+        try:
+            count, path, obj_type = json.loads(decode_cursor(cursor))
+        except (TypeError, ValueError):
+            raise ValueError(u"Invalid cursor '{}'".format(cursor))
+        return (count, path, obj_type)
 
-        result_objects = []
-        for t in termstrings:
-            if cls.is_stop_word(t):
-                continue
-            result_objects.extend(cls.objects.filter(term=t).all())
+    @classmethod
+    def _ranking_keys(cls, termstrings, prefix=False, cursor=None):
+        """Return the ranking keys (-score, path, type) of the objects which
+        match a list of terms, after the cursor"""
+        scores = cls.score(termstrings, prefix)
+        keys = [(-count, path, obj_type)
+                for (path, obj_type), count in scores.iteritems()]
+        after = cls._decode_cursor(cursor)
+        if after:
+            keys = [key for key in keys if key > after]
+        return keys
 
+    @classmethod
+    def _hydrate(cls, keys, user):
+        """Return the (key, dictionary) couples of the objects of a list of
+        ranking keys which the user can read, in the same order"""
+        from indigo.models.acl import user_principals
+        from indigo.models.collection import Collection
+        from indigo.models.resource import Resource
+        coll_paths = [path for _, path, obj_type in keys
+                      if obj_type == 'Collection']
+        resc_paths = [path for _, path, obj_type in keys
+                      if obj_type == 'Resource']
+        objects = {}
+        objects.update(zip([(path, 'Collection') for path in coll_paths],
+                           Collection.find_many(coll_paths)))
+        objects.update(zip([(path, 'Resource') for path in resc_paths],
+                           Resource.find_many(resc_paths, load_objects=True)))
+        # The effective ACL are resolved by the ACL cache, the groups of the
+        # user are computed once
+        principals = None if user.administrator else user_principals(user)
         results = []
-        for result in result_objects:
-            try:
-                results.append(get_object(result, user))
-            except AttributeError:
-                logging.warning(u"Problem with SearchIndex('{}','{}','{}','{}')".format(
-                                result.uuid,
-                                result.term,
-                                result.object_type,
-                                result.uuid))
-        results = [x for x in results if x]
-
-        # Do some sane ordering here to group together by ID and
-        # order by frequency. Add the hit_count to the object dictionary
-        # and then we can order on that
-        keys = set(r['id'] for r in results)
-
-        result_list = []
-        for k in keys:
-            # get each element with this key, count them, store the hit
-            # count and only add one to results
-            matches = [x for x in results if x['id'] == k]
-            match = matches[0]
-            match['hit_count'] = len(matches)
-            result_list.append(match)
-
-        return sorted(result_list,
-                      key=lambda res: res.get('hit_count', 0),
-                      reverse=True)
+        for key in keys:
+            neg_count, path, obj_type = key
+            obj = objects.get((path, obj_type))
+            if obj is None:
+                # The index isn't up to date
+                continue
+            if (principals is not None and
+                    not obj.get_compiled_acl().can(principals, "read")):
+                continue
+            result_obj = obj.to_dict(user)
+            result_obj['result_type'] = obj_type
+            result_obj['hit_count'] = -neg_count
+            results.append((key, result_obj))
+        return results
 
     @classmethod
     def is_stop_word(cls, term):
         """Check if a term is a stop word"""
-        return term in ["a", "an", "and",
-                        "the", "of", "is",
-                        "in", "it", "or",
-                        "to"]
+        return term in STOP_WORDS
+
+    @classmethod
+    def reset_all(cls):
+        """Empty the index tables, before the whole tree is indexed again"""
+        cql_execute(u"TRUNCATE {keyspace}.search_index_sharded")
+        cql_execute(u"TRUNCATE {keyspace}.idsearch")
 
     @classmethod
     def reset(cls, object_path):
         """Delete objects from the SearchIndex"""
-        from indigo.models import IDSearch
-        rows = IDSearch.find(object_path)
-        for id_obj in rows:
-            obj = cls.objects.filter(term=id_obj.term,
-                                     term_type=id_obj.term_type,
-                                     object_path=id_obj.object_path).first()
-            if obj:
-                obj.delete()
-            id_obj.delete()
-
-    @classmethod
-    def index(cls, object, fields=['name']):
-        """Index"""
-        result_count = 0
-
-        def clean(t):
-            """Clean a term"""
-            if t:
-                return t.lower().replace('.', ' ').replace('_', ' ').split(' ')
-            else:
-                return []
+        cls.reset_many([object_path])
 
-        def clean_full(t):
-            """Clean a term but keep all chars"""
-            if t:
-                return t.lower()
-            else:
-                return ""
+    @classmethod
+    def reset_many(cls, object_paths):
+        """Delete a list of objects from the SearchIndex. The terms are read
+        from IDSearch in parallel and the rows are deleted with one batch
+        per partition"""
+        object_paths = list(object_paths)
+        if not object_paths:
+            return
+        results = cql_execute_concurrent(u"""SELECT term, term_type
+            FROM {keyspace}.idsearch WHERE object_path=?""",
+                                         [(path,) for path in object_paths])
+        shards = search_shards()
+        by_partition = {}
+        for path, rows in zip(object_paths, results):
+            shard = shard_for(path, shards)
+            for row in rows:
+                by_partition.setdefault((row['term'], shard), []).append(
+                    (row['term'], shard, row['term_type'], path))
+        cql_execute_batches(u"""DELETE FROM {keyspace}.search_index_sharded
+            WHERE term=? and shard=? and term_type=? and object_path=?""",
+                            by_partition.values())
+        cql_execute_concurrent(u"""DELETE FROM {keyspace}.idsearch
+            WHERE object_path=?""",
+                               [(path,) for path in object_paths])
 
+    @classmethod
+    def get_terms(cls, object, fields=('name',)):
+        """Return the set of (term_type, term) couples indexed for an
+        object"""
+        fields = list(fields)
         terms = []
         if 'metadata' in fields:
             metadata = object.get_cdmi_metadata()
@@ -151,33 +308,187 @@ class SearchIndex(Model):
                 # A value can be a string or a list of string
                 if isinstance(v, list):
                     for vv in v:
-                        terms.extend([('metadata', el) for el in clean(vv.strip())])
+                        terms.extend([('metadata', el)
+                                      for el in tokenize(vv.strip(), False)])
                 else:
-                    terms.extend([('metadata', el) for el in clean(v.strip())])
+                    terms.extend([('metadata', el)
+                                  for el in tokenize(v.strip(), False)])
             fields.remove('metadata')
         for f in fields:
             attr = getattr(object, f)
             if isinstance(attr, dict):
                 for k, v in attr.iteritems():
-                    terms.extend([(f, el) for el in clean(v.strip())])
-                    terms.append((f, clean_full(v.strip())))
+                    terms.extend([(f, el) for el in tokenize(v.strip())])
+            else:
+                terms.extend([(f, el) for el in tokenize(attr)])
+        max_length = prefix_length()
+        if max_length:
+            for term in set([term for _, term in terms]):
+                terms.extend([(PREFIX_TERM_TYPE, el)
+                              for el in prefixes(term, max_length)])
+        return set(terms)
+
+    @classmethod
+    def score(cls, termstrings, prefix=False):
+        """Return a Counter of the number of terms matched by each
+        (object_path, object_type), the terms are read in parallel.
+
+        With 'prefix' each word of the query is looked up in the prefix
+        index, the objects must match all of them. The candidate sets are
+        intersected and the exact matches rank first. For the words longer
+        than the indexed prefixes the terms of the candidates are checked
+        against the whole word"""
+        terms = set()
+        for termstring in termstrings:
+            terms.update(tokenize(termstring))
+        scores = Counter()
+        if not terms:
+            return scores
+        results = cls._read_shards(u"""SELECT object_path, object_type
+            FROM {keyspace}.search_index_sharded
+            WHERE term=? and shard=? and term_type IN ?""",
+                                   terms, TERM_TYPES)
+        for rows in results:
+            for row in rows:
+                scores[(row['object_path'], row['object_type'])] += 1
+        max_length = prefix_length()
+        if not prefix or not max_length:
+            return scores
+
+        words = set()
+        for termstring in termstrings:
+            words.update(tokenize(termstring, False))
+        if not words:
+            return scores
+        indexed = set([word[:max_length] for word in words])
+        results = cls._read_shards(u"""SELECT object_path, object_type
+            FROM {keyspace}.search_index_sharded
+            WHERE term=? and shard=? and term_type=?""",
+                                   indexed, PREFIX_TERM_TYPE)
+        candidates = None
+        for rows in results:
+            keys = set([(row['object_path'], row['object_type'])
+                        for row in rows])
+            if candidates is None:
+                candidates = keys
             else:
-                terms.extend([(f, el) for el in clean(attr)])
-                terms.append((f, clean_full(attr)))
-        
+                candidates &= keys
+        long_words = [word for word in words if len(word) > max_length]
+        if long_words and candidates:
+            candidates = cls._match_words(candidates, long_words)
+        return Counter(dict([(key, len(indexed) + scores[key])
+                             for key in candidates or ()]))
+
+    @classmethod
+    def _match_words(cls, candidates, words):
+        """Return the candidates (object_path, object_type) which have, for
+        each word, an indexed term which starts with it. The prefix index
+        only holds the first characters of the long words so their
+        candidates are checked against their terms in IDSearch"""
+        candidates = list(candidates)
+        results = cql_execute_concurrent(u"""SELECT term, term_type
+            FROM {keyspace}.idsearch WHERE object_path=?""",
+                                         [(path,) for path, _ in candidates])
+        res = set()
+        for key, rows in zip(candidates, results):
+            terms = [row['term'] for row in rows
+                     if row['term_type'] in TERM_TYPES]
+            if all(any(term.startswith(word) for term in terms)
+                   for word in words):
+                res.add(key)
+        return res
+
+    @classmethod
+    def _read_shards(cls, query, terms, *parameters):
+        """Execute a query on all the shards of a list of terms in parallel,
+        the query is bound with the term, the shard and 'parameters'. Return
+        the list of the rows of each term"""
+        terms = list(terms)
+        shards = search_shards()
+        results = cql_execute_concurrent(query,
+                                         [(term, shard) + parameters
+                                          for term in terms
+                                          for shard in xrange(shards)])
+        return [list(chain(*results[idx * shards:(idx + 1) * shards]))
+                for idx in xrange(len(terms))]
 
+    @classmethod
+    def suggest(cls, text, user, limit=SUGGEST_LIMIT):
+        """Return the dictionaries of the objects the user can read which have
+        a word or a name starting with 'text', for type-ahead. The objects
+        are read from a single term of the prefix index, its shards are read
+        in parallel"""
+        max_length = prefix_length()
+        text = (text or u"").strip().lower()[:max_length]
+        if len(text) < PREFIX_MIN_LENGTH:
+            return []
+        rows = cls._read_shards(u"""SELECT object_path, object_type
+            FROM {keyspace}.search_index_sharded
+            WHERE term=? and shard=? and term_type=? LIMIT ?""",
+                                [text], PREFIX_TERM_TYPE, limit)[0]
+        keys = [(-1, row['object_path'], row['object_type'])
+                for row in rows[:limit]]
+        return [result_obj for _, result_obj in cls._hydrate(keys, user)]
+
+    @classmethod
+    def index(cls, object, fields=('name',), force=False):
+        """Index an object, return the number of terms.
+
+        The terms already indexed are read from IDSearch, only the rows of
+        the terms which changed are inserted or deleted. With 'force' all
+        the terms are written again, which repairs missing rows. The writes are sent
+        in parallel as unlogged batches, one per partition, the first error
+        is raised once all the replies are received so the caller knows the
+        object has to be indexed again"""
+        path = object.path
         object_type = object.__class__.__name__
-        for term_type, term in terms:
-            if cls.is_stop_word(term):
-                continue
-            if len(term) < 2:
-                continue
-            SearchIndex.create(term=term,
-                                term_type=term_type,
-                                object_type=object_type,
-                                object_path=object.path)
-            result_count += 1
-        return result_count
+        terms = cls.get_terms(object, fields)
+        rows = cql_execute(u"""SELECT term, term_type FROM {keyspace}.idsearch
+            WHERE object_path=?""", (path,))
+        current = set([(row['term_type'], row['term']) for row in rows])
+        removed = current - terms
+        added = terms if force else terms - current
+
+        # All the rows of the object are in the same shard of each term
+        shard = shard_for(path, search_shards())
+        futures = []
+        if removed:
+            by_term = {}
+            for term_type, term in removed:
+                by_term.setdefault(term, []).append(
+                    (term, shard, term_type, path))
+            futures.extend(cql_execute_batches_async(u"""DELETE FROM
+                {keyspace}.search_index_sharded
+                WHERE term=? and shard=? and term_type=? and object_path=?""",
+                                                     by_term.values()))
+            futures.extend(cql_execute_batches_async(u"""DELETE FROM
+                {keyspace}.idsearch
+                WHERE object_path=? and term=? and term_type=?""",
+                                                     [[(path, term, term_type)
+                                                       for term_type, term in removed]]))
+        if added:
+            by_term = {}
+            for term_type, term in added:
+                by_term.setdefault(term, []).append(
+                    (term, shard, term_type, path, object_type,
+                     default_uuid()))
+            futures.extend(cql_execute_batches_async(u"""INSERT INTO
+                {keyspace}.search_index_sharded
+                (term, shard, term_type, object_path, object_type, uuid)
+                VALUES (?, ?, ?, ?, ?, ?)""", by_term.values()))
+            futures.extend(cql_execute_batches_async(u"""INSERT INTO
+                {keyspace}.idsearch (object_path, term, term_type)
+                VALUES (?, ?, ?)""", [[(path, term, term_type)
+                                       for term_type, term in added]]))
+        error = None
+        for future in futures:
+            try:
+                future.result()
+            except Exception as exc:
+                error = error or exc
+        if error is not None:
+            raise error
+        return len(terms)
 
     def __unicode__(self):
         return unicode("".format(self.term, self.object_type))
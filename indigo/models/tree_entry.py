@@ -17,12 +17,12 @@ limitations under the License.
 """
 
 from dse.cqlengine.models import Model
-from dse.query import SimpleStatement
-from dse.cqlengine import (
-    columns,
-    connection
-)
+from dse.cqlengine import columns
 from datetime import datetime
+import struct
+import threading
+import time
+import zlib
 
 from indigo import get_config
 from indigo.util import (
@@ -33,10 +33,20 @@ from indigo.util import (
 from indigo.models import (
     Group
 )
+from indigo.util_cql import (
+    cql_bind,
+    cql_execute,
+    cql_execute_batches,
+    cql_execute_concurrent,
+    decode_cursor,
+    encode_cursor,
+    get_session,
+)
 from indigo.models.acl import (
     Ace,
-    acl_cdmi_to_cql,
-    acl_list_to_cql,
+    acl_cache,
+    acl_cdmi_to_map,
+    acl_list_to_map,
     cdmi_str_to_aceflag,
     cdmi_str_to_acemask,
     str_to_acemask,
@@ -46,9 +56,136 @@ static_fields = ["container_metadata",
                  "container_uuid",
                  "container_create_ts",
                  "container_modified_ts",
-                 "container_acl"]
+                 "container_acl",
+                 "container_buckets"]
+
+# Columns of a single entry, they are the same in both layouts
+entry_fields = ["metadata",
+                "create_ts",
+                "modified_ts",
+                "acl",
+                "mimetype",
+                "url",
+                "uuid"]
+
+# Maximum number of names in the IN clause of a single bulk read
+FIND_MANY_BATCH = 100
+
+# Number of rows fetched in a single page when we list a container
+NAMES_PAGE_SIZE = 1000
+
+# Number of seconds the number of buckets of a container is kept in memory
+BUCKETS_CACHE_TTL = 60
+
+# container -> (number of buckets, expiry time)
+_buckets_cache = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(name, buckets):
+    """Return the bucket of an entry in a container split in 'buckets'
+    buckets. The hash has to be stable between processes."""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % buckets
+
+
+def default_buckets():
+    """Return the number of buckets for new containers (0 for the
+    single partition layout)"""
+    cfg = get_config(None)
+    return cfg.get('TREE_ENTRY_BUCKETS', 0)
+
+
+class EntryMixin(object):
+    """Methods for the rows which describe a single entry of a container,
+    whatever the table which stores them"""
+
+    # Table and primary key of the entries
+    entry_table = u"tree_entry"
+    entry_key = ("container", "name")
+
+
+    def _entry_values(self):
+        """Return the values of the primary key of the entry"""
+        return [getattr(self, col) for col in self.entry_key]
+
+
+    @classmethod
+    def _entry_where(cls, marker):
+        """Return the where condition which selects an entry"""
+        return u" and ".join([u"{}={}".format(col, marker)
+                              for col in cls.entry_key])
+
+
+    def create_entry_acl(self, acl):
+        """Replace the acl with the given ACL map
+        """
+        cql_execute(u"""UPDATE {keyspace}.{table} SET acl=?
+            WHERE {where}""",
+                    [acl] + self._entry_values(),
+                    table=self.entry_table,
+                    where=self._entry_where(u"?"))
+
+
+    def create_entry_acl_list(self, read_access, write_access):
+        """""Create entry ACL from  lists of group uuids"""
+        acl = acl_list_to_map(read_access, write_access)
+        self.create_entry_acl(acl)
 
-class TreeEntry(Model):
+
+    def create_entry_acl_cdmi(self, cdmi_acl):
+        """""Create entry ACL from a cdmi object (list of dict)"""
+        acl = acl_cdmi_to_map(cdmi_acl)
+        self.create_entry_acl(acl)
+
+
+    def path(self):
+        """Get the full path of the specific entry"""
+        return merge(self.container, self.name)
+
+
+    def update(self, **kwargs):
+        """Update an entry
+
+        All the columns are written with a single statement, prepared once
+        for each set of column names"""
+        if not kwargs:
+            return self
+        columns = sorted(kwargs)
+        values = [kwargs[arg] for arg in columns]
+        assignments = u", ".join([u"{}=?".format(arg) for arg in columns])
+        cql_execute(u"""UPDATE {keyspace}.{table} SET {assignments}
+            WHERE {where}""",
+                    values + self._entry_values(),
+                    table=self.entry_table,
+                    assignments=assignments,
+                    where=self._entry_where(u"?"))
+        return self
+
+
+    def update_entry_acl(self, acl):
+        """Update the acl with the given ACL map"""
+        cql_execute(u"""UPDATE {keyspace}.{table} SET acl=acl+?
+            WHERE {where}""",
+                    [acl] + self._entry_values(),
+                    table=self.entry_table,
+                    where=self._entry_where(u"?"))
+
+
+    def update_entry_acl_list(self, read_access, write_access):
+        """"Update entry ACL from  lists of group uuids"""
+        acl = acl_list_to_map(read_access, write_access)
+        self.update_entry_acl(acl)
+
+
+    def update_entry_acl_cdmi(self, cdmi_acl):
+        """"Update entry ACL from a cdmi object (list of dict)"""
+        acl = acl_cdmi_to_map(cdmi_acl)
+        self.update_entry_acl(acl)
+
+
+class TreeEntry(EntryMixin, Model):
     """TreeEntry model"""
 
     # Partitioned by container, clustered by name, so all files for a directory
@@ -75,6 +212,11 @@ class TreeEntry(Model):
     container_modified_ts = columns.DateTime(static=True)
     container_acl = columns.Map(columns.Text, columns.UserDefinedType(Ace),
                                 static=True)
+    # Very large directories can be split in several partitions, the entries
+    # are then stored in the tree_entry_bucket table and only the header row
+    # (name '.') stays here (see TreeEntryBucket). 0 or null for a directory
+    # stored in a single partition.
+    container_buckets = columns.Integer(static=True)
 
     # This is the actual directory entry per-se, i.e. unique per name....
     # As with a conventional filesystem this is simply a reference to the 'real'
@@ -96,6 +238,64 @@ class TreeEntry(Model):
         self.create_container_acl_list(["AUTHENTICATED@"], [])
 
 
+    @classmethod
+    def bucketize(cls, container, buckets):
+        """Move the entries of a container stored in a single partition to
+        'buckets' buckets in the tree_entry_bucket table. Return the number
+        of entries moved.
+
+        The entries are copied, the header is switched to the new layout and
+        the old rows are copied again (to get the entries added in the
+        meantime) and deleted. The number of buckets is cached by the other
+        processes for BUCKETS_CACHE_TTL seconds, the container shouldn't be
+        modified while it's migrated."""
+        if cls.get_buckets(container):
+            return 0
+        cls._copy_to_buckets(container, buckets, False)
+        cql_execute(u"""UPDATE {keyspace}.tree_entry SET container_buckets=?
+            WHERE container=?""", (buckets, container))
+        with _buckets_lock:
+            _buckets_cache.pop(container, None)
+        return cls._copy_to_buckets(container, buckets, True)
+
+
+    @classmethod
+    def _copy_to_buckets(cls, container, buckets, delete):
+        """Copy the entries of a single partition container to the bucket
+        table, a page at a time, and delete them if 'delete' is True"""
+        session = get_session()
+        stmt = cql_bind(u"""SELECT name, {columns} FROM {keyspace}.tree_entry
+            WHERE container=?""",
+                        (container,),
+                        columns=u", ".join(entry_fields))
+        stmt.fetch_size = NAMES_PAGE_SIZE
+        rows = session.execute(stmt)
+        count = 0
+        while True:
+            page = [row for row in rows.current_rows if row['name'] != '.']
+            if page:
+                cql_execute_concurrent(u"""INSERT INTO {keyspace}.tree_entry_bucket
+                    (container, bucket, name, {columns})
+                    VALUES (?, ?, ?, {markers})""",
+                                       [[container,
+                                         bucket_for(row['name'], buckets),
+                                         row['name']] +
+                                        [row[col] for col in entry_fields]
+                                        for row in page],
+                                       columns=u", ".join(entry_fields),
+                                       markers=u", ".join([u"?"] * len(entry_fields)))
+                if delete:
+                    cql_execute_concurrent(u"""DELETE FROM {keyspace}.tree_entry
+                        WHERE container=? and name=?""",
+                                           [(container, row['name'])
+                                            for row in page])
+                count += len(page)
+            if not rows.has_more_pages:
+                break
+            rows.fetch_next_page()
+        return count
+
+
     @classmethod
     def create(cls, **kwargs):
         """Create"""
@@ -104,124 +304,337 @@ class TreeEntry(Model):
 #             metadata["cdmi_mimetype"] = kwargs["mimetype"]
 #             kwargs['metadata'] = meta_cdmi_to_cassandra(metadata)
 #             del kwargs['mimetype']
+        if kwargs.get('name') == '.':
+            # Header of a new container
+            if 'container_buckets' not in kwargs and default_buckets():
+                kwargs['container_buckets'] = default_buckets()
+            new = super(TreeEntry, cls).create(**kwargs)
+            with _buckets_lock:
+                _buckets_cache[new.container] = (
+                    new.container_buckets or 0,
+                    time.time() + BUCKETS_CACHE_TTL)
+            return new
+        buckets = cls.get_buckets(kwargs['container'])
+        if buckets:
+            kwargs['bucket'] = bucket_for(kwargs['name'], buckets)
+            return TreeEntryBucket.create(**kwargs)
         new = super(TreeEntry, cls).create(**kwargs)
         return new
 
 
-    def create_container_acl(self, acl_cql):
-        """Replace the static acl with the given cql string
+    def create_container_acl(self, acl):
+        """Replace the static acl with the given ACL map
         """
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET container_acl={} 
-            WHERE container=%s""".format(acl_cql))
-        session.execute(query, (self.container,))
+        cql_execute(u"""UPDATE {keyspace}.tree_entry SET container_acl=?
+            WHERE container=?""", (acl, self.container))
+        acl_cache.invalidate(self.container)
 
 
     def create_container_acl_cdmi(self, cdmi_acl):
         """""Create static ACL from a cdmi object (list of dict)"""
-        cql_string = acl_cdmi_to_cql(cdmi_acl)
-        self.create_container_acl(cql_string)
+        acl = acl_cdmi_to_map(cdmi_acl)
+        self.create_container_acl(acl)
 
 
     def create_container_acl_list(self, read_access, write_access):
         """""Create static ACL from  lists of group uuids"""
-        cql_string = acl_list_to_cql(read_access, write_access)
-        self.create_container_acl(cql_string)
+        acl = acl_list_to_map(read_access, write_access)
+        self.create_container_acl(acl)
 
 
-    def create_entry_acl(self, acl_cql):
-        """Replace the acl with the given cql string
-        """
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET acl={} 
-            WHERE container=%s and name=%s""".format(acl_cql))
-        session.execute(query, (self.container, self.name,))
+    @classmethod
+    def delete_container(cls, container):
+        """Delete all the rows of a container, in all its buckets"""
+        buckets = cls.get_buckets(container)
+        cql_execute(u"""DELETE FROM {keyspace}.tree_entry WHERE container=?""",
+                    (container,))
+        if buckets:
+            cql_execute_concurrent(u"""DELETE FROM {keyspace}.tree_entry_bucket
+                WHERE container=? and bucket=?""",
+                                   [(container, bucket)
+                                    for bucket in xrange(buckets)])
+        with _buckets_lock:
+            _buckets_cache.pop(container, None)
+        acl_cache.invalidate(container)
 
 
-    def create_entry_acl_list(self, read_access, write_access):
-        """""Create entry ACL from  lists of group uuids"""
-        cql_string = acl_list_to_cql(read_access, write_access)
-        self.create_entry_acl(cql_string)
+    @classmethod
+    def delete_entries(cls, container, names):
+        """Delete a list of entries of a container, whatever its layout"""
+        buckets = cls.get_buckets(container)
+        by_partition = {}
+        for name in names:
+            if buckets:
+                partition = (container, bucket_for(name, buckets))
+            else:
+                partition = (container,)
+            by_partition.setdefault(partition, []).append(name)
+        params = []
+        bucket_params = []
+        for partition, names in by_partition.iteritems():
+            for idx in xrange(0, len(names), FIND_MANY_BATCH):
+                key = list(partition) + [names[idx:idx + FIND_MANY_BATCH]]
+                if len(partition) == 1:
+                    params.append(key)
+                else:
+                    bucket_params.append(key)
+        if params:
+            cql_execute_concurrent(u"""DELETE FROM {keyspace}.tree_entry
+                WHERE container=? and name IN ?""", params)
+        if bucket_params:
+            cql_execute_concurrent(u"""DELETE FROM {keyspace}.tree_entry_bucket
+                WHERE container=? and bucket=? and name IN ?""", bucket_params)
 
 
-    def create_entry_acl_cdmi(self, cdmi_acl):
-        """""Create entry ACL from a cdmi object (list of dict)"""
-        cql_string = acl_cdmi_to_cql(cdmi_acl)
-        self.create_entry_acl(cql_string)
+    @classmethod
+    def find_entry(cls, container, name):
+        """Find the entry 'name' of a container, whatever its layout"""
+        buckets = cls.get_buckets(container)
+        if buckets:
+            return TreeEntryBucket.objects.filter(
+                container=container,
+                bucket=bucket_for(name, buckets),
+                name=name).first()
+        return cls.objects.filter(container=container, name=name).first()
 
 
-    def path(self):
-        """Get the full path of the specific entry"""
-        return merge(self.container, self.name)
+    @classmethod
+    def find_many(cls, keys):
+        """Find a list of entries from a list of (container, name) couples.
+
+        The names are grouped by partition (the container, and the bucket
+        for bucketed containers) and the reads are sent asynchronously.
+        Return a dictionary indexed by the (container, name) couples found"""
+        keys = list(keys)
+        buckets = cls.get_buckets_many(set([container for container, name in keys
+                                            if name != '.']))
+        by_partition = {}
+        for container, name in keys:
+            if name != '.' and buckets.get(container):
+                partition = (container, bucket_for(name, buckets[container]))
+            else:
+                partition = (container,)
+            names = by_partition.setdefault(partition, [])
+            if name not in names:
+                names.append(name)
+        params = []
+        bucket_params = []
+        for partition, names in by_partition.iteritems():
+            for idx in xrange(0, len(names), FIND_MANY_BATCH):
+                key = list(partition) + [names[idx:idx + FIND_MANY_BATCH]]
+                if len(partition) == 1:
+                    params.append(key)
+                else:
+                    bucket_params.append(key)
+        entries = {}
+        if params:
+            results = cql_execute_concurrent(u"""SELECT * FROM {keyspace}.tree_entry
+                WHERE container=? and name IN ?""", params)
+            for rows in results:
+                for row in rows:
+                    entry = cls(**row)
+                    entries[(entry.container, entry.name)] = entry
+        if bucket_params:
+            results = cql_execute_concurrent(u"""SELECT * FROM {keyspace}.tree_entry_bucket
+                WHERE container=? and bucket=? and name IN ?""", bucket_params)
+            for rows in results:
+                for row in rows:
+                    entry = TreeEntryBucket(**row)
+                    entries[(entry.container, entry.name)] = entry
+        return entries
 
 
-    def update(self, **kwargs):
-        """Update a collection"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        for arg in kwargs:
-            # For static fields we can't use the name in the where condition
-            if arg in static_fields:
-                query = SimpleStatement(u"""UPDATE tree_entry SET {}=%s
-                    WHERE container=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.container))
-            else:
-                query = SimpleStatement(u"""UPDATE tree_entry SET {}=%s
-                    WHERE container=%s and name=%s""".format(arg))
-                session.execute(query, (kwargs[arg], self.container, self.name))
-        return self
+    @classmethod
+    def get_buckets(cls, container):
+        """Return the number of buckets of a container, 0 if it's stored in
+        a single partition"""
+        return cls.get_buckets_many([container]).get(container, 0)
+
+
+    @classmethod
+    def get_buckets_many(cls, containers):
+        """Return a dictionary with the number of buckets of a list of
+        containers. The values are read from the header rows and cached for
+        the existing containers"""
+        now = time.time()
+        res = {}
+        missing = []
+        with _buckets_lock:
+            for container in containers:
+                cached = _buckets_cache.get(container)
+                if cached and cached[1] > now:
+                    res[container] = cached[0]
+                else:
+                    missing.append(container)
+        if not missing:
+            return res
+        results = cql_execute_concurrent(u"""SELECT DISTINCT container, container_buckets
+            FROM {keyspace}.tree_entry WHERE container=?""",
+                                         [(container,) for container in missing])
+        with _buckets_lock:
+            for container, rows in zip(missing, results):
+                res[container] = 0
+                for row in rows:
+                    # Only existing containers are cached, a container
+                    # created by another process is seen straight away
+                    res[container] = row['container_buckets'] or 0
+                    _buckets_cache[container] = (res[container],
+                                                 now + BUCKETS_CACHE_TTL)
+        return res
+
+
+    @classmethod
+    def get_names_page(cls, container, cursor=None, page_size=NAMES_PAGE_SIZE):
+        """Return a page of the names stored in a container and the cursor for
+        the next page (None for the last one). The header row ('.') is
+        included for containers stored in a single partition.
+
+        Bucketed containers are read one bucket after the other, the cursor
+        holds the bucket number in front of the driver's paging state"""
+        session = get_session()
+        paging_state = decode_cursor(cursor)
+        buckets = cls.get_buckets(container)
+        if not buckets:
+            stmt = cql_bind(u"""SELECT name FROM {keyspace}.tree_entry
+                WHERE container=?""", (container,))
+            stmt.fetch_size = page_size
+            rows = session.execute(stmt, paging_state=paging_state)
+            return ([row['name'] for row in rows.current_rows],
+                    encode_cursor(rows.paging_state))
+        bucket = 0
+        if paging_state:
+            bucket = struct.unpack("!H", paging_state[:2])[0]
+            paging_state = paging_state[2:] or None
+        stmt = cql_bind(u"""SELECT name FROM {keyspace}.tree_entry_bucket
+            WHERE container=? and bucket=?""", (container, bucket))
+        stmt.fetch_size = page_size
+        rows = session.execute(stmt, paging_state=paging_state)
+        names = [row['name'] for row in rows.current_rows]
+        if rows.paging_state:
+            next_state = struct.pack("!H", bucket) + rows.paging_state
+        elif bucket + 1 < buckets:
+            next_state = struct.pack("!H", bucket + 1)
+        else:
+            next_state = None
+        return (names, encode_cursor(next_state))
 
 
-    def update_container_acl(self, acl_cql):
-        """Update the static acl with the given cql string"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET container_acl=container_acl+{} 
-            WHERE container=%s""".format(acl_cql))
-        session.execute(query, (self.container,))
+    @classmethod
+    def iter_names(cls, container, page_size=NAMES_PAGE_SIZE):
+        """Generator which yields the names stored in a container, a page at a
+        time. The header row ('.') is included for containers stored in a
+        single partition. The first pages of all the buckets of a bucketed
+        container are requested in parallel"""
+        buckets = cls.get_buckets(container)
+        if not buckets:
+            stmt = cql_bind(u"""SELECT name FROM {keyspace}.tree_entry
+                WHERE container=?""", (container,))
+            stmt.fetch_size = page_size
+            for row in get_session().execute(stmt):
+                yield row['name']
+            return
+        futures = []
+        for bucket in xrange(buckets):
+            stmt = cql_bind(u"""SELECT name FROM {keyspace}.tree_entry_bucket
+                WHERE container=? and bucket=?""", (container, bucket))
+            stmt.fetch_size = page_size
+            futures.append(get_session().execute_async(stmt))
+        for future in futures:
+            for row in future.result():
+                yield row['name']
+
+
+    @classmethod
+    def set_container_acl_many(cls, containers, acl):
+        """Replace the static acl of a list of containers with the same ACL
+        map, with one asynchronous request per partition. The ACL cache is
+        left to the caller"""
+        cql_execute_concurrent(u"""UPDATE {keyspace}.tree_entry
+            SET container_acl=? WHERE container=?""",
+                               [(acl, container) for container in containers])
+
+
+    @classmethod
+    def set_entries_acl(cls, entries, acl):
+        """Replace the acl of a list of entries with the same ACL map. The
+        entries are grouped by partition and written with unlogged
+        batches"""
+        by_table = {}
+        for entry in entries:
+            values = entry._entry_values()
+            partitions = by_table.setdefault(entry.__class__, {})
+            partitions.setdefault(tuple(values[:-1]), []).append(
+                [acl] + values)
+        for entry_cls, partitions in by_table.iteritems():
+            cql_execute_batches(u"""UPDATE {keyspace}.{table} SET acl=?
+                WHERE {where}""",
+                                partitions.values(),
+                                table=entry_cls.entry_table,
+                                where=entry_cls._entry_where(u"?"))
+
+
+    def update(self, **kwargs):
+        """Update a collection
+
+        All the columns are written with a single statement, prepared once
+        for each set of column names"""
+        if not kwargs:
+            return self
+        # For static fields we can't use the name in the where condition, if
+        # there's at least one regular column the whole row is updated (the
+        # static columns can be set in the same statement)
+        if all([arg in static_fields for arg in kwargs]):
+            columns = sorted(kwargs)
+            values = [kwargs[arg] for arg in columns]
+            assignments = u", ".join([u"{}=?".format(arg) for arg in columns])
+            cql_execute(u"""UPDATE {keyspace}.tree_entry SET {assignments}
+                WHERE container=?""",
+                        values + [self.container],
+                        assignments=assignments)
+            return self
+        return super(TreeEntry, self).update(**kwargs)
+
+
+    def update_container_acl(self, acl):
+        """Update the static acl with the given ACL map"""
+        cql_execute(u"""UPDATE {keyspace}.tree_entry
+            SET container_acl=container_acl+?
+            WHERE container=?""", (acl, self.container))
+        acl_cache.invalidate(self.container)
 
 
     def update_container_acl_cdmi(self, cdmi_acl):
         """"Update static ACL from a cdmi object (list of dict)"""
-        cql_string = acl_cdmi_to_cql(cdmi_acl)
-        self.update_container_acl(cql_string)
+        acl = acl_cdmi_to_map(cdmi_acl)
+        self.update_container_acl(acl)
 
 
     def update_container_acl_list(self, read_access, write_access):
         """"Update static ACL from  lists of group uuids"""
-        cql_string = acl_list_to_cql(read_access, write_access)
-        self.update_container_acl(cql_string)
-
+        acl = acl_list_to_map(read_access, write_access)
+        self.update_container_acl(acl)
 
-    def update_entry_acl(self, acl_cql):
-        """Update the acl with the given cql string"""
-        cfg = get_config(None)
-        session = connection.get_session()
-        keyspace = cfg.get('KEYSPACE', 'indigo')
-        session.set_keyspace(keyspace)
-        query = SimpleStatement(u"""UPDATE tree_entry SET acl=acl+{} 
-            WHERE container=%s and name=%s""".format(acl_cql))
-        session.execute(query, (self.container, self.name,))
 
+class TreeEntryBucket(EntryMixin, Model):
+    """Entries of the bucketed containers
 
-    def update_entry_acl_list(self, read_access, write_access):
-        """"Update entry ACL from  lists of group uuids"""
-        cql_string = acl_list_to_cql(read_access, write_access)
-        self.update_entry_acl(cql_string)
+    The entries of a very large container are spread over a fixed number of
+    partitions (container, bucket), the bucket is a hash of the name. The
+    static container columns stay on the header row of the container in the
+    tree_entry table. Use TreeEntry.find_entry(), find_many() and
+    iter_names() which hide the layout of a container."""
 
+    entry_table = u"tree_entry_bucket"
+    entry_key = ("container", "bucket", "name")
 
-    def update_entry_acl_cdmi(self, cdmi_acl):
-        """"Update entry ACL from a cdmi object (list of dict)"""
-        cql_string = acl_cdmi_to_cql(cdmi_acl)
-        self.update_entry_acl(cql_string)
+    container = columns.Text(partition_key=True)
+    bucket = columns.Integer(partition_key=True)
+    name = columns.Text(primary_key=True, partition_key=False)
 
+    metadata = columns.Map(columns.Text, columns.Text)
+    create_ts = columns.DateTime(default=datetime.now)
+    modified_ts = columns.DateTime()
+    acl = columns.Map(columns.Text, columns.UserDefinedType(Ace))
+    mimetype = columns.Text()
+    url = columns.Text()
+    uuid = columns.Text()
@@ -30,9 +30,8 @@ from indigo.util import (
     log_with,
 )
 from indigo.util_graph import (
-    get_graph_session,
     gq_add_vertex_user,
-    gq_get_vertex_user
+    gq_get_vertex,
 )
 
 
@@ -59,9 +58,9 @@ class User(Model):
 
     @classmethod
     def check_graph_users(cls):
-        for u in User.objects.all():
-            if not u.vertex_exists():
-                u.create_vertex()
+        """Create the missing vertices of the users with bulk requests"""
+        from indigo.graph_sync import sync_users
+        sync_users()
 
     @classmethod
     @log_with()
@@ -96,9 +95,7 @@ class User(Model):
         user = User(**kwargs)
         user.save()
         
-        session = get_graph_session()
-        session.execute_graph("""v_new = {}""".format(gq_add_vertex_user(user))
-                             )
+        gq_add_vertex_user(user)
         
         state = user.mqtt_get_state()
         payload = user.mqtt_payload({}, state)
@@ -108,9 +105,7 @@ class User(Model):
         return user
 
     def create_vertex(self):
-        session = get_graph_session()
-        session.execute_graph("""v_new = {}""".format(gq_add_vertex_user(self))
-                             )
+        gq_add_vertex_user(self)
 
     def delete(self, username=None):
         from indigo.models import Notification
@@ -223,8 +218,7 @@ class User(Model):
 
     def vertex_exists(self):
         try:
-            session = get_graph_session()
-            res = session.execute_graph("{}.next()".format(gq_get_vertex_user(self)))
-            return True
+            res = gq_get_vertex('user', self.uuid)
+            return bool(res.current_rows)
         except:
             return False
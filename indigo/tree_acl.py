@@ -0,0 +1,185 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from multiprocessing.pool import ThreadPool
+import time
+
+from indigo.models import (
+    Collection,
+    DataObject,
+    TreeEntry,
+)
+from indigo.models.acl import (
+    acl_cache,
+    acl_list_to_map,
+    inherited_acl,
+)
+from indigo.util import merge
+from indigo.tree_walker import TreeWalker
+
+# Number of threads which update the collections of a level
+PROPAGATE_WORKERS = 8
+
+# Number of collections handled by a single task, and number of resources
+# read and updated with a single bulk request
+PROPAGATE_BATCH_SIZE = 100
+
+
+class AclPropagation(TreeWalker):
+    """Set the ACL of a collection and propagate it to everything below it.
+
+    The ACL given as lists of groups becomes the ACL of the top collection,
+    the existing ACL of the subtree are replaced by the inherited entries
+    (see inherited_acl() for the meaning of the ACEFLAG_* flags). As the
+    whole subtree is rewritten the ACL of a level only depends on its depth.
+
+    The tree is walked breadth-first, the collections of a level are
+    processed by batches on a pool of threads. The ACL of the sub-collections
+    is a static column, it is written once per partition, the ACL of the
+    resources are written with bulk requests (data objects, or tree entries
+    grouped by partition for the references). A checkpoint is saved after
+    each batch, the updates are idempotent so an interrupted propagation
+    restarts from the last batch."""
+
+    operation = u"Propagate ACL"
+
+    def __init__(self, path, read_access, write_access, recursive=True,
+                 workers=PROPAGATE_WORKERS, batch_size=PROPAGATE_BATCH_SIZE,
+                 progress=None, checkpoint=None):
+        super(AclPropagation, self).__init__(path, workers, batch_size,
+                                             progress)
+        self.acl = acl_list_to_map(read_access, write_access)
+        self.recursive = recursive
+        self.checkpoint = checkpoint
+        # Depth of the top collection in the whole tree
+        self._top_depth = None
+
+
+    def _acl_at_depth(self, depth):
+        """Return the ACL of the collections 'depth' levels below the top
+        collection"""
+        acl = self.acl
+        for _ in xrange(depth):
+            acl = inherited_acl(acl, False)
+        return acl
+
+
+    def _path_depth(self, path):
+        """Return the number of collections above a path"""
+        return len([name for name in path.split('/') if name])
+
+
+    def _propagate(self, paths):
+        """Update the children of a batch of collections of a level, return
+        the list of the sub-collections to walk, and the number of resources
+        and of sub-collections which aren't walked"""
+        acl = self._acl_at_depth(self._path_depth(paths[0]) - self._top_depth)
+        container_acl = inherited_acl(acl, False)
+        object_acl = inherited_acl(acl, True)
+        sub_collections = []
+        resources = 0
+        for path in paths:
+            names = []
+            for name in TreeEntry.iter_names(path):
+                if name == '.':
+                    continue
+                elif name.endswith('/'):
+                    sub_collections.append(merge(path, name[:-1]))
+                else:
+                    names.append(name)
+                    if len(names) >= self.batch_size:
+                        resources += self._set_resources(path, names,
+                                                         object_acl)
+                        names = []
+            if names:
+                resources += self._set_resources(path, names, object_acl)
+        TreeEntry.set_container_acl_many(sub_collections, container_acl)
+        if self.recursive:
+            return sub_collections, (resources, 0)
+        return [], (resources, len(sub_collections))
+
+
+    def _set_resources(self, path, names, acl):
+        """Replace the ACL of a list of resources of a collection"""
+        from indigo.models.resource import is_reference
+        entries = TreeEntry.find_many([(path, name) for name in names])
+        references = []
+        obj_ids = []
+        for entry in entries.itervalues():
+            if is_reference(entry.url):
+                references.append(entry)
+            else:
+                obj_ids.append(entry.url.replace("cassandra://", ""))
+        DataObject.set_acl_many(obj_ids, acl)
+        TreeEntry.set_entries_acl(references, acl)
+        return len(entries)
+
+
+    def run(self, state=None):
+        """Propagate the ACL, return the statistics. 'state' is the last
+        checkpoint of an interrupted propagation"""
+        root = Collection.find(self.path)
+        if not root:
+            return None
+        self.start_time = time.time()
+        self._top_depth = self._path_depth(root.path)
+        if state:
+            self.collections = state['collections']
+            self.resources = state['resources']
+        else:
+            TreeEntry.set_container_acl_many([root.path], self.acl)
+            acl_cache.invalidate(root.path)
+            self.collections = 1
+        pool = ThreadPool(self.workers)
+        try:
+            for resources, collections in self._walk(pool, self._propagate,
+                                                     root.path, state):
+                self.resources += resources
+                self.collections += collections
+                self._report()
+        finally:
+            pool.close()
+            pool.join()
+        acl_cache.invalidate(root.path)
+        self._report(True)
+        return self.stats()
+
+
+def propagate_acl(path, read_access, write_access, recursive=True,
+                  workers=PROPAGATE_WORKERS, batch_size=PROPAGATE_BATCH_SIZE,
+                  progress=None):
+    """Set the ACL of a collection and of its content, return the
+    statistics"""
+    engine = AclPropagation(path, read_access, write_access, recursive,
+                            workers, batch_size, progress)
+    return engine.run()
+
+
+def propagate_job(job):
+    """Execute a 'propagate_acl' job, a job resumed after a restart starts
+    again after its last batch"""
+    spec = job.get_spec()
+    progress = lambda stats: job.save_checkpoint(progress=stats)
+    checkpoint = lambda state: job.save_checkpoint(checkpoint=state)
+    engine = AclPropagation(spec['path'],
+                            spec.get('read_access', []),
+                            spec.get('write_access', []),
+                            spec.get('recursive', True),
+                            progress=progress,
+                            checkpoint=checkpoint)
+    return engine.run(job.get_checkpoint())
@@ -0,0 +1,189 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import json
+from multiprocessing.pool import ThreadPool
+import time
+
+from indigo.models import (
+    Collection,
+    DataObject,
+    MetadataIndex,
+    Notification,
+    Resource,
+    SearchIndex,
+    TreeEntry,
+)
+from indigo.util import (
+    datetime_serializer,
+    merge,
+)
+from indigo.util_graph import gq_drop_vertices
+from indigo.tree_walker import TreeWalker
+
+# Number of threads which delete the batches
+DELETE_WORKERS = 8
+
+# Number of objects deleted by a single task
+DELETE_BATCH_SIZE = 100
+
+
+class SubtreeDelete(TreeWalker):
+    """Delete a collection and everything below it.
+
+    The tree is walked breadth-first, one level at a time. The resources of
+    a level are deleted by batches on a pool of threads: blobs, search index
+    rows and graph vertices are removed with bulk requests. The tree entries
+    of the resources go with the partitions of their collections, which are
+    dropped at the end, deepest level first, so an interrupted delete can be
+    started again on the same path.
+
+    A single notification is sent for the whole subtree."""
+
+    operation = u"Delete"
+
+    def __init__(self, path, username=None, workers=DELETE_WORKERS,
+                 batch_size=DELETE_BATCH_SIZE, progress=None):
+        super(SubtreeDelete, self).__init__(path, workers, batch_size,
+                                            progress)
+        self.username = username
+
+
+    def _delete_collections(self, paths):
+        """Delete a batch of collections whose children have been deleted"""
+        collections = [coll for coll in Collection.find_many(paths) if coll]
+        SearchIndex.reset_many(paths)
+        MetadataIndex.reset_many([(coll.path, "Collection",
+                                   coll.get_cdmi_metadata())
+                                  for coll in collections])
+        gq_drop_vertices('collection', [coll.uuid for coll in collections
+                                        if coll.uuid])
+        for path in paths:
+            TreeEntry.delete_container(path)
+        return len(collections)
+
+
+    def _delete_resources(self, paths):
+        """Delete a batch of resources, the tree entries are left to the
+        deletion of the collection"""
+        resources = [resc for resc in Resource.find_many(paths,
+                                                         load_objects=True)
+                     if resc]
+        MetadataIndex.reset_many([(resc.path, "Resource",
+                                   resc.get_cdmi_metadata())
+                                  for resc in resources])
+        DataObject.delete_many([resc.obj_id for resc in resources
+                                if not resc.is_reference])
+        SearchIndex.reset_many([resc.path for resc in resources])
+        gq_drop_vertices('resource', [resc.uuid for resc in resources
+                                      if resc.uuid])
+        return len(resources)
+
+
+    def _resource_batches(self, level, next_level):
+        """Generator which yields the batches of resources for the
+        collections of a level, the sub-collections are appended to
+        'next_level'"""
+        for path in level:
+            batch = []
+            for name in TreeEntry.iter_names(path):
+                if name == '.':
+                    continue
+                elif name.endswith('/'):
+                    next_level.append(merge(path, name[:-1]))
+                else:
+                    batch.append(merge(path, name))
+                    if len(batch) >= self.batch_size:
+                        yield batch
+                        batch = []
+            if batch:
+                yield batch
+
+
+    def run(self):
+        """Delete the subtree, return the statistics"""
+        root = Collection.find(self.path)
+        if not root:
+            return None
+        self.start_time = time.time()
+        state = root.mqtt_get_state()
+        levels = []
+        level = [root.path]
+        pool = ThreadPool(self.workers)
+        try:
+            while level:
+                levels.append(level)
+                next_level = []
+                for count in self._run_tasks(pool, self._delete_resources,
+                                             self._resource_batches(level,
+                                                                    next_level)):
+                    self.resources += count
+                    self._report()
+                level = next_level
+            # The root collection is handled separately
+            levels[0] = []
+            for level in reversed(levels):
+                for count in self._run_tasks(pool, self._delete_collections,
+                                             self._batches(level)):
+                    self.collections += count
+                    self._report()
+        finally:
+            pool.close()
+            pool.join()
+        self._delete_root(root)
+        self._report(True)
+        stats = self.stats()
+        payload = json.dumps({'pre': state, 'post': {}, 'summary': stats},
+                             default=datetime_serializer)
+        Notification.delete_collection(self.username, root.path, payload)
+        return stats
+
+
+    def _delete_root(self, root):
+        """Delete the top collection of the subtree. The root of the tree
+        itself is kept, only its children are removed"""
+        if root.is_root:
+            names = [name for name in TreeEntry.iter_names(root.path)
+                     if name != '.']
+            TreeEntry.delete_entries(root.path, names)
+            return
+        SearchIndex.reset_many([root.path])
+        MetadataIndex.reset_many([(root.path, "Collection",
+                                   root.get_cdmi_metadata())])
+        gq_drop_vertices('collection', [root.uuid])
+        TreeEntry.delete_container(root.path)
+        child = TreeEntry.find_entry(root.container, u"{}/".format(root.name))
+        if child:
+            child.delete()
+        self.collections += 1
+
+
+def delete_subtree(path, username=None, workers=DELETE_WORKERS,
+                   batch_size=DELETE_BATCH_SIZE, progress=None):
+    """Delete a collection and all its content, return the statistics"""
+    engine = SubtreeDelete(path, username, workers, batch_size, progress)
+    return engine.run()
+
+
+def delete_job(job):
+    """Execute a 'delete' job. The deletion is idempotent, a job resumed
+    after a restart walks what is left of the subtree"""
+    spec = job.get_spec()
+    progress = lambda stats: job.save_checkpoint(progress=stats)
+    engine = SubtreeDelete(spec['path'], job.username, progress=progress)
+    return engine.run()
@@ -0,0 +1,150 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from multiprocessing.pool import ThreadPool
+import time
+
+from indigo.models import (
+    Collection,
+    MetadataIndex,
+    Resource,
+    SearchIndex,
+    TreeEntry,
+)
+from indigo.util import merge
+from indigo.tree_walker import TreeWalker
+
+# Number of threads which index the collections of a level
+REINDEX_WORKERS = 8
+
+# Number of collections handled by a single task, and number of resources
+# read with a single bulk request
+REINDEX_BATCH_SIZE = 100
+
+
+class TreeReindex(TreeWalker):
+    """Index again the collections and the resources of a subtree, in the
+    search index and in the metadata index.
+
+    The tree is walked breadth-first, the collections of a level and their
+    resources are indexed by batches on a pool of threads, the resources
+    are read with bulk requests. All the rows of the objects are written
+    again, so the missing ones are repaired. With 'reset' the index tables
+    are emptied first, which is needed when the layout of the index changes
+    (new table, other number of shards). A checkpoint is saved after each batch,
+    indexing is idempotent so an interrupted reindex restarts from the last
+    batch."""
+
+    operation = u"Reindex"
+
+    def __init__(self, path, reset=False, workers=REINDEX_WORKERS,
+                 batch_size=REINDEX_BATCH_SIZE, progress=None,
+                 checkpoint=None):
+        super(TreeReindex, self).__init__(path, workers, batch_size, progress)
+        self.reset = reset
+        self.checkpoint = checkpoint
+
+
+    def _index(self, paths):
+        """Index a batch of collections and their resources, return the list
+        of the sub-collections and the number of resources indexed"""
+        changes = []
+        for coll in Collection.find_many(paths):
+            if coll:
+                if not coll.is_root:
+                    coll.index(force=True)
+                metadata = coll.get_cdmi_metadata()
+                changes.append((coll.path, 'Collection', metadata, metadata))
+        MetadataIndex.update_many(changes, force=True)
+        sub_collections = []
+        resources = 0
+        for path in paths:
+            names = []
+            for name in TreeEntry.iter_names(path):
+                if name == '.':
+                    continue
+                elif name.endswith('/'):
+                    sub_collections.append(merge(path, name[:-1]))
+                else:
+                    names.append(name)
+                    if len(names) >= self.batch_size:
+                        resources += self._index_resources(path, names)
+                        names = []
+            if names:
+                resources += self._index_resources(path, names)
+        return sub_collections, resources
+
+
+    def _index_resources(self, path, names):
+        """Index a list of resources of a collection"""
+        changes = []
+        for resc in Resource.find_many([merge(path, name) for name in names],
+                                       load_objects=True):
+            if resc:
+                resc.index(force=True)
+                metadata = resc.get_cdmi_metadata()
+                changes.append((resc.path, 'Resource', metadata, metadata))
+        MetadataIndex.update_many(changes, force=True)
+        return len(changes)
+
+
+    def run(self, state=None):
+        """Index the subtree, return the statistics. 'state' is the last
+        checkpoint of an interrupted reindex"""
+        root = Collection.find(self.path)
+        if not root:
+            return None
+        self.start_time = time.time()
+        if state:
+            self.collections = state['collections']
+            self.resources = state['resources']
+        else:
+            if self.reset:
+                SearchIndex.reset_all()
+                MetadataIndex.reset_all()
+            self.collections = 1
+        pool = ThreadPool(self.workers)
+        try:
+            for count in self._walk(pool, self._index, root.path, state):
+                self.resources += count
+                self._report()
+        finally:
+            pool.close()
+            pool.join()
+        self._report(True)
+        return self.stats()
+
+
+def reindex_tree(path="/", reset=False, workers=REINDEX_WORKERS,
+                 batch_size=REINDEX_BATCH_SIZE, progress=None):
+    """Index again a subtree, return the statistics"""
+    engine = TreeReindex(path, reset, workers, batch_size, progress)
+    return engine.run()
+
+
+def reindex_job(job):
+    """Execute a 'reindex' job, a job resumed after a restart starts again
+    after its last batch"""
+    spec = job.get_spec()
+    progress = lambda stats: job.save_checkpoint(progress=stats)
+    checkpoint = lambda state: job.save_checkpoint(checkpoint=state)
+    engine = TreeReindex(spec.get('path', '/'),
+                         spec.get('reset', False),
+                         progress=progress,
+                         checkpoint=checkpoint)
+    return engine.run(job.get_checkpoint())
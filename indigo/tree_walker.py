@@ -0,0 +1,184 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import threading
+import time
+
+from indigo.log import init_log
+from indigo.models import TreeEntry
+from indigo.util import merge
+
+logger = init_log('tree_walker')
+
+# Number of threads which process the batches
+WALKER_WORKERS = 8
+
+# Number of objects processed by a single task
+WALKER_BATCH_SIZE = 100
+
+# Minimum number of seconds between two progress reports
+PROGRESS_INTERVAL = 10
+
+
+class TreeWalker(object):
+    """Base class of the operations which walk a subtree in parallel.
+
+    It counts the collections and resources processed, reports the progress
+    and the throughput, and runs the batches of a level on a pool of
+    threads. The levels can be walked with checkpoints saved after each
+    batch (see _walk())."""
+
+    # Name of the operation in the logs
+    operation = u"Walk"
+
+    def __init__(self, path, workers=WALKER_WORKERS,
+                 batch_size=WALKER_BATCH_SIZE, progress=None):
+        self.path = path
+        self.workers = workers
+        self.batch_size = batch_size
+        # Optional callable, called with the statistics dictionary
+        self.progress = progress
+        # Optional callable, called with the state to save after each batch
+        # of a level walked by _walk()
+        self.checkpoint = None
+        self.collections = 0
+        self.resources = 0
+        self.start_time = None
+        self._lock = threading.Lock()
+        self._last_report = 0
+
+
+    def _batches(self, paths):
+        """Split a list of paths in batches"""
+        for idx in xrange(0, len(paths), self.batch_size):
+            yield paths[idx:idx + self.batch_size]
+
+
+    def _report(self, force=False):
+        """Log the progress and throughput at most every PROGRESS_INTERVAL
+        seconds"""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_report < PROGRESS_INTERVAL:
+                return
+            self._last_report = now
+        stats = self.stats()
+        logger.info(u"{} {}: {} collections, {} resources in {:.1f}s "
+                    u"({:.1f} objects/s)".format(self.operation,
+                                                 self.path,
+                                                 stats['collections'],
+                                                 stats['resources'],
+                                                 stats['elapsed'],
+                                                 stats['rate']))
+        if self.progress:
+            self.progress(stats)
+
+
+    def _run_tasks(self, pool, func, batches):
+        """Run 'func' on the pool for each batch and yield the results. The
+        batches are read in this thread, at most two per worker are queued
+        so a large level is never loaded in memory"""
+        pending = []
+        for batch in batches:
+            pending.append(pool.apply_async(func, (batch,)))
+            if len(pending) >= 2 * self.workers:
+                yield pending.pop(0).get()
+        for result in pending:
+            yield result.get()
+
+
+    def _sub_collections(self, paths):
+        """Return the paths of the sub-collections of a batch of
+        collections"""
+        res = []
+        for path in paths:
+            res.extend([merge(path, name[:-1])
+                        for name in TreeEntry.iter_names(path)
+                        if name.endswith('/')])
+        return res
+
+
+    def _level(self, pool, top, depth):
+        """Return the sorted paths of the collections 'depth' levels below
+        the collection 'top', read from the tree entries"""
+        level = [top]
+        for _ in xrange(depth):
+            next_level = []
+            for sub_collections in self._run_tasks(pool,
+                                                   self._sub_collections,
+                                                   self._batches(level)):
+                next_level.extend(sub_collections)
+            level = sorted(next_level)
+        return level
+
+
+    def _walk(self, pool, func, top, state=None):
+        """Walk the subtree of the collection 'top' breadth-first and yield
+        the results of 'func' in order. 'func' is run on the pool for each
+        batch of collection paths of a level, it returns the list of their
+        sub-collections and a result.
+
+        The levels are sorted by path. After each batch the checkpoint is
+        called with the statistics, the depth of the level and the last path
+        of the batch, so the checkpoint stays small. From such a 'state' the
+        level is read again from the tree entries and the walk starts after
+        the cursor, the sub-collections of the collections already done are
+        listed without calling 'func'."""
+        depth = 0
+        level = [top]
+        cursor = None
+        if state:
+            depth = state['depth']
+            # A checkpoint without cursor restarts the whole level
+            cursor = state.get('cursor')
+            level = self._level(pool, top, depth)
+        while level:
+            next_level = []
+            if cursor is not None:
+                done = [path for path in level if path <= cursor]
+                level = [path for path in level if path > cursor]
+                for sub_collections in self._run_tasks(pool,
+                                                       self._sub_collections,
+                                                       self._batches(done)):
+                    next_level.extend(sub_collections)
+            for cursor, (sub_collections, result) in self._run_tasks(
+                    pool, lambda batch: (batch[-1], func(batch)),
+                    self._batches(level)):
+                next_level.extend(sub_collections)
+                self.collections += len(sub_collections)
+                yield result
+                if self.checkpoint:
+                    state = self.stats()
+                    state.update({"depth": depth, "cursor": cursor})
+                    self.checkpoint(state)
+            level = sorted(next_level)
+            depth += 1
+            cursor = None
+
+
+    def stats(self):
+        """Return a dictionary with the progress of the operation"""
+        elapsed = time.time() - self.start_time if self.start_time else 0.0
+        done = self.collections + self.resources
+        return {
+            "path": self.path,
+            "collections": self.collections,
+            "resources": self.resources,
+            "elapsed": elapsed,
+            "rate": done / elapsed if elapsed else 0.0,
+        }
@@ -0,0 +1,226 @@
+"""Indigo - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import base64
+import threading
+
+from dse.concurrent import execute_concurrent
+from dse.cqlengine import connection
+from dse.query import (
+    BatchStatement,
+    BatchType,
+    SimpleStatement,
+)
+
+from indigo import get_config
+
+
+# Maximum number of requests in flight for the bulk operations
+DEFAULT_CONCURRENCY = 50
+
+# Maximum number of statements in a single batch
+MAX_BATCH_SIZE = 100
+
+
+class StatementRegistry(object):
+    """Cache of the prepared statements used by the models.
+
+    Queries are written with a '{keyspace}' placeholder in front of the
+    table names so they are always fully qualified and the session never
+    needs a set_keyspace() call. Extra placeholders (column names, ...) can
+    be given as keyword arguments, the resulting text is the shape of the
+    statement and it is prepared once per session.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statements = {}
+
+
+    def keyspace(self):
+        """Return the keyspace used by Indigo"""
+        cfg = get_config(None)
+        return cfg.get('KEYSPACE', 'indigo')
+
+
+    def qualify(self, query, **fields):
+        """Return the text of a query with the keyspace and the given fields
+        filled in"""
+        return query.format(keyspace=self.keyspace(), **fields)
+
+
+    def prepare(self, query, **fields):
+        """Return the prepared statement for a query, prepare it on the
+        current session if it hasn't been done yet"""
+        session = connection.get_session()
+        key = (session, self.qualify(query, **fields))
+        stmt = self._statements.get(key)
+        if stmt is None:
+            with self._lock:
+                stmt = self._statements.get(key)
+                if stmt is None:
+                    stmt = session.prepare(key[1])
+                    self._statements[key] = stmt
+        return stmt
+
+
+    def bind(self, query, parameters=None, **fields):
+        """Return a bound statement for a query"""
+        return self.prepare(query, **fields).bind(parameters or ())
+
+
+    def execute(self, query, parameters=None, **fields):
+        """Execute a query with a prepared statement"""
+        session = connection.get_session()
+        return session.execute(self.bind(query, parameters, **fields))
+
+
+    def execute_async(self, query, parameters=None, **fields):
+        """Execute a query with a prepared statement, return a future"""
+        session = connection.get_session()
+        return session.execute_async(self.bind(query, parameters, **fields))
+
+
+    def execute_concurrent(self, query, parameters_list,
+                           concurrency=DEFAULT_CONCURRENCY, **fields):
+        """Execute a prepared statement once for each set of parameters with
+        asynchronous requests, at most 'concurrency' of them are in flight at
+        the same time. The result sets are returned in the order of
+        'parameters_list'"""
+        session = connection.get_session()
+        stmt = self.prepare(query, **fields)
+        results = execute_concurrent(session,
+                                     [(stmt, params) for params in parameters_list],
+                                     concurrency=concurrency,
+                                     raise_on_first_error=True)
+        return [result for _, result in results]
+
+
+    def batches(self, query, partitions, **fields):
+        """Return the unlogged batches of a prepared statement for lists of
+        parameters grouped by partition, at most MAX_BATCH_SIZE statements
+        each"""
+        stmt = self.prepare(query, **fields)
+        batches = []
+        for parameters_list in partitions:
+            parameters_list = list(parameters_list)
+            for idx in xrange(0, len(parameters_list), MAX_BATCH_SIZE):
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for params in parameters_list[idx:idx + MAX_BATCH_SIZE]:
+                    batch.add(stmt, params)
+                batches.append(batch)
+        return batches
+
+
+    def execute_batches(self, query, partitions,
+                        concurrency=DEFAULT_CONCURRENCY, **fields):
+        """Execute a prepared statement for lists of parameters grouped by
+        partition. Each group is sent as unlogged batches (a single partition
+        so it's applied atomically by one replica set), the batches are sent
+        asynchronously."""
+        session = connection.get_session()
+        batches = self.batches(query, partitions, **fields)
+        if batches:
+            execute_concurrent(session, [(batch, None) for batch in batches],
+                               concurrency=concurrency,
+                               raise_on_first_error=True)
+        return len(batches)
+
+
+    def execute_batches_async(self, query, partitions, **fields):
+        """Send the unlogged batches of a prepared statement for lists of
+        parameters grouped by partition without waiting, return the
+        futures"""
+        session = connection.get_session()
+        return [session.execute_async(batch)
+                for batch in self.batches(query, partitions, **fields)]
+
+
+    def simple(self, query, **fields):
+        """Return a keyspace qualified SimpleStatement for queries which
+        can't be prepared (literals which change for every call)"""
+        return SimpleStatement(self.qualify(query, **fields))
+
+
+statements = StatementRegistry()
+
+
+def cql_bind(query, parameters=None, **fields):
+    """Return a bound statement from the shared registry"""
+    return statements.bind(query, parameters, **fields)
+
+
+def cql_execute(query, parameters=None, **fields):
+    """Execute a prepared statement from the shared registry"""
+    return statements.execute(query, parameters, **fields)
+
+
+def cql_execute_async(query, parameters=None, **fields):
+    """Execute asynchronously a prepared statement from the shared
+    registry"""
+    return statements.execute_async(query, parameters, **fields)
+
+
+def cql_execute_concurrent(query, parameters_list,
+                           concurrency=DEFAULT_CONCURRENCY, **fields):
+    """Execute a prepared statement from the shared registry for each set of
+    parameters, with a bounded number of requests in flight"""
+    return statements.execute_concurrent(query, parameters_list,
+                                         concurrency, **fields)
+
+
+def cql_execute_batches(query, partitions,
+                        concurrency=DEFAULT_CONCURRENCY, **fields):
+    """Execute a prepared statement from the shared registry with one unlogged
+    batch per partition"""
+    return statements.execute_batches(query, partitions,
+                                      concurrency, **fields)
+
+
+def cql_execute_batches_async(query, partitions, **fields):
+    """Send a prepared statement from the shared registry with one unlogged
+    batch per partition, return the futures"""
+    return statements.execute_batches_async(query, partitions, **fields)
+
+
+def cql_simple(query, **fields):
+    """Return a keyspace qualified SimpleStatement"""
+    return statements.simple(query, **fields)
+
+
+def decode_cursor(cursor):
+    """Return the driver paging state from an opaque cursor"""
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(str(cursor))
+    except TypeError:
+        raise ValueError(u"Invalid cursor '{}'".format(cursor))
+
+
+def encode_cursor(paging_state):
+    """Return an opaque cursor from a driver paging state, None if there
+    are no more pages"""
+    if not paging_state:
+        return None
+    return base64.urlsafe_b64encode(paging_state)
+
+
+def get_session():
+    """Return the Cassandra session used by the models"""
+    return connection.get_session()
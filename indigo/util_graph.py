@@ -16,6 +16,10 @@ limitations under the License.
 
 """
 
+import atexit
+import os
+import threading
+
 from dse.cluster import (
     Cluster, 
     GraphExecutionProfile, 
@@ -24,94 +28,455 @@ from dse.cluster import (
 )
 from dse.graph import GraphOptions
 
+from indigo import RESERVED_META
+from indigo.log import init_log
 
-def get_graph_session(graph_name="indigo_graph"):
-    ep = GraphExecutionProfile(graph_options=GraphOptions(graph_name=graph_name))
-    cluster = Cluster(execution_profiles={EXEC_PROFILE_GRAPH_DEFAULT: ep})
-    session = cluster.connect()
-    return session
+logger = init_log('util_graph')
 
 
-def gq_add_vertex_collection(coll):
-    """Create the gremlin query that creates a Vertex for a collection in the
-    Tree Entry table
-    """
-    name = coll.entry.container.split('/')[-1]
-    if not name: # root
-        name = '/'
-    
-    query = "graph.addVertex(T.label, 'collection', "
-    query += "'name', '{}', ".format(name)
-    query += "'uuid', '{}', ".format(coll.uuid)
-    query += "'create_ts', '{}', ".format(coll.entry.container_create_ts)
-    query += "'modified_ts', '{}')".format(coll.entry.container_modified_ts)
-    
-    return query
-
-
-def gq_add_vertex_resource(resc):
-    """Create the gremlin query that creates a Vertex for a resource in the
-    Tree Entry table
+# Maximum number of vertices dropped by a single traversal
+DROP_BATCH_SIZE = 500
+
+
+class GraphSessionManager(object):
+    """Process-wide pool of DSE Graph sessions.
+
+    One Cluster and one Session are kept per graph name and shared between
+    all the threads of the process. The pid of the process which opened the
+    connections is recorded so that a forked worker (pre-fork web servers)
+    opens its own connections instead of reusing the sockets inherited from
+    its parent.
     """
-    query = "graph.addVertex(T.label, 'resource', "
-    query += "'name', '{}', ".format(resc.get_name())
-    query += "'uuid', '{}', ".format(resc.uuid)
-    query += "'size', '{}', ".format(resc.get_size())
-    #query += "'mimetype', '{}', ".format(resc.get_mimetype() or "application/octet-stream")
-    query += "'create_ts', '{}', ".format(resc.get_create_ts())
-    query += "'modified_ts', '{}')".format(resc.get_modified_ts())
-    return query
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clusters = {}
+        self._sessions = {}
+        self.created = 0
+        self.reused = 0
+
+
+    def _check_fork(self):
+        """Forget the connections inherited from a parent process"""
+        pid = os.getpid()
+        if pid != self._pid:
+            # The parent still owns these connections, we must not shut them
+            # down from the child. The lock may have been copied in a locked
+            # state so it is replaced as well.
+            self._lock = threading.Lock()
+            self._pid = pid
+            self._clusters = {}
+            self._sessions = {}
+            self.created = 0
+            self.reused = 0
+
+
+    def get_session(self, graph_name="indigo_graph"):
+        """Return the shared session for a graph, connect if needed"""
+        self._check_fork()
+        with self._lock:
+            session = self._sessions.get(graph_name)
+            if session is not None and not session.is_shutdown:
+                self.reused += 1
+                return session
+            ep = GraphExecutionProfile(graph_options=GraphOptions(graph_name=graph_name))
+            cluster = Cluster(execution_profiles={EXEC_PROFILE_GRAPH_DEFAULT: ep})
+            session = cluster.connect()
+            self._clusters[graph_name] = cluster
+            self._sessions[graph_name] = session
+            self.created += 1
+            return session
+
+
+    def shutdown(self):
+        """Close all the clusters opened by this process"""
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            for graph_name, cluster in self._clusters.items():
+                try:
+                    cluster.shutdown()
+                except Exception:
+                    logger.warning(u"Problem while closing the graph session "
+                                   u"for '{}'".format(graph_name))
+            self._clusters = {}
+            self._sessions = {}
+
+
+    def stats(self):
+        """Return a dictionary with the number of sessions created and
+        reused"""
+        return {
+            "created": self.created,
+            "reused": self.reused,
+            "open": len(self._sessions),
+        }
+
+
+graph_sessions = GraphSessionManager()
+atexit.register(graph_sessions.shutdown)
+
+
+def get_graph_session(graph_name="indigo_graph"):
+    """Return the shared session for the graph 'graph_name'"""
+    return graph_sessions.get_session(graph_name)
+
+
+def graph_session_stats():
+    """Return the statistics of the graph session manager"""
+    return graph_sessions.stats()
+
+
+def shutdown_graph_sessions():
+    """Close all the graph sessions of the process"""
+    graph_sessions.shutdown()
+
+
+def drop_vertices(label, uuids, batch_size=DROP_BATCH_SIZE):
+    """Drop the vertices with a label from a list of uuids, with one traversal
+    for each batch of uuids"""
+    uuids = list(uuids)
+    session = get_graph_session()
+    for idx in xrange(0, len(uuids), batch_size):
+        session.execute_graph("""g.V().hasLabel(label)
+                                  .has('uuid', within(uuids)).drop()""",
+                              {'label': label,
+                               'uuids': uuids[idx:idx + batch_size]})
+
+
+# Schema of the graph which mirrors the tree. All the vertices are looked up
+# by label and uuid, the materialized indexes turn these lookups into index
+# hits so scans can be disabled. The properties of the metadata are free so
+# they are still created on the fly ('Development' schema mode).
+GRAPH_SCHEMA = """schema.propertyKey('uuid').Text().single().ifNotExists().create();
+schema.propertyKey('name').Text().single().ifNotExists().create();
+schema.propertyKey('size').Text().single().ifNotExists().create();
+schema.propertyKey('create_ts').Text().single().ifNotExists().create();
+schema.propertyKey('modified_ts').Text().single().ifNotExists().create();
+schema.vertexLabel('collection').properties('uuid', 'name', 'create_ts', 'modified_ts').ifNotExists().create();
+schema.vertexLabel('resource').properties('uuid', 'name', 'size', 'create_ts', 'modified_ts').ifNotExists().create();
+schema.vertexLabel('user').properties('uuid', 'name').ifNotExists().create();
+schema.edgeLabel('son').single().connection('collection', 'collection').connection('collection', 'resource').ifNotExists().create();
+schema.edgeLabel('owns').single().connection('user', 'collection').connection('user', 'resource').ifNotExists().create();
+schema.vertexLabel('collection').index('byUuid').materialized().by('uuid').ifNotExists().add();
+schema.vertexLabel('resource').index('byUuid').materialized().by('uuid').ifNotExists().add();
+schema.vertexLabel('user').index('byUuid').materialized().by('uuid').ifNotExists().add();"""
+
+
+def create_graph_schema(graph_name="indigo_graph"):
+    """Create the schema of the graph if it doesn't exist and disable the
+    scans"""
+    session = get_graph_session(graph_name)
+    session.execute_graph("schema.config().option('graph.schema_mode').set('Development')")
+    session.execute_graph("schema.config().option('graph.allow_scan').set('false')")
+    session.execute_graph(GRAPH_SCHEMA)
+
+
+# The scripts sent to DSE Graph have a fixed text and the values are bound as
+# parameters: the server compiles each script once and keeps it in its cache,
+# and the values never need to be quoted.
+
+GQ_GET_VERTEX = "g.V().hasLabel(label).has('uuid', uuid)"
+
+# Create vertices from a list of maps, each vertex is linked to its parent
+# collection and to its owner when their uuids are given. The same script is
+# used for a single vertex and for the batches of the write-behind queue.
+GQ_ADD_VERTICES = """vertices.each { m ->
+    def v_new = graph.addVertex(T.label, m.label,
+                                'name', m.name,
+                                'uuid', m.uuid,
+                                'create_ts', m.create_ts,
+                                'modified_ts', m.modified_ts);
+    if (m.size != null) {
+        v_new.property('size', m.size);
+    }
+    if (m.metadata != null) {
+        m.metadata.each { key, value -> v_new.property(key, value) };
+    }
+    if (m.parent_uuid != null) {
+        g.V().hasLabel('collection').has('uuid', m.parent_uuid).next().addEdge('son', v_new);
+    }
+    if (m.user_uuid != null) {
+        g.V().hasLabel('user').has('uuid', m.user_uuid).next().addEdge('owns', v_new);
+    }
+}"""
+
+GQ_ADD_USER = "graph.addVertex(T.label, 'user', 'name', name, 'uuid', uuid)"
+
+GQ_ADD_USERS = """users.each { u ->
+    graph.addVertex(T.label, 'user', 'name', u.name, 'uuid', u.uuid);
+}"""
+
+# Link existing vertices to their parent collection
+GQ_ADD_SON_EDGES = """edges.each { e ->
+    def parent = g.V().hasLabel('collection').has('uuid', e.parent_uuid).next();
+    def child = g.V().hasLabel(e.label).has('uuid', e.uuid).next();
+    parent.addEdge('son', child);
+}"""
+
+# The children of a list of collections, as maps with the uuid of the
+# collection and the list of the labels and uuids of its children
+GQ_GET_CHILDREN = """g.V().hasLabel('collection').has('uuid', within(uuids))
+    .project('uuid', 'children')
+    .by('uuid')
+    .by(out('son').project('label', 'uuid').by(label).by('uuid').fold())"""
+
+GQ_GET_UUIDS = "g.V().hasLabel(label).has('uuid', within(uuids)).values('uuid')"
+
+# Drop a list of vertices and everything below them
+GQ_DROP_SUBTREES = """g.V().hasLabel(label).has('uuid', within(uuids))
+    .emit().repeat(out('son')).drop()"""
+
+GQ_DROP_VERTEX = GQ_GET_VERTEX + ".drop()"
+
+GQ_GET_PROPERTIES = GQ_GET_VERTEX + ".properties()"
+
+# Replace the metadata of a list of vertices in a single request: the
+# properties which aren't in the new map are dropped (except the reserved
+# ones), only the values which changed are written, the final properties of
+# each vertex are returned. A missing vertex (not synchronised yet) is
+# skipped with an empty map
+GQ_UPDATE_PROPERTIES = """updates.collect { u ->
+    def found = g.V().hasLabel(u.label).has('uuid', u.uuid).tryNext();
+    if (!found.isPresent()) {
+        return [:];
+    }
+    def v = found.get();
+    v.properties().toList().each { p ->
+        if (!reserved.contains(p.key()) && !u.metadata.containsKey(p.key())) {
+            p.remove();
+        }
+    };
+    u.metadata.each { key, value ->
+        def current = v.property(key);
+        if (!current.isPresent() || current.value() != value) {
+            v.property(key, value);
+        }
+    };
+    v.properties().toList().collectEntries { p -> [(p.key()): p.value()] }
+}"""
+
+
+def graph_execute(query, params=None):
+    """Execute a script with bound parameters on the shared graph session"""
+    session = get_graph_session()
+    return session.execute_graph(query, params or {})
+
+
+def graph_value(value):
+    """Return the text stored in a vertex property for a value"""
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return value
+    return unicode(value)
+
+
+def graph_metadata(metadata):
+    """Return the properties of a vertex for a metadata dictionary, None if
+    there's no metadata"""
+    if not metadata:
+        return None
+    return dict([(key, graph_value(value))
+                 for key, value in metadata.iteritems()])
+
+
+def graph_apply(entries):
+    """Apply a list of pending vertex mutations with one traversal for each
+    kind of mutation. Each entry is a dictionary with the 'label' and the
+    'uuid' of a vertex, 'drop' (True if the vertex is removed), 'add' (the
+    map of a new vertex) and 'metadata' (its new properties). The drops are
+    applied first so a vertex can be dropped and created again. The drops
+    and the adds are cleared from the entries once they are written, an
+    entry applied again after a failure doesn't create its vertex twice."""
+    drops = {}
+    for entry in entries:
+        if entry['drop']:
+            drops.setdefault(entry['label'], []).append(entry)
+    for label, dropped in drops.iteritems():
+        drop_vertices(label, [entry['uuid'] for entry in dropped])
+        for entry in dropped:
+            entry['drop'] = False
+    added = [entry for entry in entries if entry['add']]
+    if added:
+        graph_execute(GQ_ADD_VERTICES, {'vertices': [entry['add']
+                                                     for entry in added]})
+        for entry in added:
+            entry['add'] = None
+    updates = [{'label': entry['label'],
+                'uuid': entry['uuid'],
+                'metadata': entry['metadata']}
+               for entry in entries if entry['metadata'] is not None]
+    if updates:
+        return graph_execute(GQ_UPDATE_PROPERTIES, {
+            'updates': updates,
+            'reserved': RESERVED_META,
+        })
+    return None
+
+
+def graph_write(op, label, uuid, params):
+    """Apply a mutation ('add', 'update' or 'drop') to a vertex. In
+    write-behind mode it's queued and None is returned, otherwise the
+    result set of the request is returned"""
+    from indigo.graph_queue import graph_queue
+    if graph_queue.enabled():
+        graph_queue.put(op, label, uuid, params)
+        return None
+    return graph_apply([{
+        'label': label,
+        'uuid': uuid,
+        'drop': op == 'drop',
+        'add': params if op == 'add' else None,
+        'metadata': params if op == 'update' else None,
+    }])
+
+
+def gq_add_son_edges(edges):
+    """Link existing vertices to their parent collection, 'edges' is a list
+    of dictionaries with the 'label' and the 'uuid' of a vertex and the
+    'parent_uuid' of its collection"""
+    if edges:
+        graph_execute(GQ_ADD_SON_EDGES, {'edges': edges})
+
+
+def gq_add_users(users):
+    """Create the vertices of a list of users with a single request"""
+    if users:
+        graph_execute(GQ_ADD_USERS, {
+            'users': [{'name': user.name, 'uuid': user.uuid}
+                      for user in users]
+        })
+
+
+def gq_add_vertices(vertices):
+    """Create vertices from a list of maps (see vertex_collection() and
+    vertex_resource()) with a single request"""
+    if vertices:
+        graph_execute(GQ_ADD_VERTICES, {'vertices': vertices})
+
+
+def gq_add_vertex_collection(coll, parent=None, user=None):
+    """Create the vertex of a collection, linked to its parent collection and
+    to its owner if they are given"""
+    return graph_write('add', 'collection', coll.uuid,
+                       vertex_collection(coll, parent, user))
+
+
+def gq_add_vertex_resource(resc, parent, user=None):
+    """Create the vertex of a resource, linked to its collection and to its
+    owner if it's given"""
+    return graph_write('add', 'resource', resc.uuid,
+                       vertex_resource(resc, parent, user))
 
 
 def gq_add_vertex_user(user):
-    """Create the gremlin query that creates a Vertex for a user
-    """
-    query = "graph.addVertex(T.label, 'user', "
-    query += "'name', '{}', ".format(user.name)
-    query += "'uuid', '{}')".format(user.uuid)
-    return query
+    """Create the vertex of a user"""
+    return graph_execute(GQ_ADD_USER, {'name': user.name, 'uuid': user.uuid})
 
 
+def gq_drop_vertex(label, uuid):
+    """Remove a vertex and its edges"""
+    return graph_write('drop', label, uuid, None)
 
-def gq_get_vertex_collection(coll):
-    """Create the gremlin query that returns a Vertex for a collection given
-    its uuid
-    """
-    query = "g.V().hasLabel('collection').has('uuid', '{}')".format(coll.uuid)
-    return query
 
+def gq_drop_vertices(label, uuids):
+    """Remove a list of vertices and their edges. In write-behind mode the
+    drops are queued, so they are ordered with the pending mutations of the
+    vertices, otherwise they are written with bulk traversals"""
+    from indigo.graph_queue import graph_queue
+    if graph_queue.enabled():
+        for uuid in uuids:
+            graph_queue.put('drop', label, uuid, None)
+    else:
+        drop_vertices(label, uuids)
 
-def gq_get_metadata_collection(coll):
-    """Create the gremlin query that returns metadata for a collection given
-    its uuid
-    """
-    query = """{}.properties();
-            """.format(gq_get_vertex_collection(coll))
-    return query
 
+def gq_drop_subtrees(label, uuids):
+    """Drop a list of vertices and the vertices below them"""
+    uuids = list(uuids)
+    for idx in xrange(0, len(uuids), DROP_BATCH_SIZE):
+        graph_execute(GQ_DROP_SUBTREES, {'label': label,
+                                         'uuids': uuids[idx:idx + DROP_BATCH_SIZE]})
 
-def gq_get_metadata_resource(coll):
-    """Create the gremlin query that returns metadata for a resource given
-    its uuid
-    """
-    query = """{}.properties();
-            """.format(gq_get_vertex_resource(coll))
-    return query
 
+def gq_existing_uuids(label, uuids):
+    """Return the set of the uuids of a list which have a vertex"""
+    if not uuids:
+        return set()
+    rset = graph_execute(GQ_GET_UUIDS, {'label': label, 'uuids': list(uuids)})
+    return set([result.value for result in rset])
 
-def gq_get_vertex_resource(resc):
-    """Create the gremlin query that returns a Vertex for a resource given
-    its uuid
-    """
-    query = "g.V().hasLabel('resource').has('uuid', '{}')".format(resc.uuid)
-    return query
 
+def gq_get_children(uuids):
+    """Return a dictionary which maps the uuids of a list of collections to
+    the dictionary {uuid: label} of the children of their vertex. The
+    collections without a vertex are missing"""
+    if not uuids:
+        return {}
+    rset = graph_execute(GQ_GET_CHILDREN, {'uuids': list(uuids)})
+    res = {}
+    for result in rset:
+        res[result.value['uuid']] = dict([(child['uuid'], child['label'])
+                                          for child in result.value['children']])
+    return res
 
-def gq_get_vertex_user(user):
-    """Create the gremlin query that returns a Vertex for a user given
-    its uuid
-    """
-    query = "g.V().hasLabel('user').has('uuid', '{}')".format(user.uuid)
-    return query
+
+def gq_get_properties(label, uuid):
+    """Return the properties of a vertex"""
+    return graph_execute(GQ_GET_PROPERTIES, {'label': label, 'uuid': uuid})
+
+
+def gq_get_vertex(label, uuid):
+    """Return the result set of the vertex with a label and a uuid"""
+    return graph_execute(GQ_GET_VERTEX, {'label': label, 'uuid': uuid})
+
+
+def gq_update_properties(label, uuid, metadata):
+    """Replace the metadata of a vertex with a dictionary, with a single
+    request. Return the dictionary of the resulting metadata, empty if the
+    vertex doesn't exist, None in write-behind mode"""
+    rset = graph_write('update', label, uuid, graph_metadata(metadata) or {})
+    if rset is None:
+        return None
+    properties = {}
+    for result in rset:
+        properties.update(result.value)
+    return dict([(key, value) for key, value in properties.iteritems()
+                 if key not in RESERVED_META])
+
+
+def vertex_collection(coll, parent=None, user=None, metadata=None):
+    """Return the map which describes the vertex of a collection for
+    GQ_ADD_VERTICES"""
+    name = coll.entry.container.split('/')[-1]
+    if not name: # root
+        name = '/'
+    return {
+        'label': 'collection',
+        'name': name,
+        'uuid': coll.uuid,
+        'size': None,
+        'create_ts': graph_value(coll.entry.container_create_ts),
+        'modified_ts': graph_value(coll.entry.container_modified_ts),
+        'parent_uuid': parent.uuid if parent else None,
+        'user_uuid': user.uuid if user else None,
+        'metadata': graph_metadata(metadata),
+    }
 
 
+def vertex_resource(resc, parent, user=None, metadata=None):
+    """Return the map which describes the vertex of a resource for
+    GQ_ADD_VERTICES"""
+    return {
+        'label': 'resource',
+        'name': resc.get_name(),
+        'uuid': resc.uuid,
+        'size': graph_value(resc.get_size()),
+        'create_ts': graph_value(resc.get_create_ts()),
+        'modified_ts': graph_value(resc.get_modified_ts()),
+        'parent_uuid': parent.uuid,
+        'user_uuid': user.uuid if user else None,
+        'metadata': graph_metadata(metadata),
+    }
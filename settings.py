@@ -4,3 +4,26 @@ LOG_LEVEL = 'INFO'
 CASSANDRA_HOSTS = ('127.0.0.1', )
 REPLICATION_FACTOR = 3
 
+# Number of partitions for the entries of the new collections, 0 keeps all
+# the entries of a collection in a single partition
+TREE_ENTRY_BUCKETS = 0
+
+# Length of the longest prefix stored in the search index for the prefix and
+# type-ahead queries, 0 disables the prefix index
+SEARCH_PREFIX_LENGTH = 0
+
+# Number of partitions of each term of the search index, the objects are
+# spread over them with a hash of their path. The index has to be rebuilt
+# with 'iadmin reindex' when it is changed
+SEARCH_SHARDS = 1
+
+# Number of partitions of each metadata key and value in the metadata index,
+# the index has to be rebuilt with 'iadmin reindex' when it is changed
+METADATA_INDEX_SHARDS = 1
+
+# Write the graph mutations asynchronously: they are queued, coalesced per
+# vertex and flushed in batches by background threads. The mutations which
+# can't be written are kept in the graph_backlog table for
+# 'iadmin graph-replay'
+GRAPH_WRITE_BEHIND = False
+GRAPH_QUEUE_SIZE = 10000
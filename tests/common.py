@@ -45,6 +45,6 @@ class IndigoTestCase(unittest.TestCase):
 
 
     def delete_collection(self, path):
-        Collection.delete_all(path)
+        Collection.delete_all(path, wait=True)
 
 
@@ -0,0 +1,159 @@
+"""Common class for unittest - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import itertools
+import unittest
+
+from indigo.models.acl import (
+    AceValue,
+    acemask_to_str,
+    ACTION_BITS,
+    acl_map_to_cql,
+    acemask_to_cdmi_str,
+    aceflag_to_cdmi_str,
+    ACEFLAG_CONTAINER_INHERIT,
+    ACEFLAG_INHERIT_ONLY,
+    ACEFLAG_INHERITED,
+    ACEFLAG_NO_PROPAGATE,
+    ACEFLAG_OBJECT_INHERIT,
+    AUTHENTICATED,
+    CompiledAcl,
+    inherited_acl,
+    mask_to_actions,
+    mask_to_dict,
+    str_to_acemask,
+)
+
+
+def baseline_actions(acl, groups, is_object):
+    """The decision of get_authorized_actions before the ACL were compiled"""
+    if not is_object:
+        groups = groups + ["AUTHENTICATED@"]
+    actions = set([])
+    for gid in groups:
+        if gid in acl:
+            level = acemask_to_str(acl[gid].acemask, is_object)
+            if level == "read":
+                actions.add("read")
+            elif level == "write":
+                actions.update(["write", "delete", "edit"])
+            elif level == "read/write":
+                actions.update(["read", "write", "delete", "edit"])
+    return actions
+
+
+class AclTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_can(self):
+        acl = CompiledAcl({
+            "grp1": AceValue("ALLOW", "grp1", 0, str_to_acemask("read", False)),
+            "grp2": AceValue("ALLOW", "grp2", 0, str_to_acemask("write", False)),
+            "grp3": AceValue("ALLOW", "grp3", 0, 0x1F),
+        })
+        assert acl.can(["grp1"], "read")
+        assert not acl.can(["grp1"], "write")
+        assert acl.can(["grp2"], "delete")
+        assert not acl.can(["grp4"], "read")
+        # Only the exact access levels grant something
+        assert not acl.can(["grp3"], "read")
+        assert mask_to_actions(acl.mask(["grp1", "grp2"])) == set(["read",
+                                                                   "write",
+                                                                   "edit",
+                                                                   "delete"])
+
+    def test_same_as_baseline(self):
+        masks = [0x0, 0x01, 0x09, 0x1F, 0x56, 0x5F, 0xFF, 0x10056]
+        aces = [None] + [(acetype, flags, mask)
+                         for acetype in ("ALLOW", "DENY")
+                         for flags in (0, ACEFLAG_INHERIT_ONLY)
+                         for mask in masks]
+        idents = ["grp1", "grp2", AUTHENTICATED]
+        users = [[], ["grp1"], ["grp2"], ["grp1", "grp2"]]
+        for values in itertools.product(aces, repeat=len(idents)):
+            acl = {}
+            for ident, value in zip(idents, values):
+                if value:
+                    acl[ident] = AceValue(value[0], ident, value[1], value[2])
+            for is_object in (True, False):
+                compiled = CompiledAcl(acl, is_object)
+                for groups in users:
+                    mask = compiled.mask(groups + [AUTHENTICATED])
+                    assert (mask_to_actions(mask) ==
+                            baseline_actions(acl, groups, is_object)), \
+                        (acl, groups, is_object)
+
+    def test_empty(self):
+        acl = CompiledAcl()
+        assert not acl
+        assert not acl.can(["grp1"], "read")
+
+    def test_mask_to_dict(self):
+        assert mask_to_dict(ACTION_BITS["read"]) == {"can_read": True,
+                                                     "can_write": False,
+                                                     "can_edit": False,
+                                                     "can_delete": False}
+
+    def test_cdmi_str(self):
+        assert acemask_to_cdmi_str(0x09, True) == "READ_METADATA, READ_OBJECT"
+        assert acemask_to_cdmi_str(0x09, False) == "READ_METADATA, LIST_CONTAINER"
+        assert acemask_to_cdmi_str(0x20001, True) == "READ_ACL, READ_OBJECT"
+        assert aceflag_to_cdmi_str(0x03) == "CONTAINER_INHERIT, OBJECT_INHERIT"
+        assert aceflag_to_cdmi_str(0) == ""
+
+    def test_acl_map_to_cql(self):
+        acl = {"grp1": AceValue("ALLOW", "grp1", 0, 0x09)}
+        assert acl_map_to_cql(acl) == (u"{'grp1': {acetype: 'ALLOW', "
+                                       u"identifier: 'grp1', aceflags: 0, "
+                                       u"acemask: 9}}")
+        assert acl_map_to_cql({}) == u"{}"
+
+    def test_inherited_acl(self):
+        acl = {
+            "grp1": AceValue("ALLOW", "grp1", 0, 0x09),
+            "grp2": AceValue("ALLOW", "grp2", ACEFLAG_OBJECT_INHERIT, 0x09),
+            "grp3": AceValue("ALLOW", "grp3",
+                             ACEFLAG_CONTAINER_INHERIT | ACEFLAG_NO_PROPAGATE,
+                             0x09),
+        }
+        objects = inherited_acl(acl, True)
+        assert sorted(objects) == ["grp1", "grp2"]
+        assert objects["grp1"].aceflags == ACEFLAG_INHERITED
+        containers = inherited_acl(acl, False)
+        assert sorted(containers) == ["grp1", "grp2", "grp3"]
+        assert containers["grp2"].aceflags & ACEFLAG_INHERIT_ONLY
+        assert containers["grp3"].aceflags == ACEFLAG_INHERITED
+        # The INHERIT_ONLY entries only reach the objects
+        assert not CompiledAcl(containers).can(["grp2"], "read")
+        assert CompiledAcl(inherited_acl(containers, True)).can(["grp2"], "read")
+        # NO_PROPAGATE stops after one level
+        assert "grp3" not in inherited_acl(containers, False)
+
+    def test_inherited_authenticated(self):
+        # ACL propagated from a collection (see AclPropagation)
+        acl = {AUTHENTICATED: AceValue("ALLOW", AUTHENTICATED, 0,
+                                       str_to_acemask("read", False))}
+        for _ in xrange(3):
+            resource_acl = CompiledAcl(inherited_acl(acl, True), True)
+            assert resource_acl.can(["grp1", AUTHENTICATED], "read")
+            assert not resource_acl.can(["grp1"], "read")
+            acl = inherited_acl(acl, False)
+        # An ACL written on the object itself still ignores AUTHENTICATED@
+        stored = {AUTHENTICATED: AceValue("ALLOW", AUTHENTICATED, 0,
+                                          str_to_acemask("read", True))}
+        assert not CompiledAcl(stored, True).can([AUTHENTICATED], "read")
@@ -0,0 +1,117 @@
+"""Common class for unittest - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+import unittest
+
+
+from indigo import util_graph
+from indigo.graph_queue import (
+    GraphWriteQueue,
+    coalesce,
+    merge,
+    new_entry,
+)
+
+
+class GraphQueueTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_coalesce(self):
+        entry = new_entry("resource", "1")
+        assert coalesce(entry, "add", {"uuid": "1"})
+        assert coalesce(entry, "update", {"a": "1"})
+        assert coalesce(entry, "update", {"a": "2"})
+        assert entry["add"] == {"uuid": "1"}
+        assert entry["metadata"] == {"a": "2"}
+        # The vertex has never been written, nothing to do
+        assert not coalesce(entry, "drop", None)
+
+        entry = new_entry("resource", "2")
+        assert coalesce(entry, "update", {"a": "1"})
+        assert coalesce(entry, "drop", None)
+        assert entry["drop"] and entry["metadata"] is None
+        self.assertRaises(ValueError, coalesce, entry, "move", None)
+
+    def test_merge(self):
+        older = new_entry("collection", "1")
+        coalesce(older, "add", {"uuid": "1"})
+        newer = new_entry("collection", "1")
+        coalesce(newer, "update", {"a": "1"})
+        entry = merge(older, newer)
+        assert entry["add"] == {"uuid": "1"}
+        assert entry["metadata"] == {"a": "1"}
+        coalesce(newer, "drop", None)
+        assert merge(older, newer)["drop"]
+
+    def test_apply_retry(self):
+        calls = []
+        def graph_execute(query, params=None):
+            calls.append(query)
+            if query == util_graph.GQ_UPDATE_PROPERTIES:
+                raise IOError("timeout")
+        def drop_vertices(label, uuids):
+            calls.append("drop")
+        saved = util_graph.graph_execute, util_graph.drop_vertices
+        util_graph.graph_execute = graph_execute
+        util_graph.drop_vertices = drop_vertices
+        try:
+            entry = new_entry("resource", "1")
+            coalesce(entry, "drop", None)
+            coalesce(entry, "add", {"uuid": "1"})
+            coalesce(entry, "update", {"a": "1"})
+            self.assertRaises(IOError, util_graph.graph_apply, [entry])
+            # The drop and the add were written, only the update is left
+            assert not entry["drop"] and entry["add"] is None
+            assert entry["metadata"] == {"a": "1"}
+            del calls[:]
+            self.assertRaises(IOError, util_graph.graph_apply, [entry])
+            assert calls == [util_graph.GQ_UPDATE_PROPERTIES]
+        finally:
+            util_graph.graph_execute, util_graph.drop_vertices = saved
+
+    def test_take_order(self):
+        # No worker thread, the batches are taken by hand
+        queue = GraphWriteQueue(workers=0, batch_size=10)
+        queue.put("add", "resource", "1", {"uuid": "1"})
+        first = queue._take()
+        assert [entry["uuid"] for entry in first] == ["1"]
+        queue.put("drop", "resource", "1", None)
+        queue.put("add", "resource", "2", {"uuid": "2"})
+        # The drop of "1" waits until its add has been written
+        second = queue._take()
+        assert [entry["uuid"] for entry in second] == ["2"]
+        assert queue.stats()["depth"] == 1
+        queue._done(first)
+        third = queue._take()
+        assert [(entry["uuid"], entry["drop"]) for entry in third] == [("1", True)]
+        queue._done(second)
+        queue._done(third)
+        assert queue.flush(0)
+
+    def test_drop_pending_parent(self):
+        queue = GraphWriteQueue(workers=0, batch_size=10)
+        queue.put("add", "collection", "p", {"uuid": "p"})
+        queue.put("add", "collection", "c", {"uuid": "c", "parent_uuid": "p"})
+        queue.put("add", "resource", "r", {"uuid": "r", "parent_uuid": "c"})
+        queue.put("add", "resource", "s", {"uuid": "s", "parent_uuid": "x"})
+        queue.put("drop", "collection", "p", None)
+        # The children of "p" would be linked to a vertex never created
+        batch = queue._take()
+        assert [entry["uuid"] for entry in batch] == ["s"], batch
+        queue._done(batch)
@@ -0,0 +1,32 @@
+"""Common class for unittest - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+import unittest
+
+
+from indigo.graph_sync import chunks
+
+
+class GraphSyncTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_chunks(self):
+        assert list(chunks(xrange(5), 2)) == [[0, 1], [2, 3], [4]]
+        assert list(chunks(iter([]), 2)) == []
+        assert list(chunks("abc", 3)) == [["a", "b", "c"]]
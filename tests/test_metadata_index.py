@@ -0,0 +1,88 @@
+"""Common class for unittest - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+import unittest
+
+from indigo.models.metadata_index import (
+    MetadataIndex,
+    index_changes,
+    metadata_couples,
+    path_range,
+)
+from tests.common import IndigoTestCase
+
+
+class MetadataIndexTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_metadata_couples(self):
+        couples = metadata_couples({"project": "radon",
+                                    "tags": ["a", "b"],
+                                    "empty": ""})
+        assert couples == set([("project", u"radon"),
+                               ("tags", u"a"),
+                               ("tags", u"b")])
+        assert metadata_couples(None) == set()
+
+    def test_path_range(self):
+        assert path_range("/") is None
+        assert path_range("/a/b/") == (u"/a/b/", u"/a/b0")
+        low, high = path_range("/a")
+        assert low <= u"/a/c.txt" < high
+        assert not low <= u"/ab" < high
+
+    def test_index_changes(self):
+        inserts, deletes, key_inserts, key_deletes = index_changes(
+            [("/a/b", "Resource", {"project": "radon", "owner": "x"},
+              {"project": "radon", "owner": "y", "tags": ["t"]})], 1)
+        assert inserts == {("owner", u"y", 0): [("owner", u"y", 0, "/a/b", "Resource")],
+                           ("tags", u"t", 0): [("tags", u"t", 0, "/a/b", "Resource")]}
+        assert deletes == {("owner", u"x", 0): [("owner", u"x", 0, "/a/b")]}
+        assert key_inserts == {("tags", 0): [("tags", 0, "/a/b", "Resource")]}
+        assert key_deletes == {}
+        assert index_changes([("/a/b", "Resource", {"k": "v"}, {"k": "v"})],
+                             1) == ({}, {}, {}, {})
+        inserts, deletes, key_inserts, _ = index_changes(
+            [("/a/b", "Resource", {"k": "v"}, {"k": "v"})], 1, True)
+        assert inserts == {("k", u"v", 0): [("k", u"v", 0, "/a/b", "Resource")]}
+        assert key_inserts == {("k", 0): [("k", 0, "/a/b", "Resource")]}
+        assert deletes == {}
+
+
+class MetadataFindTest(IndigoTestCase):
+
+    def test_find_path(self):
+        self.create_collection("/md_a")
+        self.create_collection("/md_ab")
+        try:
+            for path in ("/md_a/", "/md_ab/"):
+                MetadataIndex.update_many([(path + "c.txt", "Resource",
+                                            None, {"project": "radon"})])
+            found = MetadataIndex.find("project", "radon", "/md_a")
+            assert found == [(u"/md_a/c.txt", u"Resource")], found
+            found = MetadataIndex.find("project", path="/md_ab/")
+            assert found == [(u"/md_ab/c.txt", u"Resource")], found
+            assert len(MetadataIndex.find("project", "radon")) >= 2
+            assert MetadataIndex.find("project", "other", "/md_a") == []
+        finally:
+            MetadataIndex.reset_many([(path + "c.txt", "Resource",
+                                       {"project": "radon"})
+                                      for path in ("/md_a/", "/md_ab/")])
+            self.delete_collection("/md_a")
+            self.delete_collection("/md_ab")
@@ -17,7 +17,12 @@ limitations under the License.
 
 import unittest
 
-from indigo.models.search import SearchIndex
+from indigo.models.search import (
+    SearchIndex,
+    prefixes,
+    shard_for,
+    tokenize,
+)
 from indigo.models.collection import Collection
 from indigo.models.user import User
 from indigo.models.group import Group
@@ -66,3 +71,31 @@ class SearchTest(unittest.TestCase):
 
         results = SearchIndex.find(["protected"], reading_user)
         assert len(results) == 0, results
+
+    @raises(ValueError)
+    def test_find_page_limit(self):
+        SearchIndex.find_page(["test"], None, limit=0)
+
+    def test_get_terms(self):
+        class Named(object):
+            name = "My_file.txt"
+        terms = SearchIndex.get_terms(Named(), ['name'])
+        assert terms == set([("name", "my"),
+                             ("name", "file"),
+                             ("name", "txt"),
+                             ("name", "my_file.txt")]), terms
+
+    def test_tokenize(self):
+        assert tokenize("The_Report.pdf") == ["report", "pdf", "the_report.pdf"]
+        assert tokenize("The_Report.pdf", False) == ["report", "pdf"]
+        assert tokenize("") == []
+
+    def test_prefixes(self):
+        assert prefixes("exper", 4) == ["ex", "exp", "expe"]
+        assert prefixes("ab", 4) == ["ab"]
+        assert prefixes("abc", 0) == []
+
+    def test_shard_for(self):
+        assert shard_for(u"/a/b.txt", 8) == shard_for("/a/b.txt", 8)
+        assert 0 <= shard_for(u"/a/\xe9t\xe9.txt", 8) < 8
+        assert shard_for(u"/a/b.txt", 1) == 0
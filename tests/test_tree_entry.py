@@ -0,0 +1,37 @@
+"""Common class for unittest - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import unittest
+
+from indigo.models.tree_entry import bucket_for
+
+
+class TreeEntryTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_bucket_for(self):
+        for name in [u"a", u"file.txt", u"dir/", u"\xe9t\xe9.txt"]:
+            bucket = bucket_for(name, 16)
+            assert 0 <= bucket < 16
+            # The bucket doesn't depend on the type of the string
+            assert bucket_for(name.encode('utf-8'), 16) == bucket
+
+    def test_bucket_for_stable(self):
+        # The bucket is stored in Cassandra, the hash can't change
+        assert bucket_for(u"file.txt", 1) == 0
+        assert bucket_for(u"a", 7) == (0xe8b7be43 % 7)
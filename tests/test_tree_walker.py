@@ -0,0 +1,77 @@
+"""Common class for unittest - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from indigo.tree_walker import TreeWalker
+
+
+TREE = {
+    "/": ["/a", "/b", "/c"],
+    "/a": ["/a/x", "/a/y"],
+    "/c": ["/c/z"],
+    "/a/y": ["/a/y/w"],
+}
+
+
+class FakeWalker(TreeWalker):
+    """Walk a tree given as a dictionary"""
+
+    def __init__(self, states):
+        super(FakeWalker, self).__init__("/", workers=2, batch_size=2)
+        self.checkpoint = states.append
+
+    def _sub_collections(self, paths):
+        return [child for path in paths for child in TREE.get(path, [])]
+
+    def _visit(self, paths):
+        return self._sub_collections(paths), paths
+
+
+class TreeWalkerTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def walk(self, state=None):
+        states = []
+        walker = FakeWalker(states)
+        pool = ThreadPool(2)
+        try:
+            visited = [path for batch in walker._walk(pool, walker._visit,
+                                                      "/", state)
+                       for path in batch]
+        finally:
+            pool.close()
+            pool.join()
+        return visited, states
+
+    def test_walk(self):
+        visited, states = self.walk()
+        assert visited == ["/", "/a", "/b", "/c", "/a/x", "/a/y", "/c/z",
+                           "/a/y/w"], visited
+        assert [(state["depth"], state["cursor"]) for state in states] == \
+            [(0, "/"), (1, "/b"), (1, "/c"), (2, "/a/y"), (2, "/c/z"),
+             (3, "/a/y/w")]
+        assert "level" not in states[0]
+
+    def test_resume(self):
+        visited, _ = self.walk({"depth": 1, "cursor": "/b"})
+        # The children of "/a" are still walked
+        assert visited == ["/c", "/a/x", "/a/y", "/c/z", "/a/y/w"], visited
+        visited, _ = self.walk({"depth": 2, "cursor": "/c/z"})
+        assert visited == ["/a/y/w"], visited
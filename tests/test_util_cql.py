@@ -0,0 +1,42 @@
+"""Common class for unittest - Project RADON version
+
+Copyright 2019 University of Liverpool
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+
+from indigo.util_cql import (
+    decode_cursor,
+    encode_cursor,
+)
+
+from nose.tools import raises
+
+class UtilCqlTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def test_cursor(self):
+        paging_state = '\x00\x10\xff\xfe/+='
+        cursor = encode_cursor(paging_state)
+        assert '/' not in cursor
+        assert decode_cursor(cursor) == paging_state
+
+    def test_cursor_last_page(self):
+        assert encode_cursor(None) is None
+        assert decode_cursor(None) is None
+
+    @raises(ValueError)
+    def test_cursor_invalid(self):
+        decode_cursor("not a cursor")